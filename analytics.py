@@ -0,0 +1,1228 @@
+"""
+Customer analytics computations: RFM, CLTV and KMeans clustering
+
+Pure pandas/scikit-learn code with no Streamlit dependency, shared by the
+dashboard (app.py) and the headless batch pipeline (pipeline.py).
+"""
+
+import pandas as pd
+import numpy as np
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.metrics import adjusted_rand_score, silhouette_score
+from sklearn.preprocessing import StandardScaler
+from joblib import Parallel, delayed
+from scipy.optimize import linear_sum_assignment
+from pandas.api.types import union_categoricals
+import glob
+import hashlib
+import io
+import json
+import os
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:  # the on-disk transaction cache is skipped without pyarrow
+    pq = None
+
+from cltv_models import predict_cltv
+from instrumentation import track
+from sketches import DEFAULT_K, KLLSketch
+
+# RFM segment rules, evaluated top to bottom: a customer gets the first
+# segment whose conditions all hold. Each row is (segment, column, op, value)
+# and a segment may span several rows (conditions are AND-ed).
+RFM_SEGMENT_RULES = [
+    ('Champions', 'RFM_Segment', '>=', 10),
+    ('Champions', 'R_Score', '>=', 4),
+    ('Loyal Customers', 'RFM_Segment', '>=', 7),
+    ('Loyal Customers', 'R_Score', '>=', 3),
+    ('Potential Loyalists', 'F_Score', '>=', 3),
+    ('Potential Loyalists', 'R_Score', '>=', 3),
+    ('Recent Customers', 'R_Score', '>=', 4),
+    ('At Risk', 'RFM_Segment', '>=', 6),
+    ('At Risk', 'R_Score', '<=', 2),
+    ('Cant Lose Them', 'F_Score', '>=', 2),
+    ('Cant Lose Them', 'R_Score', '<=', 2),
+    ('Lost', 'R_Score', '<=', 2),
+]
+RFM_DEFAULT_SEGMENT = 'Others'
+
+# Optional override: a CSV with the same four columns replaces the rules above
+RFM_RULES_PATH = 'data/rfm_segment_rules.csv'
+
+# Cluster naming rules: same layout, but value is a quantile of the cluster
+# profile means (e.g. 0.75 means "above the 75th percentile of clusters")
+CLUSTER_NAME_RULES = [
+    ('VIP Champions', 'Frequency', '>', 0.75),
+    ('VIP Champions', 'Monetary', '>', 0.75),
+    ('Recent Big Spenders', 'Recency', '<', 0.25),
+    ('Recent Big Spenders', 'Monetary', '>', 0.5),
+    ('Low Engagement', 'Frequency', '<=', 0.25),
+    ('Low Engagement', 'Monetary', '<=', 0.25),
+]
+CLUSTER_DEFAULT_NAME = 'Regular Customers'
+
+RULE_OPERATORS = {
+    '>=': np.greater_equal,
+    '>': np.greater,
+    '<=': np.less_equal,
+    '<': np.less,
+    '==': np.equal,
+}
+
+def load_segment_rules(path):
+    """Load a segment rule table from a CSV with Segment, Column, Op, Value columns"""
+    if not os.path.exists(path):
+        return RFM_SEGMENT_RULES
+    table = pd.read_csv(path)
+    return list(table[['Segment', 'Column', 'Op', 'Value']].itertuples(index=False, name=None))
+
+def rules_fingerprint(path):
+    """Hash of a segment rule CSV, so results keyed by it change when the rules do"""
+    if not os.path.exists(path):
+        return 'default'
+    with open(path, 'rb') as f:
+        return hashlib.blake2b(f.read(), digest_size=8).hexdigest()
+
+def evaluate_segment_rules(values, rules, default):
+    """Assign each row the first matching segment, evaluated as array operations"""
+    segments = list(dict.fromkeys(rule[0] for rule in rules))
+    conditions = {segment: np.ones(len(values), dtype=bool) for segment in segments}
+
+    for segment, column, op, threshold in rules:
+        conditions[segment] &= RULE_OPERATORS[op](values[column].to_numpy(dtype=float), threshold)
+
+    return np.select([conditions[segment] for segment in segments], segments, default=default)
+
+DATA_PATH = 'data/canteen_shop_data.csv'
+CACHE_DIR = os.environ.get('CUSTOMER_ANALYTICS_CACHE_DIR', '.cache')
+
+# Files larger than this are streamed in chunks instead of loaded whole
+STREAMING_THRESHOLD_BYTES = 256 * 1024 ** 2
+CHUNK_SIZE = 500_000
+
+# Explicit dtypes so chunks parse consistently before compaction
+TRANSACTION_DTYPES = {
+    'Date': str,
+    'Time': str,
+    'Item': str,
+    'Price': 'float64',
+    'Quantity': 'float64',
+    'Total': 'float64',
+    'Customer ID': 'Int64',
+    'Payment Method': str,
+    'Employee ID': 'Int64',
+    'Customer Satisfaction': 'Int64',
+    'Weather': str,
+    'Special Offers': str,
+}
+
+# Compact in-memory schema: categoricals for low-cardinality text, narrow
+# integers for IDs and ratings, float32 for unit prices. Total stays float64
+# because revenue is summed over millions of rows. Date is parsed to
+# datetime64 separately, and Quantity is narrowed by clean_transactions once
+# returns are dropped, since it may be fractional or exceed 16 bits.
+COMPACT_DTYPES = {
+    'Time': 'category',
+    'Item': 'category',
+    'Price': 'float32',
+    'Total': 'float64',
+    'Customer ID': 'Int32',
+    'Payment Method': 'category',
+    'Employee ID': 'Int32',
+    'Customer Satisfaction': 'Int8',
+    'Weather': 'category',
+    'Special Offers': 'category',
+}
+# Bump when the cached transaction schema changes so old caches are rebuilt
+TRANSACTION_SCHEMA_VERSION = 3
+# Bump when the persisted customer summary changes columns
+CUSTOMER_STATE_VERSION = 4
+# Bump when the persisted rollups gain or change tables, columns or partitioning
+ROLLUP_STATE_VERSION = 2
+# Rollups of a large export, persisted by month and refreshed apart from the summary
+ROLLUP_TABLES = ['daily_cube', 'basket_lines']
+
+def source_fingerprint(path, sample_bytes=1024 ** 2):
+    """Fingerprint a source file from its size, mtime and content hash"""
+    # Hash the head and tail of large files so multi-GB sources stay cheap;
+    # appended rows change the size and tail, edits in place change mtime
+    stat = os.stat(path)
+    digest = hashlib.blake2b(f'{stat.st_size}:{stat.st_mtime_ns}'.encode(), digest_size=16)
+    with open(path, 'rb') as f:
+        if stat.st_size <= 2 * sample_bytes:
+            digest.update(f.read())
+        else:
+            digest.update(f.read(sample_bytes))
+            f.seek(-sample_bytes, os.SEEK_END)
+            digest.update(f.read())
+    return digest.hexdigest()
+
+def transaction_cache_path(path, fingerprint):
+    """Location of the cleaned-transactions Parquet cache for a source file"""
+    stem = os.path.splitext(os.path.basename(path))[0]
+    key = hashlib.blake2b(f'{fingerprint}:{TRANSACTION_SCHEMA_VERSION}'.encode(), digest_size=16).hexdigest()
+    return os.path.join(CACHE_DIR, f'{stem}-{key}.parquet')
+
+def _publish_cache(tmp_path, cache_path):
+    """Atomically move a finished cache file into place and drop stale ones"""
+    os.replace(tmp_path, cache_path)
+    stem = os.path.basename(cache_path).rsplit('-', 1)[0]
+    pattern = f'{stem}-' + '[0-9a-f]' * 32 + '.parquet'
+    for stale in glob.glob(os.path.join(CACHE_DIR, pattern)):
+        if stale != cache_path:
+            try:
+                os.remove(stale)
+            except OSError:
+                pass
+
+def memory_mb(df):
+    """In-memory size of a DataFrame, including string contents"""
+    return df.memory_usage(deep=True).sum() / 1024 ** 2
+
+def compact_transactions(df):
+    """Convert raw transactions to the compact in-memory schema"""
+    df = df.astype({column: dtype for column, dtype in COMPACT_DTYPES.items() if column in df})
+    if 'Date' in df:
+        df['Date'] = pd.to_datetime(df['Date'])
+    return df
+
+def concat_transactions(chunks):
+    """Concatenate compact chunks, unifying categories so columns stay categorical"""
+    categories = {column: pd.CategoricalDtype(union_categoricals([chunk[column] for chunk in chunks]).categories)
+                  for column in chunks[0].select_dtypes('category')}
+    return pd.concat([chunk.astype(categories) for chunk in chunks])
+
+def clean_transactions(df):
+    """Drop returns and zero/negative prices with a single boolean mask
+
+    Quantity is then downcast to the smallest integer type holding it; it
+    stays float when any quantity is fractional or too large to fit.
+    """
+    df = df[(df['Quantity'] > 0) & (df['Price'] > 0)]
+    return df.assign(Quantity=pd.to_numeric(df['Quantity'], downcast='integer'),
+                     TotalPrice=(df['Quantity'] * df['Price']).astype('float32'))
+
+# Cache data loading and processing
+def load_and_process_data(path=DATA_PATH, fingerprint=None):
+    """Load and process the canteen sales data"""
+    fingerprint = fingerprint or source_fingerprint(path)
+    cache_path = transaction_cache_path(path, fingerprint)
+    if pq is not None and os.path.exists(cache_path):
+        return pd.read_parquet(cache_path)
+
+    # Parse in chunks so only one chunk is ever held in the raw schema
+    with track('parse_transactions', kind='step') as record:
+        raw_mb = compact_mb = 0.0
+        chunks = []
+        for chunk in pd.read_csv(path, dtype=TRANSACTION_DTYPES, chunksize=CHUNK_SIZE):
+            raw_mb += memory_mb(chunk)
+            chunk = compact_transactions(chunk)
+            compact_mb += memory_mb(chunk)
+            chunks.append(clean_transactions(chunk))
+        df = concat_transactions(chunks)
+        record.update(rows=len(df), raw_mb=round(raw_mb, 1), compact_mb=round(compact_mb, 1))
+
+    if pq is not None:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+        df.to_parquet(tmp_path, index=False)
+        _publish_cache(tmp_path, cache_path)
+
+    return df
+
+def summarize_transactions(df):
+    """Partial per-customer aggregates, indexed by Customer ID"""
+    # Parse dates once; RFM and CLTV are both derived from this table
+    transactions = pd.DataFrame({
+        'Customer ID': df['Customer ID'],
+        'Date': pd.to_datetime(df['Date']),
+        'Item': df['Item'],
+        'Total': df['Total']
+    })
+
+    return transactions.groupby('Customer ID').agg(
+        FirstPurchase=('Date', 'min'),
+        LastPurchase=('Date', 'max'),
+        NumPurchases=('Item', 'count'),
+        PurchaseDays=('Date', 'nunique'),
+        TotalRevenue=('Total', 'sum')
+    )
+
+def finalize_summary(partial):
+    """Turn partial aggregates into the customer summary table"""
+    summary = partial.reset_index()
+    summary['Customer ID'] = summary['Customer ID'].astype('int64')
+    summary['CustomerLifespan'] = (summary['LastPurchase'] - summary['FirstPurchase']).dt.days
+    return summary
+
+def build_customer_summary(df):
+    """Aggregate transactions to one row per customer in a single pass"""
+    return finalize_summary(summarize_transactions(df))
+
+def dataset_overview(summary):
+    """Sidebar dataset metrics, derived from the customer summary"""
+    return {
+        'transactions': int(summary['NumPurchases'].sum()),
+        'customers': len(summary),
+        'first_date': summary['FirstPurchase'].min().strftime('%Y-%m-%d'),
+        'last_date': summary['LastPurchase'].max().strftime('%Y-%m-%d'),
+        'revenue': summary['TotalRevenue'].sum(),
+    }
+
+# Dimensions the dashboard can filter on; the daily cube keeps one row per
+# customer, day and combination of these
+CUBE_DIMENSIONS = ['Payment Method', 'Weather', 'Special Offers', 'Employee ID']
+
+def summarize_daily(df):
+    """Partial daily rollup: purchases and revenue per customer, day and dimensions"""
+    df = df[df['Customer ID'].notna()]
+    rollup = df.assign(Date=pd.to_datetime(df['Date'])).groupby(
+        ['Customer ID', 'Date', *CUBE_DIMENSIONS], observed=True, dropna=False
+    ).agg(Purchases=('Item', 'count'), Revenue=('Total', 'sum'))
+    return rollup.reset_index()
+
+def merge_daily(*partials):
+    """Combine partial rollups of different chunks into one sorted cube"""
+    rollup = concat_transactions(list(partials)).groupby(
+        ['Customer ID', 'Date', *CUBE_DIMENSIONS], observed=True, dropna=False
+    )[['Purchases', 'Revenue']].sum()
+    return finalize_daily(rollup.reset_index())
+
+def finalize_daily(rollup):
+    """Sort the cube by customer and day, as summarize_cube expects"""
+    rollup = rollup.astype({'Customer ID': 'int32', 'Purchases': 'int32'})
+    return rollup.sort_values(['Customer ID', 'Date'], kind='stable').reset_index(drop=True)
+
+def build_daily_cube(df):
+    """Per-customer, per-day rollup cube of the transactions"""
+    return finalize_daily(summarize_daily(df))
+
+# Columns that identify a basket line: a customer's items at one date and time
+BASKET_COLUMNS = ['Customer ID', 'Date', 'Time', 'Item']
+
+def basket_lines(df):
+    """Distinct (customer, date, time, item) lines of cleaned transactions"""
+    lines = df.loc[df['Customer ID'].notna(), BASKET_COLUMNS]
+    lines = lines.assign(Date=pd.to_datetime(lines['Date']))
+    return lines.drop_duplicates(ignore_index=True)
+
+def cube_dimensions(cube):
+    """Values each filterable dimension takes, for the sidebar filters"""
+    return {column: sorted(cube[column].dropna().unique().tolist()) for column in CUBE_DIMENSIONS}
+
+def filter_cube(cube, start=None, end=None, selections=None):
+    """Cube rows within [start, end] whose dimensions take one of the selected values"""
+    mask = np.ones(len(cube), dtype=bool)
+    if start is not None:
+        mask &= (cube['Date'] >= pd.Timestamp(start)).to_numpy()
+    if end is not None:
+        mask &= (cube['Date'] <= pd.Timestamp(end)).to_numpy()
+    for column, values in (selections or {}).items():
+        if values:
+            mask &= cube[column].isin(values).to_numpy()
+    return cube[mask]
+
+def summarize_cube(cube):
+    """Customer summary re-derived from (filtered) cube rows
+
+    Rows are sorted by customer and day, so each customer is one contiguous
+    run: first and last purchase are its first and last dates, and counts
+    and revenue are segment sums, without a groupby.
+    """
+    customers = cube['Customer ID'].to_numpy()
+    starts = np.flatnonzero(np.diff(customers, prepend=customers[:1] - 1))
+    ends = np.r_[starts[1:] - 1, len(customers) - 1][:len(starts)]
+    dates = cube['Date'].to_numpy()
+    new_day = np.r_[True, (customers[1:] != customers[:-1]) | (dates[1:] != dates[:-1])][:len(customers)]
+
+    partial = pd.DataFrame({
+        'FirstPurchase': dates[starts],
+        'LastPurchase': dates[ends],
+        'NumPurchases': np.add.reduceat(cube['Purchases'].to_numpy(dtype=np.int64), starts),
+        'PurchaseDays': np.add.reduceat(new_day.astype(np.int64), starts),
+        'TotalRevenue': np.add.reduceat(cube['Revenue'].to_numpy(), starts),
+    }, index=pd.Index(customers[starts], name='Customer ID'))
+    return finalize_summary(partial)
+
+class _ByteRange(io.RawIOBase):
+    """Read-only view of a byte range of an open file"""
+
+    def __init__(self, f, remaining):
+        self.f = f
+        self.remaining = remaining
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.f.read(min(len(buffer), self.remaining))
+        buffer[:len(data)] = data
+        self.remaining -= len(data)
+        return len(data)
+
+def complete_length(path, window=64 * 1024):
+    """Byte length of the file up to and including its last complete line"""
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        while size > 0:
+            start = max(0, size - window)
+            f.seek(start)
+            newline = f.read(size - start).rfind(b'\n')
+            if newline >= 0:
+                return start + newline + 1
+            size = start
+    return 0
+
+def read_transaction_range(path, start, end, chunksize=CHUNK_SIZE):
+    """Yield cleaned transaction chunks from the CSV bytes [start, end)"""
+    with open(path, 'rb') as f:
+        header = f.readline()
+        names = header.decode().strip().split(',')
+        if start == 0:
+            start = len(header)
+        if end <= start:
+            return
+        f.seek(start)
+        rows = io.BufferedReader(_ByteRange(f, end - start))
+        for chunk in pd.read_csv(rows, names=names, header=None, dtype=TRANSACTION_DTYPES, chunksize=chunksize):
+            yield clean_transactions(compact_transactions(chunk))
+
+def apply_transaction_delta(summary, delta):
+    """Fold a batch of cleaned transactions into an existing customer summary
+
+    Only customers present in the delta are touched; new customers are
+    appended. Cost is proportional to the delta, plus a vectorized
+    lifespan refresh over the summary. Purchase days count the delta's
+    days after each customer's previous last purchase, which is exact for
+    exports appended in date order.
+    """
+    partial = summarize_transactions(delta)
+    if partial.empty:
+        return summary
+
+    days = pd.DataFrame({'Customer ID': delta['Customer ID'], 'Date': pd.to_datetime(delta['Date'])}).drop_duplicates()
+    previous_last = summary.set_index('Customer ID')['LastPurchase'].reindex(days['Customer ID']).to_numpy()
+    new_days = days.loc[days['Date'].to_numpy() > previous_last, 'Customer ID'].value_counts()
+
+    summary = summary.copy()
+    rows = pd.Index(summary['Customer ID']).get_indexer(partial.index)
+    seen = rows >= 0
+    hit_rows = rows[seen]
+    hits = partial[seen]
+
+    columns = summary.columns
+    first = columns.get_loc('FirstPurchase')
+    last = columns.get_loc('LastPurchase')
+    count = columns.get_loc('NumPurchases')
+    purchase_days = columns.get_loc('PurchaseDays')
+    revenue = columns.get_loc('TotalRevenue')
+    summary.iloc[hit_rows, first] = np.minimum(summary['FirstPurchase'].to_numpy()[hit_rows], hits['FirstPurchase'].to_numpy())
+    summary.iloc[hit_rows, last] = np.maximum(summary['LastPurchase'].to_numpy()[hit_rows], hits['LastPurchase'].to_numpy())
+    summary.iloc[hit_rows, count] = summary['NumPurchases'].to_numpy()[hit_rows] + hits['NumPurchases'].to_numpy()
+    summary.iloc[hit_rows, purchase_days] = (summary['PurchaseDays'].to_numpy()[hit_rows]
+                                             + new_days.reindex(hits.index, fill_value=0).to_numpy())
+    summary.iloc[hit_rows, revenue] = summary['TotalRevenue'].to_numpy()[hit_rows] + hits['TotalRevenue'].to_numpy()
+    summary['CustomerLifespan'] = (summary['LastPurchase'] - summary['FirstPurchase']).dt.days
+
+    if (~seen).any():
+        summary = pd.concat([summary, finalize_summary(partial[~seen])], ignore_index=True)
+
+    return summary
+
+def source_cache_prefix(path):
+    """Cache file prefix for state kept per source file
+
+    The hash of the absolute path keeps same-named files in different
+    directories apart.
+    """
+    stem = os.path.splitext(os.path.basename(path))[0]
+    key = hashlib.blake2b(os.path.abspath(path).encode(), digest_size=8).hexdigest()
+    return os.path.join(CACHE_DIR, f'{stem}-{key}')
+
+def customer_state_manifest_path(path):
+    """Manifest location for the persisted customer summary of a source file"""
+    return f'{source_cache_prefix(path)}-state.json'
+
+def rollup_state_manifest_path(path):
+    """Manifest location for the persisted daily cube and basket lines of a source file"""
+    return f'{source_cache_prefix(path)}-rollups.json'
+
+def _prefix_hash(path, offset, sample_bytes=1024 ** 2):
+    """Hash of the head and of the bytes just before offset"""
+    digest = hashlib.blake2b(str(offset).encode(), digest_size=16)
+    with open(path, 'rb') as f:
+        digest.update(f.read(min(offset, sample_bytes)))
+        f.seek(max(0, offset - sample_bytes))
+        digest.update(f.read(offset - f.tell()))
+    return digest.hexdigest()
+
+def _load_state_manifest(manifest_path, version, path, end):
+    """Manifest of a persisted state that the source only appended to since
+
+    None if there is no usable state: no pyarrow, another version, missing
+    files, or a source rewritten (head or bytes before the offset changed).
+    """
+    if pq is None or not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    if manifest.get('version') != version:
+        return None
+    if not all(os.path.exists(os.path.join(CACHE_DIR, state_file)) for state_file in manifest['state_files'].values()):
+        return None
+    if manifest['offset'] > end or manifest['prefix_hash'] != _prefix_hash(path, manifest['offset']):
+        return None
+    return manifest
+
+def _read_state(manifest):
+    """The tables a state manifest points at"""
+    return {name: pd.read_parquet(os.path.join(CACHE_DIR, state_file))
+            for name, state_file in manifest['state_files'].items()}
+
+def _save_state(manifest_path, version, path, tables, offset, kept_files=None, **fields):
+    """Persist state tables read up to offset; the manifest rename is the commit point
+
+    kept_files maps unchanged tables to their current files, which the new
+    manifest points at again instead of rewriting them.
+    """
+    if pq is None:
+        return
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    prefix = os.path.splitext(os.path.basename(manifest_path))[0]
+    state_files = {name: f"{prefix}-{name.replace('/', '-')}-{offset}.parquet" for name in tables}
+    for name, state_file in state_files.items():
+        tables[name].to_parquet(os.path.join(CACHE_DIR, state_file), index=False)
+    state_files.update(kept_files or {})
+
+    previous = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            previous = json.load(f).get('state_files', {})
+    manifest = {
+        'version': version,
+        'state_files': state_files,
+        'offset': offset,
+        'prefix_hash': _prefix_hash(path, offset),
+        **fields,
+    }
+    tmp_path = f'{manifest_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, manifest_path)
+
+    for state_file in set(previous.values()) - set(state_files.values()):
+        try:
+            os.remove(os.path.join(CACHE_DIR, state_file))
+        except OSError:
+            pass
+
+def _empty_transactions():
+    """Cleaned transactions without rows, for a header-only source"""
+    return clean_transactions(compact_transactions(
+        pd.DataFrame({column: pd.Series(dtype=dtype) for column, dtype in TRANSACTION_DTYPES.items()})))
+
+def refresh_customer_state(path=DATA_PATH, chunksize=CHUNK_SIZE):
+    """Bring the persisted customer summary up to date with an append-only source
+
+    Rows appended since the last run are read from the stored byte offset
+    and folded in with apply_transaction_delta, so memory is bounded by the
+    number of customers plus one chunk. If the file was rewritten the
+    summary is rebuilt from scratch. Returns the summary and the advanced
+    snapshot date (None for a source without transactions, whose empty
+    summary is not persisted).
+    """
+    end = complete_length(path)
+    manifest_path = customer_state_manifest_path(path)
+    manifest = _load_state_manifest(manifest_path, CUSTOMER_STATE_VERSION, path, end)
+    summary = None if manifest is None else _read_state(manifest)['summary']
+    if manifest is not None and manifest['offset'] == end:
+        return summary, pd.Timestamp(manifest['snapshot_date'])
+
+    start = 0 if manifest is None else manifest['offset']
+    for chunk in read_transaction_range(path, start, end, chunksize):
+        if summary is None:
+            summary = finalize_summary(summarize_transactions(chunk))
+        else:
+            summary = apply_transaction_delta(summary, chunk)
+
+    if summary is None:
+        # Header-only or empty source: the same empty summary a full load builds
+        return build_customer_summary(_empty_transactions()), None
+
+    snapshot_date = summary['LastPurchase'].max() + pd.Timedelta(days=1)
+    if manifest is not None:
+        snapshot_date = max(snapshot_date, pd.Timestamp(manifest['snapshot_date']))
+    _save_state(manifest_path, CUSTOMER_STATE_VERSION, path, {'summary': summary}, end,
+                snapshot_date=snapshot_date.strftime('%Y-%m-%d'))
+    return summary, snapshot_date
+
+def _merge_rollup(name, partials):
+    """Combine partials of one rollup table: daily rows are summed, basket lines deduplicated"""
+    if name == 'daily_cube':
+        return merge_daily(*partials)
+    return concat_transactions(partials).drop_duplicates(ignore_index=True)
+
+def refresh_rollup_state(path=DATA_PATH, chunksize=CHUNK_SIZE):
+    """Bring the persisted daily cube and basket lines up to date with an append-only source
+
+    A separate pass from refresh_customer_state with its own byte offset,
+    so the summary never builds or holds these tables. Both tables are
+    stored as one Parquet file per month ('daily_cube/2024-01'). Appended
+    rows are read once, and only the months they fall in are merged with
+    their stored partition and rewritten; a rewritten file is rebuilt from
+    scratch. Returns the tables (ROLLUP_TABLES) assembled from all months.
+    """
+    end = complete_length(path)
+    manifest_path = rollup_state_manifest_path(path)
+    manifest = _load_state_manifest(manifest_path, ROLLUP_STATE_VERSION, path, end)
+    state_files = {} if manifest is None else manifest['state_files']
+    start = 0 if manifest is None else manifest['offset']
+
+    delta = {name: [] for name in ROLLUP_TABLES}
+    for chunk in read_transaction_range(path, start, end, chunksize):
+        delta['daily_cube'].append(summarize_daily(chunk))
+        delta['basket_lines'].append(basket_lines(chunk))
+
+    # A basket or day split at the previous offset or a chunk boundary
+    # shows up in two partials; merging the month combines them
+    changed = {}
+    for name, chunk_partials in delta.items():
+        if not chunk_partials:
+            continue
+        rows = concat_transactions(chunk_partials)
+        for month, month_rows in rows.groupby(rows['Date'].dt.to_period('M'), sort=False):
+            partition = f'{name}/{month}'
+            partials = [month_rows]
+            if partition in state_files:
+                partials.insert(0, pd.read_parquet(os.path.join(CACHE_DIR, state_files[partition])))
+            changed[partition] = _merge_rollup(name, partials)
+
+    kept = {partition: state_file for partition, state_file in state_files.items() if partition not in changed}
+    if delta['daily_cube']:
+        _save_state(manifest_path, ROLLUP_STATE_VERSION, path, changed, end, kept_files=kept)
+
+    partitions = {**changed, **{partition: pd.read_parquet(os.path.join(CACHE_DIR, state_file))
+                                for partition, state_file in kept.items()}}
+    empty = _empty_transactions()
+    tables = {}
+    for name in ROLLUP_TABLES:
+        months = [partitions[partition] for partition in sorted(partitions) if partition.split('/')[0] == name]
+        if not months:
+            # Header-only or empty source: the same empty tables a full load builds
+            months = [build_daily_cube(empty) if name == 'daily_cube' else basket_lines(empty)]
+        tables[name] = concat_transactions(months).reset_index(drop=True)
+    tables['daily_cube'] = finalize_daily(tables['daily_cube'])
+    return tables
+
+def rfm_values(summary, snapshot_date=None):
+    """Recency, Frequency and Monetary per customer"""
+    if snapshot_date is None:
+        snapshot_date = summary['LastPurchase'].max() + pd.Timedelta(days=1)
+
+    return pd.DataFrame({
+        'Customer ID': summary['Customer ID'],
+        'Recency': (snapshot_date - summary['LastPurchase']).dt.days,
+        'Frequency': summary['NumPurchases'],
+        'Monetary': summary['TotalRevenue']
+    })
+
+# Score labels per RFM column, lowest quantile bin first
+RFM_SCORE_LABELS = {
+    'Recency': [5, 4, 3, 2, 1],
+    'Frequency': [1, 2, 3, 4, 5],
+    'Monetary': [1, 2, 3],
+}
+RFM_SCORE_COLUMNS = {'Recency': 'R_Score', 'Frequency': 'F_Score', 'Monetary': 'M_Score'}
+
+def quantile_scores(values, labels):
+    """Equal-frequency bins of values, labelled lowest bin first
+
+    Bins are cut at value quantiles. When ties make edges coincide, as on
+    small filtered views, values are binned by rank instead, the way
+    Frequency always is.
+    """
+    try:
+        return pd.qcut(values, len(labels), labels=labels)
+    except ValueError:
+        bins = (values.rank(method='first').to_numpy() - 1) * len(labels) // len(values)
+        return pd.Series(pd.Categorical.from_codes(bins.astype(int), categories=labels, ordered=True),
+                         index=values.index, name=values.name)
+
+def sketch_rfm(rfm, k=DEFAULT_K, seed=0):
+    """Quantile sketches of one partition's Recency, Frequency and Monetary"""
+    return {column: KLLSketch(k, seed).update(rfm[column]) for column in RFM_SCORE_LABELS}
+
+def merge_rfm_sketches(*partials):
+    """Merge per-partition RFM sketches into sketches of all customers"""
+    merged = {column: KLLSketch(partials[0][column].k, seed=0) for column in RFM_SCORE_LABELS}
+    for partial in partials:
+        for column, sketch in partial.items():
+            merged[column].merge(sketch)
+    return merged
+
+def _tie_offsets(customer_ids):
+    """Deterministic pseudo-random position in [0, 1) of each customer within its ties"""
+    return (np.asarray(customer_ids, dtype=np.float64) * 0.6180339887498949) % 1.0
+
+def sketch_scores(rfm, sketches):
+    """R/F/M scores from merged sketches, matching the qcut bins of calculate_rfm
+
+    Recency and Monetary are binned at the sketched quantile boundaries.
+    Frequency has many ties, which the exact score splits by row order, so
+    each customer is placed at a rank between its value's lower and upper
+    rank using an offset derived from its Customer ID, then binned by rank.
+    """
+    scores = {}
+    for column in ['Recency', 'Monetary']:
+        labels = RFM_SCORE_LABELS[column]
+        boundaries = sketches[column].quantiles(np.arange(1, len(labels)) / len(labels))
+        bins = np.searchsorted(boundaries, rfm[column].to_numpy(dtype=float), side='left')
+        scores[RFM_SCORE_COLUMNS[column]] = pd.Categorical(np.asarray(labels)[bins], categories=labels, ordered=True)
+
+    labels = RFM_SCORE_LABELS['Frequency']
+    values = rfm['Frequency'].to_numpy(dtype=float)
+    lower = sketches['Frequency'].ranks(values, inclusive=False)
+    upper = sketches['Frequency'].ranks(values, inclusive=True)
+    rank = lower + _tie_offsets(rfm['Customer ID']) * (upper - lower)
+    bins = np.minimum((rank * len(labels)).astype(int), len(labels) - 1)
+    scores['F_Score'] = pd.Categorical(np.asarray(labels)[bins], categories=labels, ordered=True)
+
+    return scores
+
+def calculate_rfm(summary, rules=RFM_SEGMENT_RULES, snapshot_date=None, sketches=None):
+    """Calculate RFM metrics and segments from the customer summary
+
+    By default scores are exact quantile bins over all customers in
+    summary. With sketches (merged from every partition, see sketch_rfm),
+    a partition of the customers is scored against the global boundaries;
+    pass the global snapshot_date too so Recency is comparable.
+    """
+    rfm = rfm_values(summary, snapshot_date)
+
+    # Create RFM Scores
+    if sketches is None:
+        rfm['R_Score'] = quantile_scores(rfm['Recency'], RFM_SCORE_LABELS['Recency'])
+        rfm['F_Score'] = pd.qcut(rfm['Frequency'].rank(method='first'), 5, labels=RFM_SCORE_LABELS['Frequency'])
+        rfm['M_Score'] = quantile_scores(rfm['Monetary'], RFM_SCORE_LABELS['Monetary'])
+    else:
+        scores = sketch_scores(rfm, sketches)
+        rfm = rfm.assign(**{score: scores[score] for score in RFM_SCORE_COLUMNS.values()})
+
+    rfm['RFM_Score'] = rfm['R_Score'].astype(str) + rfm['F_Score'].astype(str) + rfm['M_Score'].astype(str)
+    rfm['RFM_Segment'] = rfm['R_Score'].astype(int) + rfm['F_Score'].astype(int) + rfm['M_Score'].astype(int)
+
+    # Segment customers
+    rfm['Customer_Segment'] = evaluate_segment_rules(rfm, rules, RFM_DEFAULT_SEGMENT)
+
+    return rfm
+
+def rfm_sketch_error(exact, approximate, sketches):
+    """How far sketch-based RFM scores are from the exact qcut scores
+
+    rank_error_bound is the sketches' guaranteed normalized rank error
+    (~99% confidence): every approximate boundary lies within that share of
+    customers of the exact one, so each score's share of customers can be
+    off by at most twice the bound. score_share_error is the largest
+    observed difference per score; score_mismatch and segment_mismatch are
+    the shares of customers whose score or segment changed (Frequency ties
+    are split arbitrarily by both methods, so its mismatch is not bounded).
+    """
+    approximate = approximate.set_index('Customer ID').loc[exact['Customer ID']]
+    report = {
+        'customers': len(exact),
+        'rank_error_bound': max(sketch.rank_error_bound() for sketch in sketches.values()),
+        'score_share_error': {},
+        'score_mismatch': {},
+    }
+    for score in RFM_SCORE_COLUMNS.values():
+        exact_scores = exact[score].astype(int).to_numpy()
+        approximate_scores = approximate[score].astype(int).to_numpy()
+        shares = pd.concat([pd.Series(exact_scores).value_counts(normalize=True),
+                            pd.Series(approximate_scores).value_counts(normalize=True)], axis=1).fillna(0)
+        report['score_share_error'][score] = float((shares.iloc[:, 0] - shares.iloc[:, 1]).abs().max())
+        report['score_mismatch'][score] = float((exact_scores != approximate_scores).mean())
+    report['segment_mismatch'] = float((exact['Customer_Segment'].to_numpy() != approximate['Customer_Segment'].to_numpy()).mean())
+    return report
+
+# Spacing of rolling RFM snapshots, as a pandas offset alias (month starts)
+SNAPSHOT_FREQ = os.environ.get('CUSTOMER_ANALYTICS_SNAPSHOT_FREQ', 'MS')
+# From segment of customers who first purchased since the previous snapshot
+NEW_CUSTOMER_SEGMENT = 'New'
+
+def snapshot_dates(first_date, last_date, freq=SNAPSHOT_FREQ):
+    """Snapshot dates at the cadence, ending on the day after the last purchase like calculate_rfm"""
+    end = pd.Timestamp(last_date) + pd.Timedelta(days=1)
+    return pd.date_range(pd.Timestamp(first_date) + pd.Timedelta(days=1), end, freq=freq).union([end])
+
+def rolling_customer_summaries(cube, dates):
+    """Customer summary as of each snapshot date, from one pass over the daily cube
+
+    Yields (date, summary), where summary covers purchases before date. The
+    cube is sorted by customer and day, so running totals per customer are
+    cumulative sums; each customer's last row before a snapshot is its state
+    there, and is repeated for the snapshots until its next purchase.
+    """
+    customers = cube['Customer ID'].to_numpy()
+    days = cube['Date'].to_numpy()
+
+    # One row per customer and day, across dimension values
+    starts = np.flatnonzero(np.r_[True, (customers[1:] != customers[:-1]) | (days[1:] != days[:-1])])
+    customers, days = customers[starts], days[starts]
+    purchases = pd.Series(np.add.reduceat(cube['Purchases'].to_numpy(dtype=np.int64), starts)).groupby(customers).cumsum()
+    revenue = pd.Series(np.add.reduceat(cube['Revenue'].to_numpy(), starts)).groupby(customers).cumsum()
+    new_customer = np.r_[True, customers[1:] != customers[:-1]]
+    first_rows = np.maximum.accumulate(np.where(new_customer, np.arange(len(customers)), 0))
+    first_days = days[first_rows]
+    purchase_days = np.arange(len(customers)) - first_rows + 1
+
+    # Each (customer, first snapshot after the day) run ends in the state
+    # that holds from that snapshot until the customer's next run
+    period = np.searchsorted(dates.to_numpy(), days, side='right')
+    rows = np.flatnonzero(np.r_[(customers[1:] != customers[:-1]) | (period[1:] != period[:-1]), True])
+    valid_from = period[rows]
+    continues = np.r_[customers[rows][1:] == customers[rows][:-1], False]
+    span = np.where(continues, np.r_[valid_from[1:], 0], len(dates)) - valid_from
+    state = np.repeat(rows, span)
+    snapshot = np.repeat(valid_from, span) + np.arange(span.sum()) - np.repeat(np.cumsum(span) - span, span)
+
+    # Group the states by snapshot, keeping customers in order
+    order = np.argsort(snapshot, kind='stable')
+    state = state[order]
+    bounds = np.searchsorted(snapshot[order], np.arange(len(dates) + 1))
+    for k, date in enumerate(dates):
+        rows_k = state[bounds[k]:bounds[k + 1]]
+        partial = pd.DataFrame({
+            'FirstPurchase': first_days[rows_k],
+            'LastPurchase': days[rows_k],
+            'NumPurchases': purchases.to_numpy()[rows_k],
+            'PurchaseDays': purchase_days[rows_k],
+            'TotalRevenue': revenue.to_numpy()[rows_k],
+        }, index=pd.Index(customers[rows_k], name='Customer ID'))
+        yield date, finalize_summary(partial)
+
+def rolling_rfm(cube, freq=SNAPSHOT_FREQ, rules=RFM_SEGMENT_RULES):
+    """RFM scores and segments at every snapshot, as calculate_rfm would give on the history up to it
+
+    Yields (date, rfm). Snapshots too early to form score quantiles (a
+    handful of customers) are skipped.
+    """
+    if cube.empty:
+        return
+    dates = snapshot_dates(cube['Date'].min(), cube['Date'].max(), freq)
+    for date, summary in rolling_customer_summaries(cube, dates):
+        try:
+            yield date, calculate_rfm(summary, rules, snapshot_date=date)
+        except ValueError:
+            continue
+
+def segment_transitions(cube, freq=SNAPSHOT_FREQ, rules=RFM_SEGMENT_RULES):
+    """Customers moving between RFM segments from each snapshot to the next
+
+    A long table with one row per snapshot and (From_Segment, To_Segment)
+    pair. Customers seen for the first time come from NEW_CUSTOMER_SEGMENT.
+    """
+    transitions = []
+    previous = pd.Series(dtype=object)
+    for date, rfm in rolling_rfm(cube, freq, rules):
+        current = pd.Series(rfm['Customer_Segment'].to_numpy(), index=rfm['Customer ID'].to_numpy())
+        moves = pd.DataFrame({
+            'From_Segment': previous.reindex(current.index).fillna(NEW_CUSTOMER_SEGMENT).to_numpy(),
+            'To_Segment': current.to_numpy(),
+        })
+        counts = moves.groupby(['From_Segment', 'To_Segment']).size().rename('Customers').reset_index()
+        transitions.append(counts.assign(Snapshot=date))
+        previous = current
+
+    columns = ['Snapshot', 'From_Segment', 'To_Segment', 'Customers']
+    if not transitions:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(transitions, ignore_index=True)[columns]
+
+def transition_matrix(transitions, snapshot):
+    """From x To segment customer counts for one snapshot of segment_transitions"""
+    moves = transitions[transitions['Snapshot'] == snapshot]
+    return moves.pivot_table(index='From_Segment', columns='To_Segment', values='Customers',
+                             aggfunc='sum', fill_value=0)
+
+# Cohort period lengths the cohort engine supports
+COHORT_PERIODS = ['month', 'week']
+
+def period_numbers(dates, period='month'):
+    """Integer period of each datetime64 date: months, or Monday-based weeks, since 1970"""
+    if period == 'month':
+        return dates.astype('datetime64[M]').astype(np.int64)
+    if period == 'week':
+        # 1970-01-01 was a Thursday; shifting by 3 days starts weeks on Monday
+        return (dates.astype('datetime64[D]').astype(np.int64) + 3) // 7
+    raise ValueError(f"Unknown cohort period {period!r}, expected one of {COHORT_PERIODS}")
+
+def period_starts(numbers, period='month'):
+    """First day of each integer period from period_numbers"""
+    if period == 'month':
+        return pd.DatetimeIndex(np.asarray(numbers).astype('datetime64[M]').astype('datetime64[D]'))
+    return pd.DatetimeIndex((np.asarray(numbers) * 7 - 3).astype('datetime64[D]'))
+
+def cohort_matrices(cube, period='month'):
+    """Acquisition cohort x periods-since-acquisition customer, retention and revenue matrices
+
+    Each customer's cohort is the period of their first purchase in the
+    (possibly filtered) cube. Returns DataFrames indexed by cohort start with
+    one column per period since acquisition: 'customers' active, 'retention'
+    as a share of the cohort and 'revenue', plus the cohort 'sizes'. Cells
+    after the last period of the data are NaN.
+    """
+    customers = cube['Customer ID'].to_numpy()
+    periods = period_numbers(cube['Date'].to_numpy(), period)
+    if len(customers) == 0:
+        empty = pd.DataFrame(index=pd.DatetimeIndex([], name='Cohort'))
+        return {'customers': empty, 'retention': empty, 'revenue': empty, 'sizes': pd.Series(dtype=np.int64)}
+
+    # The cube is sorted by customer and day: a customer's first row is their acquisition
+    new_customer = np.r_[True, customers[1:] != customers[:-1]]
+    first_rows = np.flatnonzero(new_customer)
+    cohort = np.repeat(periods[first_rows], np.diff(np.r_[first_rows, len(customers)]))
+    age = periods - cohort
+
+    first_cohort = cohort.min()
+    n_cohorts, n_ages = periods.max() - first_cohort + 1, age.max() + 1
+    cell = (cohort - first_cohort) * n_ages + age
+    # Count each customer once per period: the first of their rows with that age
+    active = new_customer | np.r_[True, age[1:] != age[:-1]]
+    counts = np.bincount(cell[active], minlength=n_cohorts * n_ages).reshape(n_cohorts, n_ages).astype(float)
+    revenue = np.bincount(cell, weights=cube['Revenue'].to_numpy(dtype=float),
+                          minlength=n_cohorts * n_ages).reshape(n_cohorts, n_ages)
+
+    # Periods not yet observed for a cohort are unknown, not zero
+    unobserved = np.add.outer(np.arange(n_cohorts), np.arange(n_ages)) >= n_cohorts
+    counts[unobserved] = revenue[unobserved] = np.nan
+    sizes = counts[:, 0]
+    acquired = sizes > 0
+
+    index = pd.Index(period_starts(first_cohort + np.flatnonzero(acquired), period), name='Cohort')
+    columns = pd.RangeIndex(n_ages, name='Periods Since Acquisition')
+    counts, revenue, sizes = counts[acquired], revenue[acquired], sizes[acquired]
+    return {
+        'customers': pd.DataFrame(counts, index=index, columns=columns),
+        'retention': pd.DataFrame(counts / sizes[:, None], index=index, columns=columns),
+        'revenue': pd.DataFrame(revenue, index=index, columns=columns),
+        'sizes': pd.Series(sizes.astype(np.int64), index=index, name='Customers'),
+    }
+
+def calculate_cltv(summary, snapshot_date=None, params=None):
+    """Calculate Customer Lifetime Value from the customer summary
+
+    CLTV is the historical value; PredictedCLTV is the BG/NBD + Gamma-Gamma
+    forecast over the next CLTV_HORIZON_DAYS (NaN when the models cannot be fitted).
+    The models are fitted on summary unless fitted params are given.
+    """
+    cltv_data = summary[['Customer ID', 'NumPurchases', 'TotalRevenue', 'CustomerLifespan']].copy()
+
+    cltv_data['AvgOrderValue'] = cltv_data['TotalRevenue'] / cltv_data['NumPurchases']
+    cltv_data['PurchaseFrequency'] = cltv_data['NumPurchases'] / (cltv_data['CustomerLifespan'] + 1) * 365
+    cltv_data['CustomerLifespanYears'] = (cltv_data['CustomerLifespan'] + 1) / 365
+    cltv_data['CLTV'] = cltv_data['AvgOrderValue'] * cltv_data['PurchaseFrequency'] * cltv_data['CustomerLifespanYears']
+
+    predictions, _ = predict_cltv(summary, snapshot_date, params=params)
+    cltv_data[predictions.columns] = predictions
+
+    return cltv_data
+
+# Customers above this CLTV quantile are left out of the value charts
+CLTV_TRIM_QUANTILE = 0.99
+# Points kept on the stored concentration (Pareto) curve
+CURVE_POINTS = 500
+# Top customer fractions whose share of CLTV is reported
+TOP_SHARE_FRACTIONS = [0.01, 0.05, 0.1, 0.2, 0.5]
+
+def concentration_curve(cltv_data, trim_quantile=CLTV_TRIM_QUANTILE, points=CURVE_POINTS,
+                        top_fractions=TOP_SHARE_FRACTIONS):
+    """Pareto curve, Gini coefficient and top-customer shares of CLTV
+
+    Customers above trim_quantile are dropped first, as on the dashboard
+    charts. Only points + 1 evenly spaced points of the curve are kept
+    (every customer on smaller data), so charts plot a fixed-size line.
+    """
+    cltv = cltv_data['CLTV'].to_numpy(dtype=float)
+    threshold = float(np.quantile(cltv, trim_quantile)) if len(cltv) else 0.0
+    # One sort serves the curve, the shares and the Gini coefficient
+    values = np.sort(cltv[cltv <= threshold])[::-1]
+    n, total = len(values), float(values.sum())
+    cumulative = np.concatenate([[0.0], np.cumsum(values)]) / (total or 1) * 100
+
+    curve_counts = np.unique(np.round(np.linspace(0, n, min(points, n) + 1)).astype(int))
+    customer_percent = curve_counts / max(n, 1) * 100
+    cumulative_percent = cumulative[curve_counts]
+    ranks = np.arange(n, 0, -1)
+    gini = 2 * np.dot(ranks, values) / (n * total) - (n + 1) / n if total else 0.0
+
+    return {
+        'customers': n,
+        'untrimmed_mean': float(cltv.mean()) if len(cltv) else 0.0,
+        'trim_threshold': threshold,
+        'total': total,
+        'mean': total / n if n else 0.0,
+        'median': float(np.median(values)) if n else 0.0,
+        'max': float(values[0]) if n else 0.0,
+        'gini': float(gini),
+        'top_shares': {f'{fraction:g}': float(cumulative[int(round(fraction * n))]) for fraction in top_fractions},
+        # Share of customers holding 80% of the value
+        'customers_for_80': float(np.interp(80, cumulative_percent, customer_percent)) if n else 0.0,
+        'curve': {
+            'customer_percent': customer_percent.tolist(),
+            'cumulative_percent': cumulative_percent.tolist(),
+        },
+    }
+
+def name_clusters(profiles, rules=CLUSTER_NAME_RULES):
+    """Name every cluster at once from its mean Recency/Frequency/Monetary profile"""
+    # Turn quantile thresholds into absolute values over the cluster profiles
+    absolute_rules = [
+        (name, column, op, profiles[column].quantile(q))
+        for name, column, op, q in rules
+    ]
+    return evaluate_segment_rules(profiles, absolute_rules, CLUSTER_DEFAULT_NAME)
+
+# Above this many customers clustering switches to mini-batch k-means
+MINIBATCH_THRESHOLD = 50_000
+MINIBATCH_SIZE = 4096
+# Customers sampled to compare the mini-batch fit against an exact fit
+QUALITY_SAMPLE_SIZE = 20_000
+
+def choose_clustering_engine(n_customers):
+    """Pick the exact or mini-batch engine from the input size"""
+    return 'minibatch' if n_customers > MINIBATCH_THRESHOLD else 'exact'
+
+def fit_kmeans(X_scaled, k, engine='exact', init=None):
+    """Fit k-means with the requested engine, optionally warm-started from centroids"""
+    seeding = {'init': init, 'n_init': 1} if init is not None else {}
+    if engine == 'minibatch':
+        # Each step sees one bounded batch; k-means++ seeds on init_size samples
+        kmeans = MiniBatchKMeans(n_clusters=k, random_state=42, n_init=3,
+                                 batch_size=MINIBATCH_SIZE, init_size=3 * MINIBATCH_SIZE)
+    else:
+        kmeans = KMeans(n_clusters=k, random_state=42, n_init=10)
+    return kmeans.set_params(**seeding).fit(X_scaled)
+
+def clustering_quality(kmeans, X_scaled, sample_size=QUALITY_SAMPLE_SIZE):
+    """Compare a fitted model with an exact KMeans fit on a random sample"""
+    rng = np.random.default_rng(42)
+    if len(X_scaled) > sample_size:
+        X_scaled = X_scaled[rng.choice(len(X_scaled), sample_size, replace=False)]
+
+    exact = fit_kmeans(X_scaled, kmeans.n_clusters, 'exact')
+    inertia = -kmeans.score(X_scaled)
+
+    return {
+        'sample_size': len(X_scaled),
+        'inertia': inertia,
+        'exact_inertia': exact.inertia_,
+        'inertia_gap': inertia / exact.inertia_ - 1,
+        'label_agreement': adjusted_rand_score(exact.labels_, kmeans.predict(X_scaled)),
+    }
+
+# Candidate cluster counts for the K sweep
+K_RANGE = range(2, 11)
+SILHOUETTE_SAMPLE_SIZE = 10_000
+# Stop sweeping after this many K values without a silhouette improvement
+SWEEP_PATIENCE = 3
+SWEEP_TOLERANCE = 0.005
+
+def score_k(X_scaled, k, engine, init=None):
+    """Fit one K and score it with inertia and a sampled silhouette"""
+    kmeans = fit_kmeans(X_scaled, k, engine, init)
+    silhouette = silhouette_score(X_scaled, kmeans.labels_,
+                                  sample_size=min(SILHOUETTE_SAMPLE_SIZE, len(X_scaled)),
+                                  random_state=42)
+    return kmeans, silhouette
+
+def sweep_k(X_scaled, K_range=K_RANGE, engine='exact', n_jobs=-1, patience=SWEEP_PATIENCE, warm_start=None):
+    """Fit candidate K values in parallel waves and pick the best silhouette
+
+    Each wave runs one K per worker process. The sweep stops early once
+    the best silhouette has not improved for `patience` consecutive K.
+    warm_start maps a K to initial centroids for that fit. Raises
+    ValueError when no candidate K is below the number of customers.
+    """
+    warm_start = warm_start or {}
+    K_values = [k for k in K_range if k < len(X_scaled)]
+    if not K_values:
+        raise ValueError(f'KMeans needs more than {min(K_range)} customers to compare cluster counts, '
+                         f'got {len(X_scaled)}')
+    wave_size = max(1, os.cpu_count() or 1) if n_jobs == -1 else n_jobs
+    models, silhouettes = {}, {}
+    best_k, stale = None, 0
+
+    with Parallel(n_jobs=n_jobs) as parallel:
+        for start in range(0, len(K_values), wave_size):
+            wave = K_values[start:start + wave_size]
+            results = parallel(delayed(score_k)(X_scaled, k, engine, warm_start.get(k)) for k in wave)
+            for k, (kmeans, silhouette) in zip(wave, results):
+                models[k], silhouettes[k] = kmeans, silhouette
+                if best_k is None or silhouette > silhouettes[best_k] + SWEEP_TOLERANCE:
+                    best_k, stale = k, 0
+                else:
+                    stale += 1
+            if stale >= patience:
+                break
+
+    return best_k, models, silhouettes
+
+def cluster_model_path(path):
+    """Location of the cluster model persisted for a source file"""
+    return f'{source_cache_prefix(path)}-kmeans_model.json'
+
+def load_cluster_model(path):
+    """Centroids, scaler parameters and names persisted by the previous run"""
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def save_cluster_model(model, path):
+    """Persist the fitted cluster model for the next run"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(model, f)
+    os.replace(tmp_path, path)
+
+def match_cluster_ids(centroids, previous_centroids, previous_ids):
+    """Map new cluster indices onto previous cluster IDs by nearest centroids
+
+    Uses an optimal one-to-one assignment; clusters without a predecessor
+    get the smallest unused IDs. Returns the ID per new cluster and the
+    distance each matched centroid moved (NaN for new clusters).
+    """
+    distances = np.linalg.norm(centroids[:, None, :] - previous_centroids[None, :, :], axis=2)
+    rows, cols = linear_sum_assignment(distances)
+
+    ids = np.full(len(centroids), -1)
+    ids[rows] = np.asarray(previous_ids)[cols]
+    moved = np.full(len(centroids), np.nan)
+    moved[rows] = distances[rows, cols]
+
+    free_ids = (i for i in range(len(centroids) + len(previous_ids)) if i not in set(ids))
+    for row in np.flatnonzero(ids < 0):
+        ids[row] = next(free_ids)
+
+    return ids, moved
+
+def clustering_features(rfm):
+    """Recency, Frequency and log-Monetary, the features customers are clustered on"""
+    X = rfm[['Recency', 'Frequency', 'Monetary']].copy()
+    X['Monetary'] = np.log1p(X['Monetary'])
+    return X
+
+def perform_kmeans_clustering(rfm, engine=None, model_path=None):
+    """Perform KMeans clustering on RFM data
+
+    With model_path (see cluster_model_path) the fit warm-starts from, and
+    keeps the cluster IDs and names of, the model saved there by the
+    previous run on the same source, then saves its own.
+    """
+    X = clustering_features(rfm)
+
+    scaler = StandardScaler()
+    X_scaled = scaler.fit_transform(X)
+
+    engine = engine or choose_clustering_engine(len(X_scaled))
+
+    # Warm-start the previous run's K from its centroids, mapped into this
+    # run's scaled space via the previous scaler parameters
+    previous = load_cluster_model(model_path) if model_path else None
+    warm_start = {}
+    if previous is not None:
+        previous_raw = np.asarray(previous['centroids']) * previous['scale'] + previous['mean']
+        previous_scaled = scaler.transform(pd.DataFrame(previous_raw, columns=X.columns))
+        warm_start[len(previous_raw)] = previous_scaled
+
+    # Sweep K in parallel and keep the best-scoring fit
+    optimal_k, models, silhouettes = sweep_k(X_scaled, K_RANGE, engine, warm_start=warm_start)
+    K_range = list(models)
+    inertias = [models[k].inertia_ for k in K_range]
+    kmeans = models[optimal_k]
+
+    # Keep cluster IDs (and so colors and names) stable across refreshes
+    centroids = kmeans.cluster_centers_
+    cluster_ids = np.arange(optimal_k)
+    moved = np.full(optimal_k, np.nan)
+    if previous is not None:
+        cluster_ids, moved = match_cluster_ids(centroids, previous_scaled, previous['ids'])
+
+    rfm_copy = rfm.copy()
+    rfm_copy['KMeans_Cluster'] = cluster_ids[kmeans.predict(X_scaled)]
+
+    # Name clusters; matched clusters keep the name they had last run
+    cluster_profiles = rfm_copy.groupby('KMeans_Cluster')[['Recency', 'Frequency', 'Monetary']].mean()
+
+    cluster_names = pd.Series(name_clusters(cluster_profiles), index=cluster_profiles.index)
+    if previous is not None:
+        previous_names = pd.Series(previous['names'], index=previous['ids'])
+        cluster_names = previous_names.reindex(cluster_names.index).fillna(cluster_names)
+    rfm_copy['Cluster_Name'] = rfm_copy['KMeans_Cluster'].map(cluster_names)
+
+    if model_path:
+        save_cluster_model({
+            'ids': cluster_ids.tolist(),
+            'names': cluster_names.loc[cluster_ids].tolist(),
+            'centroids': centroids.tolist(),
+            'mean': scaler.mean_.tolist(),
+            'scale': scaler.scale_.tolist(),
+        }, model_path)
+
+    # How far each cluster moved since the last run, in feature units
+    drift = pd.DataFrame({
+        'Cluster': cluster_ids,
+        'Cluster_Name': cluster_names.loc[cluster_ids].to_numpy(),
+        'Moved (scaled)': moved,
+    })
+    if previous is not None:
+        current_raw = pd.DataFrame(scaler.inverse_transform(centroids), index=cluster_ids, columns=X.columns)
+        shift = (current_raw - pd.DataFrame(previous_raw, index=previous['ids'], columns=X.columns)).reindex(cluster_ids)
+        drift['Recency shift (days)'] = shift['Recency'].to_numpy()
+        drift['Frequency shift'] = shift['Frequency'].to_numpy()
+        drift['Log Monetary shift'] = shift['Monetary'].to_numpy()
+
+    model_info = {
+        'engine': engine,
+        'n_customers': len(X_scaled),
+        'optimal_k': optimal_k,
+        'silhouettes': [silhouettes[k] for k in K_range],
+        'warm_started': optimal_k in warm_start,
+        'n_iter': int(kmeans.n_iter_),
+        'centroid_drift': drift.sort_values('Cluster').reset_index(drop=True),
+    }
+    if engine == 'minibatch':
+        model_info['quality'] = clustering_quality(kmeans, X_scaled)
+
+    return rfm_copy, inertias, K_range, model_info
+
+# Charts draw at most this many individual customers; larger tables are
+# sampled or binned before plotting
+POINT_BUDGET = int(os.environ.get('CUSTOMER_ANALYTICS_POINT_BUDGET', 20_000))
+# Smallest sample kept per group so small clusters stay visible
+MIN_POINTS_PER_GROUP = 200
+
+def stratified_quotas(sizes, budget=POINT_BUDGET, min_per_group=MIN_POINTS_PER_GROUP):
+    """Rows to keep per group, given the group sizes, for a stratified sample"""
+    if sizes.sum() <= budget:
+        return sizes
+    quotas = np.maximum(np.floor(sizes * budget / sizes.sum()), np.minimum(sizes, min_per_group))
+    return quotas.astype(int)
+
+def stratified_sample(df, by, budget=POINT_BUDGET, min_per_group=MIN_POINTS_PER_GROUP, random_state=42):
+    """At most about budget rows of df, sampled proportionally within each group of by
+
+    Every group keeps at least min_per_group rows (or all of them, if fewer).
+    Tables already within the budget are returned unchanged.
+    """
+    if len(df) <= budget:
+        return df
+
+    quotas = stratified_quotas(df[by].value_counts(), budget, min_per_group)
+
+    # A random rank within each group; the lowest quota ranks are kept
+    rng = np.random.default_rng(random_state)
+    ranks = pd.Series(rng.random(len(df)), index=df.index).groupby(df[by]).rank(method='first')
+    return df[ranks <= df[by].map(quotas)]
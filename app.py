@@ -10,210 +10,366 @@ import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
-from sklearn.cluster import KMeans
-from sklearn.preprocessing import StandardScaler
 from mpl_toolkits.mplot3d import Axes3D
+import os
 import warnings
 warnings.filterwarnings('ignore')
 
-# Page configuration
-st.set_page_config(
-    page_title="Customer Analytics Dashboard",
-    page_icon="📊",
-    layout="wide",
-    initial_sidebar_state="expanded"
-)
-
-# Custom CSS for better styling
-st.markdown("""
-    <style>
-    .main-header {
-        font-size: 2.5rem;
-        font-weight: bold;
-        color: #1f77b4;
-        text-align: center;
-        padding: 1rem 0;
-    }
-    .insight-box {
-        background-color: #f0f2f6;
-        padding: 1.5rem;
-        border-radius: 0.5rem;
-        border-left: 5px solid #1f77b4;
-        margin: 1rem 0;
-    }
-    .metric-card {
-        background-color: #ffffff;
-        padding: 1rem;
-        border-radius: 0.5rem;
-        box-shadow: 0 2px 4px rgba(0,0,0,0.1);
-    }
-    </style>
-""", unsafe_allow_html=True)
+from analytics import (DATA_PATH, COHORT_PERIODS, CUBE_DIMENSIONS, NEW_CUSTOMER_SEGMENT, POINT_BUDGET,
+                       RFM_RULES_PATH, cohort_matrices, filter_cube, quantile_scores, rules_fingerprint,
+                       source_fingerprint, stratified_quotas, stratified_sample, transition_matrix)
+from cltv_models import CLTV_HORIZON_DAYS, MIN_REPEAT_CUSTOMERS
+from figure_cache import FigureCache
+from instrumentation import collect, row_count, track
+from lookalikes import DEFAULT_NEIGHBOURS
+from pipeline import (ARTIFACTS_DIR, FILTERABLE_ARTIFACTS, close_context, filter_summary, filtered_artifact,
+                      pipeline_context, read_artifact, read_manifest, resolve_artifact)
+from shared_cache import SQLiteCache
 
 # Set plotting style
 plt.style.use('seaborn-v0_8-darkgrid')
 sns.set_palette("husl")
 
-# Cache data loading and processing
-@st.cache_data
-def load_and_process_data():
-    """Load and process the canteen sales data"""
-    # Load data
-    df = pd.read_csv('data/canteen_shop_data.csv')
-
-    # Clean data
-    df = df[df['Quantity'] > 0]
-    df = df[df['Price'] > 0]
-    df['TotalPrice'] = df['Quantity'] * df['Price']
-
-    return df
-
-@st.cache_data
-def calculate_rfm(df):
-    """Calculate RFM metrics and segments"""
-    snapshot_date = pd.to_datetime(df['Date']).max() + pd.Timedelta(days=1)
-
-    rfm = df.groupby('Customer ID').agg({
-        'Date': lambda x: (snapshot_date - pd.to_datetime(x.max())).days,
-        'Item': 'count',
-        'Total': 'sum'
-    }).reset_index()
-
-    rfm.columns = ['Customer ID', 'Recency', 'Frequency', 'Monetary']
-
-    # Create RFM Scores
-    rfm['R_Score'] = pd.qcut(rfm['Recency'], 5, labels=[5, 4, 3, 2, 1])
-    rfm['F_Score'] = pd.qcut(rfm['Frequency'].rank(method='first'), 5, labels=[1, 2, 3, 4, 5])
-    rfm['M_Score'] = pd.qcut(rfm['Monetary'], 3, labels=[1, 2, 3], duplicates='drop')
-
-    rfm['RFM_Score'] = rfm['R_Score'].astype(str) + rfm['F_Score'].astype(str) + rfm['M_Score'].astype(str)
-    rfm['RFM_Segment'] = rfm['R_Score'].astype(int) + rfm['F_Score'].astype(int) + rfm['M_Score'].astype(int)
-
-    # Segment customers
-    def segment_customer(row):
-        if row['RFM_Segment'] >= 10 and row['R_Score'] >= 4:
-            return 'Champions'
-        elif row['RFM_Segment'] >= 7 and row['R_Score'] >= 3:
-            return 'Loyal Customers'
-        elif row['F_Score'] >= 3 and row['R_Score'] >= 3:
-            return 'Potential Loyalists'
-        elif row['R_Score'] >= 4:
-            return 'Recent Customers'
-        elif row['RFM_Segment'] >= 6 and row['R_Score'] <= 2:
-            return 'At Risk'
-        elif row['F_Score'] >= 2 and row['R_Score'] <= 2:
-            return 'Cant Lose Them'
-        elif row['R_Score'] <= 2:
-            return 'Lost'
-        else:
-            return 'Others'
-
-    rfm['Customer_Segment'] = rfm.apply(segment_customer, axis=1)
-
-    return rfm
-
-@st.cache_data
-def calculate_cltv(df):
-    """Calculate Customer Lifetime Value"""
-    cltv_data = df.groupby('Customer ID').agg({
-        'Item': 'count',
-        'Total': 'sum',
-        'Date': lambda x: (pd.to_datetime(x.max()) - pd.to_datetime(x.min())).days
-    }).reset_index()
-
-    cltv_data.columns = ['Customer ID', 'NumPurchases', 'TotalRevenue', 'CustomerLifespan']
-
-    cltv_data['AvgOrderValue'] = cltv_data['TotalRevenue'] / cltv_data['NumPurchases']
-    cltv_data['PurchaseFrequency'] = cltv_data['NumPurchases'] / (cltv_data['CustomerLifespan'] + 1) * 365
-    cltv_data['CustomerLifespanYears'] = (cltv_data['CustomerLifespan'] + 1) / 365
-    cltv_data['CLTV'] = cltv_data['AvgOrderValue'] * cltv_data['PurchaseFrequency'] * cltv_data['CustomerLifespanYears']
-
-    return cltv_data
-
-@st.cache_data
-def perform_kmeans_clustering(rfm):
-    """Perform KMeans clustering on RFM data"""
-    X = rfm[['Recency', 'Frequency', 'Monetary']].copy()
-    X['Monetary'] = np.log1p(X['Monetary'])
-
-    scaler = StandardScaler()
-    X_scaled = scaler.fit_transform(X)
-
-    # Calculate inertias for elbow method
-    inertias = []
-    K_range = range(2, 11)
-    for k in K_range:
-        kmeans = KMeans(n_clusters=k, random_state=42, n_init=10)
-        kmeans.fit(X_scaled)
-        inertias.append(kmeans.inertia_)
-
-    # Apply optimal K
-    optimal_k = 4
-    kmeans = KMeans(n_clusters=optimal_k, random_state=42, n_init=10)
-    rfm_copy = rfm.copy()
-    rfm_copy['KMeans_Cluster'] = kmeans.fit_predict(X_scaled)
-
-    # Name clusters
-    cluster_profiles = rfm_copy.groupby('KMeans_Cluster')[['Recency', 'Frequency', 'Monetary']].mean()
-
-    def name_cluster(cluster_id, profiles):
-        profile = profiles.loc[cluster_id]
-        if profile['Frequency'] > profiles['Frequency'].quantile(0.75) and profile['Monetary'] > profiles['Monetary'].quantile(0.75):
-            return 'VIP Champions'
-        elif profile['Recency'] < profiles['Recency'].quantile(0.25) and profile['Monetary'] > profiles['Monetary'].median():
-            return 'Recent Big Spenders'
-        elif profile['Frequency'] <= profiles['Frequency'].quantile(0.25) and profile['Monetary'] <= profiles['Monetary'].quantile(0.25):
-            return 'Low Engagement'
-        else:
-            return 'Regular Customers'
-
-    rfm_copy['Cluster_Name'] = rfm_copy['KMeans_Cluster'].apply(lambda x: name_cluster(x, cluster_profiles))
+# One color per KMeans cluster ID, shared by every page
+CLUSTER_COLORS = ['#FF7043', '#00BFA5', '#FFC107', '#42A5F5', '#AB47BC',
+                  '#66BB6A', '#FFA726', '#EC407A', '#8D6E63', '#26C6DA']
+
+# Most bought items shown in the item preference heatmap, and item pairs listed
+PREFERENCE_ITEMS = 20
+PAIR_TABLE_ROWS = 25
+# Seed customers queried for a lookalike audience; larger groups are sampled
+LOOKALIKE_MAX_SEEDS = 1_000
+LOOKALIKE_TABLE_ROWS = 100
+
+def cluster_color(cluster_id):
+    """Color for a KMeans cluster ID"""
+    return CLUSTER_COLORS[cluster_id % len(CLUSTER_COLORS)]
+
+def configure_page():
+    """Page configuration and custom CSS"""
+    # Page configuration
+    st.set_page_config(
+        page_title="Customer Analytics Dashboard",
+        page_icon="📊",
+        layout="wide",
+        initial_sidebar_state="expanded"
+    )
 
-    return rfm_copy, inertias, K_range
+    # Custom CSS for better styling
+    st.markdown("""
+        <style>
+        .main-header {
+            font-size: 2.5rem;
+            font-weight: bold;
+            color: #1f77b4;
+            text-align: center;
+            padding: 1rem 0;
+        }
+        .insight-box {
+            background-color: #f0f2f6;
+            padding: 1.5rem;
+            border-radius: 0.5rem;
+            border-left: 5px solid #1f77b4;
+            margin: 1rem 0;
+        }
+        .metric-card {
+            background-color: #ffffff;
+            padding: 1rem;
+            border-radius: 0.5rem;
+            box-shadow: 0 2px 4px rgba(0,0,0,0.1);
+        }
+        </style>
+    """, unsafe_allow_html=True)
+
+# Artifacts each page needs; only these (and their dependencies) are
+# loaded or computed when the page is opened
+PAGE_ARTIFACTS = {
+    "📈 Executive Summary": ['clusters', 'concentration'],
+    "🎯 RFM Analysis": ['rfm', 'segment_transitions'],
+    "💰 CLTV Analysis": ['cltv', 'concentration'],
+    "📅 Cohort Analysis": ['daily_cube'],
+    "🔍 KMeans Clustering": ['clusters', 'clustering', 'centroid_drift'],
+    "📊 Comparative Analysis": ['clusters', 'item_pairs', 'item_preferences'],
+    "💡 Business Recommendations": ['clusters', 'concentration', 'lookalike_index'],
+}
+
+def current_run_key():
+    """Identifies the results to show: the published run, else the source data and segment rules
+
+    Every artifact and figure cache is keyed by it, so editing the rules CSV
+    recomputes segments instead of serving ones built with the old rules.
+    """
+    manifest = read_manifest(ARTIFACTS_DIR)
+    if manifest is not None:
+        return manifest['run']
+    return f"{source_fingerprint(DATA_PATH)}-{rules_fingerprint(RFM_RULES_PATH)}"
+
+@st.cache_resource
+def get_shared_cache():
+    """Artifact cache on disk, shared by every worker process on this host"""
+    return SQLiteCache()
+
+# Artifacts get_artifact actually read or computed during this script run,
+# i.e. its cache misses
+_artifact_cache_misses = set()
+
+@st.cache_data(show_spinner=False)
+def get_artifact(name, run_key):
+    """One artifact, read from the published run or computed on demand
+
+    Dependencies are looked up through this cached function too, so an
+    artifact computed for one page is reused by every later page.
+    """
+    _artifact_cache_misses.add(name)
+    manifest = read_manifest(ARTIFACTS_DIR)
+    if manifest is not None and manifest['run'] == run_key:
+        return read_artifact(name, manifest, ARTIFACTS_DIR)
+
+    def compute():
+        context = pipeline_context(DATA_PATH)
+        try:
+            return resolve_artifact(name, context, {}, resolve=lambda dependency: get_artifact(dependency, run_key))
+        finally:
+            close_context(context)
+
+    # Computed artifacts are shared with the other workers on this host
+    shared_cache = get_shared_cache()
+    with track(name, kind='shared_cache') as record:
+        value, cached = shared_cache.get_or_compute(shared_cache.make_key(run_key, name), compute)
+        record['rows'] = row_count(value)
+        record['cache'] = 'hit' if cached else 'miss'
+    return value
+
+@st.cache_resource(show_spinner=False, max_entries=2)
+def get_daily_cube(run_key):
+    """The daily rollup cube, held once per server rather than copied per session"""
+    manifest = read_manifest(ARTIFACTS_DIR)
+    if manifest is not None and manifest['run'] == run_key:
+        return read_artifact('daily_cube', manifest, ARTIFACTS_DIR)
+    return get_artifact('daily_cube', run_key)
+
+@st.cache_resource(show_spinner=False, max_entries=2)
+def get_lookalike_index(run_key):
+    """The lookalike index, held once per server rather than copied per session"""
+    manifest = read_manifest(ARTIFACTS_DIR)
+    if manifest is not None and manifest['run'] == run_key:
+        return read_artifact('lookalike_index', manifest, ARTIFACTS_DIR)
+    return get_artifact('lookalike_index', run_key)
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def get_filtered_summary(run_key, filters):
+    """Customer summary of the transactions matching the sidebar filters"""
+    start, end, selections = filters
+    return filter_summary(get_daily_cube(run_key), start, end, dict(selections))
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def get_cohorts(run_key, period, _cube):
+    """Cohort matrices of the (filtered) daily cube identified by run_key"""
+    return cohort_matrices(_cube, period)
+
+@st.cache_data(show_spinner=False, max_entries=128)
+def get_filtered_artifact(name, run_key, filters):
+    """A filterable artifact, re-derived from the filtered customer summary"""
+    _artifact_cache_misses.add(name)
+    context = pipeline_context(DATA_PATH)
+    try:
+        return filtered_artifact(name, get_filtered_summary(run_key, filters), context,
+                                 resolve=lambda dependency: get_artifact(dependency, run_key))
+    finally:
+        close_context(context)
+
+def load_artifact(name, run_key, filters=None):
+    """An artifact, filtered if filters are set, recorded with its row count and whether it was cached"""
+    with track(name, kind='load', filtered=filters is not None) as record:
+        if name == 'daily_cube':
+            # Shared by every session; a filtered view is a row mask over it
+            value = get_daily_cube(run_key)
+            if filters is not None:
+                start, end, selections = filters
+                value = filter_cube(value, start, end, dict(selections))
+        elif name == 'lookalike_index':
+            value = get_lookalike_index(run_key)
+        elif filters is not None and name in FILTERABLE_ARTIFACTS:
+            value = get_filtered_artifact(name, run_key, filters)
+        else:
+            value = get_artifact(name, run_key)
+        record['rows'] = row_count(value)
+        record['cache'] = 'miss' if name in _artifact_cache_misses else 'hit'
+    return value
+
+def sidebar_filters(overview, dimensions):
+    """Sidebar date range and dimension filters
+
+    Returns None when nothing is filtered, else a hashable
+    (start, end, selections) tuple; start and end are None when open.
+    """
+    st.sidebar.markdown("### Filters")
+    first_date = pd.Timestamp(overview['first_date']).date()
+    last_date = pd.Timestamp(overview['last_date']).date()
+    date_range = st.sidebar.date_input("Date range", value=(first_date, last_date),
+                                       min_value=first_date, max_value=last_date)
+    # While a range is being picked only its start is set
+    start, end = (tuple(date_range) + (last_date,))[:2]
+
+    selections = tuple(
+        (column, tuple(values)) for column in CUBE_DIMENSIONS
+        if (values := st.sidebar.multiselect(column, dimensions[column], placeholder="All"))
+    )
+    start = None if start <= first_date else start.isoformat()
+    end = None if end >= last_date else end.isoformat()
+    if start is None and end is None and not selections:
+        return None
+    return start, end, selections
+
+@st.cache_resource
+def get_figure_cache():
+    """Rendered charts shared by every session of this server"""
+    return FigureCache()
+
+def show_figure(chart_id, run_key, plot, **params):
+    """Display a chart, re-plotting only when its data or parameters changed
+
+    plot(**params) builds and returns the matplotlib figure; the rendered
+    image is cached per run_key, chart_id and params.
+    """
+    with track(chart_id, kind='figure') as record:
+        png, cached = get_figure_cache().get_or_render(run_key, chart_id, plot, **params)
+        record['cache'] = 'hit' if cached else 'miss'
+    st.image(png, width='stretch')
+
+def draw_histogram(ax, values, bins, budget, **style):
+    """Histogram that bins large arrays before handing them to matplotlib"""
+    if len(values) <= budget:
+        ax.hist(values, bins=bins, **style)
+        return
+    counts, edges = np.histogram(np.asarray(values, dtype=float), bins=bins)
+    ax.hist(edges[:-1], bins=edges, weights=counts, **style)
+
+def histogram_caption(n_customers, budget=POINT_BUDGET):
+    """Caption stating how the customers in a histogram were drawn"""
+    if n_customers > budget:
+        st.caption(f"Binned density of all {n_customers:,} customers "
+                   f"(above the {budget:,}-point budget).")
+    else:
+        st.caption(f"Showing all {n_customers:,} customers.")
+
+def scatter_caption(rfm, budget=POINT_BUDGET):
+    """Caption stating how many customers a cluster scatter plot shows"""
+    shown = stratified_quotas(rfm['KMeans_Cluster'].value_counts(), budget).sum()
+    if shown < len(rfm):
+        st.caption(f"Showing a stratified sample of {shown:,} of {len(rfm):,} customers "
+                   f"per cluster (point budget {budget:,}).")
+    else:
+        st.caption(f"Showing all {len(rfm):,} customers.")
+
+def show_diagnostics(records):
+    """Sidebar panel with the timing, memory and cache records of this run"""
+    with st.sidebar.expander("Diagnostics", expanded=True):
+        stats = pd.DataFrame(records, columns=['stage', 'kind', 'seconds', 'rows', 'cache',
+                                               'peak_mb', 'peak_growth_mb'])
+        page_seconds = stats.loc[stats['kind'] == 'page', 'seconds'].sum()
+        load_seconds = stats.loc[stats['kind'] == 'load', 'seconds'].sum()
+        st.caption(f"Data {load_seconds:.2f}s, page {page_seconds:.2f}s")
+        st.dataframe(stats, hide_index=True)
+
+        figure_cache = get_figure_cache()
+        st.caption(f"Figure cache: {len(figure_cache)} charts, {figure_cache.size / 1024 ** 2:.1f} MB, "
+                   f"{figure_cache.hits} hits / {figure_cache.misses} misses")
+
+        shared_cache = get_shared_cache()
+        shared_stats = shared_cache.stats()
+        st.caption(f"Shared artifact cache: {shared_stats['entries']} entries, "
+                   f"{shared_stats['bytes'] / 1024 ** 2:.1f} MB, "
+                   f"{shared_cache.hits} hits / {shared_cache.misses} misses in this worker")
 
 # Main app
 def main():
+    configure_page()
+    with collect() as records:
+        render_dashboard()
+
+    if st.session_state.get('show_diagnostics'):
+        show_diagnostics(records)
+
+def render_dashboard():
+    """Header, sidebar and the selected page"""
     # Header
     st.markdown('<h1 class="main-header">Customer Analytics Dashboard</h1>', unsafe_allow_html=True)
     st.markdown("### 📊 CLTV, RFM Analysis, and KMeans Clustering")
 
-    # Load data
-    with st.spinner('Loading and processing data...'):
-        df = load_and_process_data()
-        rfm = calculate_rfm(df)
-        cltv_data = calculate_cltv(df)
-        rfm_with_clusters, inertias, K_range = perform_kmeans_clustering(rfm)
-
     # Sidebar
     st.sidebar.title("Navigation")
-    page = st.sidebar.radio(
-        "Select Analysis",
-        ["📈 Executive Summary", "🎯 RFM Analysis", "💰 CLTV Analysis",
-         "🔍 KMeans Clustering", "📊 Comparative Analysis", "💡 Business Recommendations"]
-    )
+    page = st.sidebar.radio("Select Analysis", list(PAGE_ARTIFACTS))
+
+    # Load (or compute) only what the selected page needs
+    run_key = current_run_key()
+    with st.spinner('Loading analytics results...'):
+        overview = load_artifact('overview', run_key)
+        dimensions = load_artifact('dimensions', run_key)
 
     st.sidebar.markdown("---")
-    st.sidebar.markdown("### Dataset Overview")
-    st.sidebar.metric("Total Transactions", f"{len(df):,}")
-    st.sidebar.metric("Unique Customers", f"{df['Customer ID'].nunique():,}")
-    st.sidebar.metric("Date Range", f"{df['Date'].min()} to {df['Date'].max()}")
-    st.sidebar.metric("Total Revenue", f"£{df['Total'].sum():,.2f}")
+    filters = sidebar_filters(overview, dimensions)
+    if filters is not None and get_filtered_summary(run_key, filters).empty:
+        st.warning("No transactions match the selected filters.")
+        return
+
+    try:
+        with st.spinner('Loading analytics results...'):
+            overview = load_artifact('overview', run_key, filters)
+            data = {name: load_artifact(name, run_key, filters) for name in PAGE_ARTIFACTS[page]}
+    except ValueError as error:
+        # Score quantiles or KMeans cannot be formed from a handful of customers
+        st.warning(f"Too few customers to score or cluster them ({error}). Widen the filters or add data.")
+        return
+
+    if filters is not None:
+        st.info(f"Filtered view: {overview['customers']:,} customers and {overview['transactions']:,} "
+                f"transactions. KMeans clusters stay as fitted on the full history.")
+        # Charts of a filtered view are cached separately from the full view
+        run_key = (run_key, filters)
 
+    st.sidebar.markdown("---")
+    st.sidebar.markdown("### Dataset Overview")
+    st.sidebar.metric("Total Transactions", f"{overview['transactions']:,}")
+    st.sidebar.metric("Unique Customers", f"{overview['customers']:,}")
+    st.sidebar.metric("Date Range", f"{overview['first_date']} to {overview['last_date']}")
+    st.sidebar.metric("Total Revenue", f"£{overview['revenue']:,.2f}")
+
+    manifest = read_manifest(ARTIFACTS_DIR)
+    if manifest is None:
+        st.sidebar.caption("No precomputed results found; computing on demand. "
+                           "Run `python pipeline.py` to precompute them.")
+    else:
+        st.sidebar.caption(f"Results computed {manifest['created_at']} (run {manifest['run']})")
+        if os.path.exists(DATA_PATH) and source_fingerprint(DATA_PATH) != manifest['fingerprint']:
+            st.sidebar.warning("The data has changed since these results were computed. "
+                               "Run `python pipeline.py` to refresh them.")
+    st.sidebar.checkbox("Show diagnostics", key='show_diagnostics')
+
+    with track(page, kind='page'):
+        show_page(page, data, run_key)
+
+def show_page(page, data, run_key):
+    """Render the selected analysis page"""
     # Page routing
     if page == "📈 Executive Summary":
-        show_executive_summary(df, rfm_with_clusters, cltv_data)
+        show_executive_summary(data['clusters'], data['concentration'], run_key)
     elif page == "🎯 RFM Analysis":
-        show_rfm_analysis(rfm)
+        show_rfm_analysis(data['rfm'], data['segment_transitions'], run_key)
     elif page == "💰 CLTV Analysis":
-        show_cltv_analysis(cltv_data)
+        show_cltv_analysis(data['cltv'], data['concentration'], run_key)
+    elif page == "📅 Cohort Analysis":
+        show_cohort_analysis(data['daily_cube'], run_key)
     elif page == "🔍 KMeans Clustering":
-        show_kmeans_analysis(rfm_with_clusters, inertias, K_range)
+        clustering = data['clustering']
+        model_info = {**clustering, 'centroid_drift': data['centroid_drift']}
+        show_kmeans_analysis(data['clusters'], clustering['inertias'], clustering['K_range'], model_info, run_key)
     elif page == "📊 Comparative Analysis":
-        show_comparative_analysis(rfm_with_clusters)
+        show_comparative_analysis(data['clusters'], data['item_pairs'], data['item_preferences'], run_key)
     elif page == "💡 Business Recommendations":
-        show_business_recommendations(rfm_with_clusters, cltv_data)
+        show_business_recommendations(data['clusters'], data['concentration'], data['lookalike_index'])
 
-def show_executive_summary(df, rfm, cltv_data):
+def show_executive_summary(rfm, concentration, run_key):
     """Executive Summary with 3 Core Insights"""
     st.header("Executive Summary: Three Core Actionable Insights")
 
@@ -222,7 +378,7 @@ def show_executive_summary(df, rfm, cltv_data):
     with col1:
         st.metric("Total Customers", f"{len(rfm):,}")
     with col2:
-        st.metric("Avg CLTV", f"£{cltv_data['CLTV'].mean():.2f}")
+        st.metric("Avg CLTV", f"£{concentration['untrimmed_mean']:.2f}")
     with col3:
         champions = len(rfm[rfm['Customer_Segment'] == 'Champions'])
         st.metric("Champions", f"{champions}")
@@ -309,40 +465,35 @@ def show_executive_summary(df, rfm, cltv_data):
     # Insight 3: CLTV and Pareto Principle
     st.markdown("## 💎 Insight 3: Customer Lifetime Value and Pareto Principle")
 
-    cltv_clean = cltv_data[cltv_data['CLTV'] <= cltv_data['CLTV'].quantile(0.99)]
-
     col1, col2, col3 = st.columns(3)
     with col1:
-        st.metric("Total CLTV", f"£{cltv_clean['CLTV'].sum():,.2f}")
+        st.metric("Total CLTV", f"£{concentration['total']:,.2f}")
     with col2:
-        st.metric("Avg CLTV per Customer", f"£{cltv_clean['CLTV'].mean():.2f}")
+        st.metric("Avg CLTV per Customer", f"£{concentration['mean']:.2f}")
     with col3:
-        st.metric("Median CLTV", f"£{cltv_clean['CLTV'].median():.2f}")
-
-    # Pareto Chart
-    sorted_cltv = cltv_clean.sort_values('CLTV', ascending=False).copy()
-    sorted_cltv['CumulativePercent'] = (sorted_cltv['CLTV'].cumsum() / sorted_cltv['CLTV'].sum()) * 100
-    sorted_cltv['CustomerPercent'] = (np.arange(1, len(sorted_cltv) + 1) / len(sorted_cltv)) * 100
-
-    # Find 20/80 point
-    idx_20 = int(len(sorted_cltv) * 0.2)
-    cltv_at_20 = sorted_cltv.iloc[idx_20]['CumulativePercent']
-
-    fig, ax = plt.subplots(figsize=(10, 6))
-    ax.plot(sorted_cltv['CustomerPercent'], sorted_cltv['CumulativePercent'],
-            color='#00BFA5', linewidth=3, label='Cumulative CLTV')
-    ax.plot([0, 100], [0, 100], 'k--', alpha=0.3, label='Perfect Equality')
-    ax.axvline(20, color='red', linestyle=':', alpha=0.7, linewidth=2)
-    ax.axhline(cltv_at_20, color='red', linestyle=':', alpha=0.7, linewidth=2)
-    ax.fill_between([0, 20], [0, 0], [cltv_at_20, cltv_at_20], alpha=0.2, color='red')
-    ax.set_xlabel('Cumulative % of Customers', fontweight='bold', fontsize=12)
-    ax.set_ylabel('Cumulative % of Total CLTV', fontweight='bold', fontsize=12)
-    ax.set_title('Pareto Principle: CLTV Concentration', fontweight='bold', fontsize=14)
-    ax.grid(True, alpha=0.3)
-    ax.legend()
-    ax.text(20, cltv_at_20 + 5, f'{cltv_at_20:.1f}%', fontsize=12, fontweight='bold', color='red')
-    st.pyplot(fig)
-    plt.close()
+        st.metric("Median CLTV", f"£{concentration['median']:.2f}")
+
+    # Pareto Chart, from the precomputed curve and 20/80 point
+    curve = concentration['curve']
+    cltv_at_20 = concentration['top_shares']['0.2']
+
+    def plot():
+        fig, ax = plt.subplots(figsize=(10, 6))
+        ax.plot(curve['customer_percent'], curve['cumulative_percent'],
+                color='#00BFA5', linewidth=3, label='Cumulative CLTV')
+        ax.plot([0, 100], [0, 100], 'k--', alpha=0.3, label='Perfect Equality')
+        ax.axvline(20, color='red', linestyle=':', alpha=0.7, linewidth=2)
+        ax.axhline(cltv_at_20, color='red', linestyle=':', alpha=0.7, linewidth=2)
+        ax.fill_between([0, 20], [0, 0], [cltv_at_20, cltv_at_20], alpha=0.2, color='red')
+        ax.set_xlabel('Cumulative % of Customers', fontweight='bold', fontsize=12)
+        ax.set_ylabel('Cumulative % of Total CLTV', fontweight='bold', fontsize=12)
+        ax.set_title('Pareto Principle: CLTV Concentration', fontweight='bold', fontsize=14)
+        ax.grid(True, alpha=0.3)
+        ax.legend()
+        ax.text(20, cltv_at_20 + 5, f'{cltv_at_20:.1f}%', fontsize=12, fontweight='bold', color='red')
+        return fig
+
+    show_figure('executive_pareto', run_key, plot)
 
     st.markdown('<div class="insight-box">', unsafe_allow_html=True)
     st.markdown(f"""
@@ -354,7 +505,7 @@ def show_executive_summary(df, rfm, cltv_data):
     """)
     st.markdown('</div>', unsafe_allow_html=True)
 
-def show_rfm_analysis(rfm):
+def show_rfm_analysis(rfm, transitions, run_key):
     """RFM Analysis Page"""
     st.header("🎯 RFM Analysis")
     st.markdown("Recency, Frequency, Monetary (RFM) segmentation analysis")
@@ -362,29 +513,32 @@ def show_rfm_analysis(rfm):
     # RFM Distribution
     st.subheader("RFM Metrics Distribution")
 
-    fig, axes = plt.subplots(1, 3, figsize=(15, 4))
+    def plot(budget):
+        fig, axes = plt.subplots(1, 3, figsize=(15, 4))
+
+        draw_histogram(axes[0], rfm['Recency'], 30, budget, color='#FF7043', edgecolor='black', alpha=0.7)
+        axes[0].axvline(rfm['Recency'].median(), color='red', linestyle='--', linewidth=2)
+        axes[0].set_title('Recency Distribution', fontweight='bold')
+        axes[0].set_xlabel('Days Since Last Purchase')
+        axes[0].set_ylabel('Number of Customers')
 
-    axes[0].hist(rfm['Recency'], bins=30, color='#FF7043', edgecolor='black', alpha=0.7)
-    axes[0].axvline(rfm['Recency'].median(), color='red', linestyle='--', linewidth=2)
-    axes[0].set_title('Recency Distribution', fontweight='bold')
-    axes[0].set_xlabel('Days Since Last Purchase')
-    axes[0].set_ylabel('Number of Customers')
+        draw_histogram(axes[1], rfm['Frequency'], 30, budget, color='#00BFA5', edgecolor='black', alpha=0.7)
+        axes[1].axvline(rfm['Frequency'].median(), color='red', linestyle='--', linewidth=2)
+        axes[1].set_title('Frequency Distribution', fontweight='bold')
+        axes[1].set_xlabel('Number of Purchases')
+        axes[1].set_ylabel('Number of Customers')
 
-    axes[1].hist(rfm['Frequency'], bins=30, color='#00BFA5', edgecolor='black', alpha=0.7)
-    axes[1].axvline(rfm['Frequency'].median(), color='red', linestyle='--', linewidth=2)
-    axes[1].set_title('Frequency Distribution', fontweight='bold')
-    axes[1].set_xlabel('Number of Purchases')
-    axes[1].set_ylabel('Number of Customers')
+        draw_histogram(axes[2], np.log10(rfm['Monetary']), 30, budget, color='#FFC107', edgecolor='black', alpha=0.7)
+        axes[2].axvline(np.log10(rfm['Monetary'].median()), color='red', linestyle='--', linewidth=2)
+        axes[2].set_title('Monetary Distribution (Log)', fontweight='bold')
+        axes[2].set_xlabel('Log10(Total Spend)')
+        axes[2].set_ylabel('Number of Customers')
 
-    axes[2].hist(np.log10(rfm['Monetary']), bins=30, color='#FFC107', edgecolor='black', alpha=0.7)
-    axes[2].axvline(np.log10(rfm['Monetary'].median()), color='red', linestyle='--', linewidth=2)
-    axes[2].set_title('Monetary Distribution (Log)', fontweight='bold')
-    axes[2].set_xlabel('Log10(Total Spend)')
-    axes[2].set_ylabel('Number of Customers')
+        plt.tight_layout()
+        return fig
 
-    plt.tight_layout()
-    st.pyplot(fig)
-    plt.close()
+    show_figure('rfm_distributions', run_key, plot, budget=POINT_BUDGET)
+    histogram_caption(len(rfm))
 
     # Customer Segments Distribution (Essential Visualization 1)
     st.subheader("📊 Customer Segments Distribution")
@@ -392,18 +546,20 @@ def show_rfm_analysis(rfm):
     segment_counts = rfm['Customer_Segment'].value_counts()
     segment_pct = (segment_counts / len(rfm) * 100).round(1)
 
-    fig, ax = plt.subplots(figsize=(10, 6))
-    colors_palette = ['#FF7043', '#00BFA5', '#FFC107', '#42A5F5', '#AB47BC', '#66BB6A', '#FFA726', '#EC407A']
-    bars = ax.barh(segment_counts.index, segment_counts.values, color=colors_palette[:len(segment_counts)])
-    ax.set_xlabel('Number of Customers', fontweight='bold', fontsize=12)
-    ax.set_ylabel('Segment', fontweight='bold', fontsize=12)
-    ax.set_title('Customer Segments Distribution', fontweight='bold', fontsize=14)
+    def plot():
+        fig, ax = plt.subplots(figsize=(10, 6))
+        colors_palette = ['#FF7043', '#00BFA5', '#FFC107', '#42A5F5', '#AB47BC', '#66BB6A', '#FFA726', '#EC407A']
+        bars = ax.barh(segment_counts.index, segment_counts.values, color=colors_palette[:len(segment_counts)])
+        ax.set_xlabel('Number of Customers', fontweight='bold', fontsize=12)
+        ax.set_ylabel('Segment', fontweight='bold', fontsize=12)
+        ax.set_title('Customer Segments Distribution', fontweight='bold', fontsize=14)
 
-    for i, (count, pct) in enumerate(zip(segment_counts.values, segment_pct.values)):
-        ax.text(count, i, f' {count} ({pct}%)', va='center', fontweight='bold')
+        for i, (count, pct) in enumerate(zip(segment_counts.values, segment_pct.values)):
+            ax.text(count, i, f' {count} ({pct}%)', va='center', fontweight='bold')
 
-    st.pyplot(fig)
-    plt.close()
+        return fig
+
+    show_figure('rfm_segment_counts', run_key, plot)
 
     # Segment Metric Heatmap (Essential Visualization 2)
     st.subheader("🔥 Segment Metric Heatmap")
@@ -411,14 +567,16 @@ def show_rfm_analysis(rfm):
     segment_metrics = rfm.groupby('Customer_Segment')[['Recency', 'Frequency', 'Monetary']].mean()
     segment_metrics_normalized = (segment_metrics - segment_metrics.min()) / (segment_metrics.max() - segment_metrics.min())
 
-    fig, ax = plt.subplots(figsize=(12, 6))
-    sns.heatmap(segment_metrics_normalized.T, annot=True, fmt='.2f', cmap='RdYlGn_r',
-                linewidths=2, cbar_kws={'label': 'Normalized Score'}, ax=ax, annot_kws={'fontsize': 11, 'fontweight': 'bold'})
-    ax.set_title('RFM Metrics by Customer Segment (Normalized)', fontweight='bold', fontsize=14)
-    ax.set_xlabel('Customer Segment', fontweight='bold', fontsize=12)
-    ax.set_ylabel('RFM Metric', fontweight='bold', fontsize=12)
-    st.pyplot(fig)
-    plt.close()
+    def plot():
+        fig, ax = plt.subplots(figsize=(12, 6))
+        sns.heatmap(segment_metrics_normalized.T, annot=True, fmt='.2f', cmap='RdYlGn_r',
+                    linewidths=2, cbar_kws={'label': 'Normalized Score'}, ax=ax, annot_kws={'fontsize': 11, 'fontweight': 'bold'})
+        ax.set_title('RFM Metrics by Customer Segment (Normalized)', fontweight='bold', fontsize=14)
+        ax.set_xlabel('Customer Segment', fontweight='bold', fontsize=12)
+        ax.set_ylabel('RFM Metric', fontweight='bold', fontsize=12)
+        return fig
+
+    show_figure('rfm_segment_heatmap', run_key, plot)
 
     # Segment Summary Table
     st.subheader("Segment Summary Statistics")
@@ -431,99 +589,273 @@ def show_rfm_analysis(rfm):
     segment_summary.columns = ['Avg Recency', 'Avg Frequency', 'Avg Monetary', 'Total Revenue', 'Count']
     st.dataframe(segment_summary.style.background_gradient(cmap='YlOrRd', subset=['Total Revenue']))
 
-def show_cltv_analysis(cltv_data):
+    # Segment Migration between rolling snapshots
+    st.subheader("🔀 Segment Migration")
+
+    # The first snapshot only has new customers
+    snapshots = sorted(transitions['Snapshot'].unique())[1:]
+    if not snapshots:
+        st.info("Segment migration needs at least two RFM snapshots; the data covers too short a period.")
+        return
+
+    labels = [pd.Timestamp(snapshot).strftime('%Y-%m-%d') for snapshot in snapshots]
+    label = labels[0] if len(labels) == 1 else st.select_slider("Snapshot", options=labels, value=labels[-1])
+    snapshot = snapshots[labels.index(label)]
+    matrix = transition_matrix(transitions, snapshot)
+
+    def plot(snapshot):
+        fig, ax = plt.subplots(figsize=(12, 7))
+        sns.heatmap(matrix, annot=True, fmt='d', cmap='Blues', linewidths=1,
+                    cbar_kws={'label': 'Customers'}, ax=ax)
+        ax.set_title(f'Segment Migration into the {snapshot} Snapshot', fontweight='bold', fontsize=14)
+        ax.set_xlabel('Segment at Snapshot', fontweight='bold', fontsize=12)
+        ax.set_ylabel('Segment at Previous Snapshot', fontweight='bold', fontsize=12)
+        return fig
+
+    show_figure('rfm_segment_migration', run_key, plot, snapshot=label)
+    st.caption(f"RFM recomputed at {len(snapshots) + 1} snapshots over the full history "
+               f"(the sidebar filters do not apply). {NEW_CUSTOMER_SEGMENT} counts customers "
+               "whose first purchase came after the previous snapshot.")
+
+def show_cltv_analysis(cltv_data, concentration, run_key):
     """CLTV Analysis Page"""
     st.header("💰 Customer Lifetime Value (CLTV) Analysis")
 
-    cltv_clean = cltv_data[cltv_data['CLTV'] <= cltv_data['CLTV'].quantile(0.99)]
+    cltv_clean = cltv_data[cltv_data['CLTV'] <= concentration['trim_threshold']]
 
     # Key Metrics
     col1, col2, col3, col4 = st.columns(4)
     with col1:
-        st.metric("Total CLTV", f"£{cltv_clean['CLTV'].sum():,.2f}")
+        st.metric("Total CLTV", f"£{concentration['total']:,.2f}")
     with col2:
-        st.metric("Mean CLTV", f"£{cltv_clean['CLTV'].mean():.2f}")
+        st.metric("Mean CLTV", f"£{concentration['mean']:.2f}")
     with col3:
-        st.metric("Median CLTV", f"£{cltv_clean['CLTV'].median():.2f}")
+        st.metric("Median CLTV", f"£{concentration['median']:.2f}")
     with col4:
-        st.metric("Max CLTV", f"£{cltv_clean['CLTV'].max():.2f}")
+        st.metric("Max CLTV", f"£{concentration['max']:.2f}")
 
     # CLTV Distribution (Essential Visualization 5)
     st.subheader("📊 CLTV Distribution")
 
-    fig, ax = plt.subplots(figsize=(10, 6))
-    ax.hist(cltv_clean['CLTV'], bins=50, color='#00BFA5', edgecolor='black', alpha=0.7)
-    ax.axvline(cltv_clean['CLTV'].mean(), color='red', linestyle='--', linewidth=2,
-               label=f'Mean: £{cltv_clean["CLTV"].mean():.2f}')
-    ax.axvline(cltv_clean['CLTV'].median(), color='blue', linestyle='--', linewidth=2,
-               label=f'Median: £{cltv_clean["CLTV"].median():.2f}')
-    ax.set_xlabel('Customer Lifetime Value (£)', fontweight='bold', fontsize=12)
-    ax.set_ylabel('Number of Customers', fontweight='bold', fontsize=12)
-    ax.set_title('CLTV Distribution', fontweight='bold', fontsize=14)
-    ax.legend()
-    ax.grid(True, alpha=0.3)
-    st.pyplot(fig)
-    plt.close()
+    def plot(budget):
+        fig, ax = plt.subplots(figsize=(10, 6))
+        draw_histogram(ax, cltv_clean['CLTV'], 50, budget, color='#00BFA5', edgecolor='black', alpha=0.7)
+        ax.axvline(concentration['mean'], color='red', linestyle='--', linewidth=2,
+                   label=f"Mean: £{concentration['mean']:.2f}")
+        ax.axvline(concentration['median'], color='blue', linestyle='--', linewidth=2,
+                   label=f"Median: £{concentration['median']:.2f}")
+        ax.set_xlabel('Customer Lifetime Value (£)', fontweight='bold', fontsize=12)
+        ax.set_ylabel('Number of Customers', fontweight='bold', fontsize=12)
+        ax.set_title('CLTV Distribution', fontweight='bold', fontsize=14)
+        ax.legend()
+        ax.grid(True, alpha=0.3)
+        return fig
+
+    show_figure('cltv_histogram', run_key, plot, budget=POINT_BUDGET)
+    histogram_caption(len(cltv_clean))
 
     # Cumulative CLTV Distribution (Essential Visualization 4)
     st.subheader("📈 Cumulative CLTV Distribution (Pareto Analysis)")
 
-    sorted_cltv = cltv_clean.sort_values('CLTV', ascending=False).copy()
-    sorted_cltv['CumulativePercent'] = (sorted_cltv['CLTV'].cumsum() / sorted_cltv['CLTV'].sum()) * 100
-    sorted_cltv['CustomerPercent'] = (np.arange(1, len(sorted_cltv) + 1) / len(sorted_cltv)) * 100
-
-    fig, ax = plt.subplots(figsize=(10, 6))
-    ax.plot(sorted_cltv['CustomerPercent'], sorted_cltv['CumulativePercent'],
-            color='#00BFA5', linewidth=3, label='Cumulative CLTV')
-    ax.plot([0, 100], [0, 100], 'k--', alpha=0.3, label='Perfect Equality')
-    ax.axvline(20, color='red', linestyle=':', alpha=0.5, linewidth=2, label='20% Mark')
-    ax.axhline(80, color='red', linestyle=':', alpha=0.5, linewidth=2, label='80% Mark')
-    ax.fill_between([0, 100], [0, 100], sorted_cltv['CustomerPercent'].values[::-1], alpha=0.1, color='orange')
-    ax.set_xlabel('Cumulative % of Customers', fontweight='bold', fontsize=12)
-    ax.set_ylabel('Cumulative % of Total CLTV', fontweight='bold', fontsize=12)
-    ax.set_title('Cumulative CLTV Distribution (Pareto)', fontweight='bold', fontsize=14)
-    ax.grid(True, alpha=0.3)
-    ax.legend()
-    st.pyplot(fig)
-    plt.close()
+    curve = concentration['curve']
+
+    def plot():
+        fig, ax = plt.subplots(figsize=(10, 6))
+        ax.plot(curve['customer_percent'], curve['cumulative_percent'],
+                color='#00BFA5', linewidth=3, label='Cumulative CLTV')
+        ax.plot([0, 100], [0, 100], 'k--', alpha=0.3, label='Perfect Equality')
+        ax.axvline(20, color='red', linestyle=':', alpha=0.5, linewidth=2, label='20% Mark')
+        ax.axhline(80, color='red', linestyle=':', alpha=0.5, linewidth=2, label='80% Mark')
+        # Area between the curve and equality, whose share of the half-square is the Gini coefficient
+        ax.fill_between(curve['customer_percent'], curve['customer_percent'], curve['cumulative_percent'],
+                        alpha=0.1, color='orange')
+        ax.set_xlabel('Cumulative % of Customers', fontweight='bold', fontsize=12)
+        ax.set_ylabel('Cumulative % of Total CLTV', fontweight='bold', fontsize=12)
+        ax.set_title('Cumulative CLTV Distribution (Pareto)', fontweight='bold', fontsize=14)
+        ax.grid(True, alpha=0.3)
+        ax.legend()
+        return fig
+
+    show_figure('cltv_pareto', run_key, plot)
+
+    top_shares = concentration['top_shares']
+    st.caption(f"Top 1% of customers hold {top_shares['0.01']:.1f}% of CLTV, top 5% {top_shares['0.05']:.1f}%, "
+               f"top 10% {top_shares['0.1']:.1f}% and top 20% {top_shares['0.2']:.1f}%. "
+               f"{concentration['customers_for_80']:.1f}% of customers hold 80%. "
+               f"Gini coefficient: {concentration['gini']:.2f}.")
 
     # Customer Value Segments
     st.subheader("🎯 Customer Value Segments")
 
-    cltv_quartiles = pd.qcut(cltv_clean['CLTV'], q=4, labels=['Low Value', 'Medium Value', 'High Value', 'Top Value'])
+    cltv_quartiles = quantile_scores(cltv_clean['CLTV'], ['Low Value', 'Medium Value', 'High Value', 'Top Value'])
     segment_counts = cltv_quartiles.value_counts().sort_index()
 
-    fig, ax = plt.subplots(figsize=(10, 6))
-    colors = ['#FFC107', '#FF7043', '#42A5F5', '#00BFA5']
-    bars = ax.bar(segment_counts.index, segment_counts.values, color=colors, edgecolor='black', linewidth=2)
-    ax.set_title('Customer Value Segments', fontweight='bold', fontsize=14)
-    ax.set_xlabel('CLTV Segment', fontweight='bold', fontsize=12)
-    ax.set_ylabel('Number of Customers', fontweight='bold', fontsize=12)
+    def plot():
+        fig, ax = plt.subplots(figsize=(10, 6))
+        colors = ['#FFC107', '#FF7043', '#42A5F5', '#00BFA5']
+        bars = ax.bar(segment_counts.index, segment_counts.values, color=colors, edgecolor='black', linewidth=2)
+        ax.set_title('Customer Value Segments', fontweight='bold', fontsize=14)
+        ax.set_xlabel('CLTV Segment', fontweight='bold', fontsize=12)
+        ax.set_ylabel('Number of Customers', fontweight='bold', fontsize=12)
+
+        for i, v in enumerate(segment_counts.values):
+            ax.text(i, v, f'{v}', ha='center', va='bottom', fontweight='bold', fontsize=12)
+
+        return fig
+
+    show_figure('cltv_value_segments', run_key, plot)
 
-    for i, v in enumerate(segment_counts.values):
-        ax.text(i, v, f'{v}', ha='center', va='bottom', fontweight='bold', fontsize=12)
+    # Predicted CLTV from the BG/NBD + Gamma-Gamma models
+    st.subheader(f"🔮 Predicted CLTV (Next {CLTV_HORIZON_DAYS} Days)")
 
-    st.pyplot(fig)
-    plt.close()
+    predicted = cltv_data['PredictedCLTV'].dropna()
+    if predicted.empty:
+        st.info(f"Predicted CLTV needs at least {MIN_REPEAT_CUSTOMERS} repeat customers to fit "
+                "the purchase and spend models.")
+        return
 
-def show_kmeans_analysis(rfm, inertias, K_range):
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        st.metric("Total Predicted CLTV", f"£{predicted.sum():,.2f}")
+    with col2:
+        st.metric("Avg Probability Alive", f"{cltv_data['ProbabilityAlive'].mean():.1%}")
+    with col3:
+        st.metric("Avg Predicted Purchase Days", f"{cltv_data['PredictedPurchases'].mean():.1f}")
+
+    predicted_clean = predicted[predicted <= predicted.quantile(0.99)]
+
+    def plot(budget):
+        fig, ax = plt.subplots(figsize=(10, 6))
+        draw_histogram(ax, predicted_clean, 50, budget, color='#7E57C2', edgecolor='black', alpha=0.7)
+        ax.axvline(predicted_clean.mean(), color='red', linestyle='--', linewidth=2,
+                   label=f'Mean: £{predicted_clean.mean():.2f}')
+        ax.set_xlabel('Predicted CLTV (£)', fontweight='bold', fontsize=12)
+        ax.set_ylabel('Number of Customers', fontweight='bold', fontsize=12)
+        ax.set_title('Predicted CLTV Distribution', fontweight='bold', fontsize=14)
+        ax.legend()
+        ax.grid(True, alpha=0.3)
+        return fig
+
+    show_figure('cltv_predicted_histogram', run_key, plot, budget=POINT_BUDGET)
+    histogram_caption(len(predicted_clean))
+
+def show_cohort_analysis(cube, run_key):
+    """Cohort Retention Analysis Page"""
+    st.header("📅 Cohort Retention Analysis")
+    st.markdown("Customers grouped by the period of their first purchase, followed over the periods since")
+
+    period = st.radio("Cohort period", COHORT_PERIODS, format_func=str.title, horizontal=True)
+    cohorts = get_cohorts(run_key, period, cube)
+    retention, revenue, sizes = cohorts['retention'], cohorts['revenue'], cohorts['sizes']
+    labels = retention.index.strftime('%Y-%m' if period == 'month' else '%Y-%m-%d')
+
+    # Average retention per period since acquisition, weighted by the cohorts observed that long
+    observed = cohorts['customers'].notna()
+    average_retention = cohorts['customers'].sum() / observed.mul(sizes, axis=0).sum()
+
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        st.metric("Cohorts", f"{len(sizes):,}")
+    with col2:
+        st.metric("Customers Acquired", f"{sizes.sum():,}")
+    with col3:
+        st.metric(f"Retained After 1 {period.title()}",
+                  f"{average_retention.iloc[1]:.1%}" if len(average_retention) > 1 else "n/a")
+
+    # Annotating every cell stops being readable past a couple of dozen cohorts
+    annotate = retention.shape[0] <= 24 and retention.shape[1] <= 24
+
+    st.subheader("🔁 Retention by Cohort")
+
+    def plot(period):
+        fig, ax = plt.subplots(figsize=(12, max(4, 0.4 * len(labels))))
+        sns.heatmap(retention * 100, annot=annotate, fmt='.0f', cmap='YlGnBu', vmin=0, vmax=100,
+                    yticklabels=labels, cbar_kws={'label': '% of Cohort Active'}, ax=ax)
+        ax.set_title('Share of Each Cohort Purchasing in Each Period', fontweight='bold', fontsize=14)
+        ax.set_xlabel(f'{period.title()}s Since First Purchase', fontweight='bold', fontsize=12)
+        ax.set_ylabel('Cohort', fontweight='bold', fontsize=12)
+        return fig
+
+    show_figure('cohort_retention', run_key, plot, period=period)
+
+    st.subheader("💷 Revenue by Cohort")
+
+    def plot(period):
+        fig, ax = plt.subplots(figsize=(12, max(4, 0.4 * len(labels))))
+        sns.heatmap(revenue.div(sizes, axis=0), annot=annotate, fmt='.1f', cmap='YlOrRd',
+                    yticklabels=labels, cbar_kws={'label': 'Revenue per Acquired Customer (£)'}, ax=ax)
+        ax.set_title('Revenue per Acquired Customer in Each Period', fontweight='bold', fontsize=14)
+        ax.set_xlabel(f'{period.title()}s Since First Purchase', fontweight='bold', fontsize=12)
+        ax.set_ylabel('Cohort', fontweight='bold', fontsize=12)
+        return fig
+
+    show_figure('cohort_revenue', run_key, plot, period=period)
+
+    st.subheader("📉 Average Retention Curve")
+
+    def plot(period):
+        fig, ax = plt.subplots(figsize=(10, 5))
+        ax.plot(average_retention.index, average_retention.to_numpy() * 100, marker='o',
+                color='#00BFA5', linewidth=3)
+        ax.set_xlabel(f'{period.title()}s Since First Purchase', fontweight='bold', fontsize=12)
+        ax.set_ylabel('% of Customers Active', fontweight='bold', fontsize=12)
+        ax.set_title('Average Retention Curve', fontweight='bold', fontsize=14)
+        ax.set_ylim(0, 105)
+        ax.grid(True, alpha=0.3)
+        return fig
+
+    show_figure('cohort_retention_curve', run_key, plot, period=period)
+    st.caption("Averages weight each cohort by its size and only include cohorts observed for that long. "
+               "Under sidebar filters, cohorts start at each customer's first matching purchase.")
+
+def show_kmeans_analysis(rfm, inertias, K_range, model_info, run_key):
     """KMeans Clustering Analysis Page"""
     st.header("🔍 KMeans Clustering Analysis")
 
+    if model_info['engine'] == 'minibatch':
+        quality = model_info['quality']
+        st.info(
+            f"{model_info['n_customers']:,} customers clustered with mini-batch k-means. "
+            f"On a {quality['sample_size']:,}-customer sample its inertia is "
+            f"{quality['inertia_gap']:+.1%} vs. an exact fit "
+            f"(label agreement ARI {quality['label_agreement']:.2f})."
+        )
+
     # Elbow Method
     st.subheader("📉 Elbow Method for Optimal K")
 
-    fig, ax = plt.subplots(figsize=(10, 6))
-    ax.plot(K_range, inertias, 'bo-', linewidth=2, markersize=10)
-    ax.axvline(x=4, color='red', linestyle='--', alpha=0.7, linewidth=2, label='Optimal K=4')
-    ax.set_xlabel('Number of Clusters (K)', fontweight='bold', fontsize=12)
-    ax.set_ylabel('Inertia (Within-Cluster Sum of Squares)', fontweight='bold', fontsize=12)
-    ax.set_title('Elbow Method: Finding Optimal Number of Clusters', fontweight='bold', fontsize=14)
-    ax.grid(True, alpha=0.3)
-    ax.legend()
-    ax.set_xticks(K_range)
-    st.pyplot(fig)
-    plt.close()
+    optimal_k = model_info['optimal_k']
+
+    def plot():
+        fig, ax = plt.subplots(figsize=(10, 6))
+        ax.plot(K_range, inertias, 'bo-', linewidth=2, markersize=10, label='Inertia')
+        ax.axvline(x=optimal_k, color='red', linestyle='--', alpha=0.7, linewidth=2, label=f'Optimal K={optimal_k}')
+        ax.set_xlabel('Number of Clusters (K)', fontweight='bold', fontsize=12)
+        ax.set_ylabel('Inertia (Within-Cluster Sum of Squares)', fontweight='bold', fontsize=12)
+        ax.set_title('Elbow Method: Finding Optimal Number of Clusters', fontweight='bold', fontsize=14)
+        ax.grid(True, alpha=0.3)
+        ax_silhouette = ax.twinx()
+        ax_silhouette.plot(K_range, model_info['silhouettes'], 's--', color='#00BFA5', linewidth=2, label='Silhouette (sampled)')
+        ax_silhouette.set_ylabel('Silhouette Score', fontweight='bold', fontsize=12)
+        ax_silhouette.grid(False)
+        lines, labels = ax.get_legend_handles_labels()
+        lines2, labels2 = ax_silhouette.get_legend_handles_labels()
+        ax.legend(lines + lines2, labels + labels2)
+        ax.set_xticks(K_range)
+        return fig
+
+    show_figure('kmeans_elbow', run_key, plot)
+
+    st.caption(f"K={optimal_k} selected automatically by the highest sampled silhouette score.")
+
+    # Cluster stability across refreshes
+    drift = model_info['centroid_drift']
+    if drift['Moved (scaled)'].notna().any():
+        st.subheader("🧭 Cluster Drift Since Last Refresh")
+        warm = "warm-started from the previous centroids" if model_info['warm_started'] else "fitted from scratch"
+        st.markdown(f"Final model {warm}, converged in {model_info['n_iter']} iterations. "
+                    "Cluster IDs are matched to the previous run so colors and names stay stable.")
+        st.dataframe(drift.set_index('Cluster').round(3))
 
     # Revenue by KMeans Cluster (Essential Visualization 3)
     st.subheader("💰 Revenue by KMeans Cluster")
@@ -531,59 +863,64 @@ def show_kmeans_analysis(rfm, inertias, K_range):
     cluster_revenue = rfm.groupby('KMeans_Cluster')['Monetary'].sum().sort_values(ascending=False)
     cluster_counts = rfm['KMeans_Cluster'].value_counts().sort_index()
 
-    fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(14, 6))
+    def plot():
+        fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(14, 6))
+
+        bars1 = ax1.bar(range(len(cluster_revenue)), cluster_revenue.values,
+                        color=[cluster_color(i) for i in cluster_revenue.index], edgecolor='black', linewidth=2)
+        ax1.set_xticks(range(len(cluster_revenue)))
+        ax1.set_xticklabels([f'Cluster {i}' for i in cluster_revenue.index])
+        ax1.set_title('Total Revenue by KMeans Cluster', fontweight='bold', fontsize=14)
+        ax1.set_ylabel('Total Revenue (£)', fontweight='bold', fontsize=12)
 
-    colors = ['#FF7043', '#00BFA5', '#FFC107', '#42A5F5']
-    bars1 = ax1.bar(range(len(cluster_revenue)), cluster_revenue.values,
-                    color=[colors[i] for i in cluster_revenue.index], edgecolor='black', linewidth=2)
-    ax1.set_xticks(range(len(cluster_revenue)))
-    ax1.set_xticklabels([f'Cluster {i}' for i in cluster_revenue.index])
-    ax1.set_title('Total Revenue by KMeans Cluster', fontweight='bold', fontsize=14)
-    ax1.set_ylabel('Total Revenue (£)', fontweight='bold', fontsize=12)
+        for i, (idx, v) in enumerate(cluster_revenue.items()):
+            ax1.text(i, v, f'£{v/1000:.0f}K', ha='center', va='bottom', fontweight='bold', fontsize=11)
 
-    for i, (idx, v) in enumerate(cluster_revenue.items()):
-        ax1.text(i, v, f'£{v/1000:.0f}K', ha='center', va='bottom', fontweight='bold', fontsize=11)
+        bars2 = ax2.bar(range(len(cluster_counts)), cluster_counts.values,
+                        color=[cluster_color(i) for i in cluster_counts.index], edgecolor='black', linewidth=2)
+        ax2.set_xticks(range(len(cluster_counts)))
+        ax2.set_xticklabels([f'Cluster {i}' for i in cluster_counts.index])
+        ax2.set_title('Customer Distribution by Cluster', fontweight='bold', fontsize=14)
+        ax2.set_ylabel('Number of Customers', fontweight='bold', fontsize=12)
 
-    bars2 = ax2.bar(range(len(cluster_counts)), cluster_counts.values,
-                    color=colors, edgecolor='black', linewidth=2)
-    ax2.set_xticks(range(len(cluster_counts)))
-    ax2.set_xticklabels([f'Cluster {i}' for i in range(len(cluster_counts))])
-    ax2.set_title('Customer Distribution by Cluster', fontweight='bold', fontsize=14)
-    ax2.set_ylabel('Number of Customers', fontweight='bold', fontsize=12)
+        for i, v in enumerate(cluster_counts.values):
+            ax2.text(i, v, f'{v}', ha='center', va='bottom', fontweight='bold', fontsize=11)
 
-    for i, v in enumerate(cluster_counts.values):
-        ax2.text(i, v, f'{v}', ha='center', va='bottom', fontweight='bold', fontsize=11)
+        plt.tight_layout()
+        return fig
 
-    plt.tight_layout()
-    st.pyplot(fig)
-    plt.close()
+    show_figure('kmeans_cluster_revenue', run_key, plot)
 
     # 3D Cluster Visualization
     st.subheader("🌐 3D Cluster Visualization")
 
-    fig = plt.figure(figsize=(12, 8))
-    ax = fig.add_subplot(111, projection='3d')
-
-    for i in range(4):
-        cluster_data = rfm[rfm['KMeans_Cluster'] == i]
-        ax.scatter(cluster_data['Recency'],
-                  cluster_data['Frequency'],
-                  np.log1p(cluster_data['Monetary']),
-                  c=colors[i],
-                  label=f'Cluster {i}: {cluster_data["Cluster_Name"].iloc[0]}',
-                  alpha=0.6,
-                  s=50,
-                  edgecolor='black',
-                  linewidth=0.5)
-
-    ax.set_xlabel('Recency (days)', fontweight='bold', fontsize=11)
-    ax.set_ylabel('Frequency (purchases)', fontweight='bold', fontsize=11)
-    ax.set_zlabel('Log(Monetary)', fontweight='bold', fontsize=11)
-    ax.set_title('KMeans Clustering (3D View)', fontweight='bold', fontsize=14)
-    ax.legend(loc='upper right', fontsize=10)
-
-    st.pyplot(fig)
-    plt.close()
+    def plot(budget):
+        fig = plt.figure(figsize=(12, 8))
+        ax = fig.add_subplot(111, projection='3d')
+
+        # Above the budget, draw a per-cluster sample with lighter markers
+        sample = stratified_sample(rfm, 'KMeans_Cluster', budget)
+        marker = {'s': 50, 'edgecolor': 'black', 'linewidth': 0.5} if len(sample) == len(rfm) else {'s': 8, 'linewidth': 0}
+
+        for i, cluster_data in sample.groupby('KMeans_Cluster'):
+            ax.scatter(cluster_data['Recency'],
+                      cluster_data['Frequency'],
+                      np.log1p(cluster_data['Monetary']),
+                      c=cluster_color(i),
+                      label=f'Cluster {i}: {cluster_data["Cluster_Name"].iloc[0]}',
+                      alpha=0.6,
+                      **marker)
+
+        ax.set_xlabel('Recency (days)', fontweight='bold', fontsize=11)
+        ax.set_ylabel('Frequency (purchases)', fontweight='bold', fontsize=11)
+        ax.set_zlabel('Log(Monetary)', fontweight='bold', fontsize=11)
+        ax.set_title('KMeans Clustering (3D View)', fontweight='bold', fontsize=14)
+        ax.legend(loc='upper right', fontsize=10)
+
+        return fig
+
+    show_figure('kmeans_3d', run_key, plot, budget=POINT_BUDGET)
+    scatter_caption(rfm)
 
     # Cluster Summary
     st.subheader("📊 Cluster Summary Statistics")
@@ -597,7 +934,7 @@ def show_kmeans_analysis(rfm, inertias, K_range):
     cluster_summary.columns = ['Avg Recency', 'Avg Frequency', 'Avg Monetary', 'Total Revenue', 'Count']
     st.dataframe(cluster_summary.style.background_gradient(cmap='YlGnBu'))
 
-def show_comparative_analysis(rfm):
+def show_comparative_analysis(rfm, item_pairs, item_preferences, run_key):
     """Comparative Analysis Page"""
     st.header("📊 Comparative Analysis: RFM vs KMeans")
 
@@ -606,15 +943,17 @@ def show_comparative_analysis(rfm):
 
     crosstab = pd.crosstab(rfm['Customer_Segment'], rfm['KMeans_Cluster'])
 
-    fig, ax = plt.subplots(figsize=(12, 8))
-    sns.heatmap(crosstab, annot=True, fmt='d', cmap='YlOrRd', ax=ax,
-                cbar_kws={'label': 'Customer Count'}, linewidths=2,
-                annot_kws={'fontsize': 12, 'fontweight': 'bold'})
-    ax.set_title('RFM Segments vs KMeans Clusters', fontweight='bold', fontsize=14)
-    ax.set_xlabel('KMeans Cluster', fontweight='bold', fontsize=12)
-    ax.set_ylabel('RFM Segment', fontweight='bold', fontsize=12)
-    st.pyplot(fig)
-    plt.close()
+    def plot():
+        fig, ax = plt.subplots(figsize=(12, 8))
+        sns.heatmap(crosstab, annot=True, fmt='d', cmap='YlOrRd', ax=ax,
+                    cbar_kws={'label': 'Customer Count'}, linewidths=2,
+                    annot_kws={'fontsize': 12, 'fontweight': 'bold'})
+        ax.set_title('RFM Segments vs KMeans Clusters', fontweight='bold', fontsize=14)
+        ax.set_xlabel('KMeans Cluster', fontweight='bold', fontsize=12)
+        ax.set_ylabel('RFM Segment', fontweight='bold', fontsize=12)
+        return fig
+
+    show_figure('comparative_crosstab', run_key, plot)
 
     st.markdown("""
     This heatmap shows the convergence between rule-based RFM segments and data-driven KMeans clusters.
@@ -624,34 +963,36 @@ def show_comparative_analysis(rfm):
     # Recency vs Log(Monetary) Scatter (Essential Visualization 6)
     st.subheader("🎯 Recency vs Monetary by Cluster")
 
-    fig, ax = plt.subplots(figsize=(12, 8))
-    colors_cluster = ['#FF7043', '#00BFA5', '#FFC107', '#42A5F5']
-
-    for i in range(4):
-        cluster_data = rfm[rfm['KMeans_Cluster'] == i]
-        ax.scatter(cluster_data['Recency'],
-                  np.log1p(cluster_data['Monetary']),
-                  c=colors_cluster[i],
-                  label=f'Cluster {i}: {cluster_data["Cluster_Name"].iloc[0]}',
-                  alpha=0.6,
-                  s=100,
-                  edgecolor='black',
-                  linewidth=0.5)
-
-    ax.set_xlabel('Recency (Days Since Last Purchase)', fontweight='bold', fontsize=12)
-    ax.set_ylabel('Log(Monetary Value)', fontweight='bold', fontsize=12)
-    ax.set_title('Recency vs Monetary: Customer Action Space', fontweight='bold', fontsize=14)
-    ax.legend(fontsize=11)
-    ax.grid(True, alpha=0.3)
-
-    # Add quadrant lines
-    median_recency = rfm['Recency'].median()
-    median_monetary = np.log1p(rfm['Monetary'].median())
-    ax.axvline(median_recency, color='gray', linestyle='--', alpha=0.5)
-    ax.axhline(median_monetary, color='gray', linestyle='--', alpha=0.5)
-
-    st.pyplot(fig)
-    plt.close()
+    def plot(budget):
+        fig, ax = plt.subplots(figsize=(12, 8))
+
+        sample = stratified_sample(rfm, 'KMeans_Cluster', budget)
+        marker = {'s': 100, 'edgecolor': 'black', 'linewidth': 0.5} if len(sample) == len(rfm) else {'s': 10, 'linewidth': 0}
+
+        for i, cluster_data in sample.groupby('KMeans_Cluster'):
+            ax.scatter(cluster_data['Recency'],
+                      np.log1p(cluster_data['Monetary']),
+                      c=cluster_color(i),
+                      label=f'Cluster {i}: {cluster_data["Cluster_Name"].iloc[0]}',
+                      alpha=0.6,
+                      **marker)
+
+        ax.set_xlabel('Recency (Days Since Last Purchase)', fontweight='bold', fontsize=12)
+        ax.set_ylabel('Log(Monetary Value)', fontweight='bold', fontsize=12)
+        ax.set_title('Recency vs Monetary: Customer Action Space', fontweight='bold', fontsize=14)
+        ax.legend(fontsize=11)
+        ax.grid(True, alpha=0.3)
+
+        # Add quadrant lines
+        median_recency = rfm['Recency'].median()
+        median_monetary = np.log1p(rfm['Monetary'].median())
+        ax.axvline(median_recency, color='gray', linestyle='--', alpha=0.5)
+        ax.axhline(median_monetary, color='gray', linestyle='--', alpha=0.5)
+
+        return fig
+
+    show_figure('comparative_action_space', run_key, plot, budget=POINT_BUDGET)
+    scatter_caption(rfm)
 
     st.markdown("""
     **Action Space Mapping:**
@@ -668,29 +1009,71 @@ def show_comparative_analysis(rfm):
 
     with col1:
         segment_monetary = rfm.groupby('Customer_Segment')['Monetary'].mean().sort_values(ascending=True)
-        fig, ax = plt.subplots(figsize=(8, 6))
-        ax.barh(range(len(segment_monetary)), segment_monetary.values, color='#00BFA5', alpha=0.7, edgecolor='black')
-        ax.set_yticks(range(len(segment_monetary)))
-        ax.set_yticklabels(segment_monetary.index)
-        ax.set_title('Avg Monetary by RFM Segment', fontweight='bold')
-        ax.set_xlabel('Average Monetary (£)', fontweight='bold')
-        ax.grid(axis='x', alpha=0.3)
-        st.pyplot(fig)
-        plt.close()
+        def plot():
+            fig, ax = plt.subplots(figsize=(8, 6))
+            ax.barh(range(len(segment_monetary)), segment_monetary.values, color='#00BFA5', alpha=0.7, edgecolor='black')
+            ax.set_yticks(range(len(segment_monetary)))
+            ax.set_yticklabels(segment_monetary.index)
+            ax.set_title('Avg Monetary by RFM Segment', fontweight='bold')
+            ax.set_xlabel('Average Monetary (£)', fontweight='bold')
+            ax.grid(axis='x', alpha=0.3)
+            return fig
+
+        show_figure('comparative_segment_monetary', run_key, plot)
 
     with col2:
         cluster_monetary = rfm.groupby('Cluster_Name')['Monetary'].mean().sort_values(ascending=True)
-        fig, ax = plt.subplots(figsize=(8, 6))
-        ax.barh(range(len(cluster_monetary)), cluster_monetary.values, color='#FF7043', alpha=0.7, edgecolor='black')
-        ax.set_yticks(range(len(cluster_monetary)))
-        ax.set_yticklabels(cluster_monetary.index)
-        ax.set_title('Avg Monetary by KMeans Cluster', fontweight='bold')
-        ax.set_xlabel('Average Monetary (£)', fontweight='bold')
-        ax.grid(axis='x', alpha=0.3)
-        st.pyplot(fig)
-        plt.close()
-
-def show_business_recommendations(rfm, cltv_data):
+        def plot():
+            fig, ax = plt.subplots(figsize=(8, 6))
+            ax.barh(range(len(cluster_monetary)), cluster_monetary.values, color='#FF7043', alpha=0.7, edgecolor='black')
+            ax.set_yticks(range(len(cluster_monetary)))
+            ax.set_yticklabels(cluster_monetary.index)
+            ax.set_title('Avg Monetary by KMeans Cluster', fontweight='bold')
+            ax.set_xlabel('Average Monetary (£)', fontweight='bold')
+            ax.grid(axis='x', alpha=0.3)
+            return fig
+
+        show_figure('comparative_cluster_monetary', run_key, plot)
+
+    # Item Preferences from the sparse basket matrices
+    st.subheader("🧺 Item Preferences by Segment")
+
+    grouping = st.radio("Group customers by", ['RFM Segment', 'KMeans Cluster'], horizontal=True)
+    preferences = item_preferences[item_preferences['Grouping'] == grouping]
+    top_items = preferences.groupby('Item')['Baskets'].sum().nlargest(PREFERENCE_ITEMS).index
+    affinity = preferences.pivot(index='Segment', columns='Item', values='Affinity')
+    affinity = affinity.loc[preferences['Segment'].unique(), top_items]
+
+    def plot(grouping):
+        fig, ax = plt.subplots(figsize=(12, max(4, 0.7 * len(affinity))))
+        sns.heatmap(affinity, annot=True, fmt='.2f', cmap='RdBu_r', center=1, linewidths=1,
+                    cbar_kws={'label': 'Affinity'}, ax=ax)
+        ax.set_title(f'Item Affinity by {grouping}', fontweight='bold', fontsize=14)
+        ax.set_xlabel('Item', fontweight='bold', fontsize=12)
+        ax.set_ylabel(grouping, fontweight='bold', fontsize=12)
+        return fig
+
+    show_figure('comparative_item_affinity', run_key, plot, grouping=grouping)
+    st.caption("Affinity is the share of a segment's baskets holding an item over the item's share of all "
+               "baskets; above 1 the segment favours the item. A basket is a customer's lines with the same "
+               "date and time, over the full history (the sidebar filters do not apply).")
+
+    # Item Pairs bought in the same basket
+    st.subheader("🛒 Items Bought Together")
+
+    if item_pairs.empty:
+        st.info("No basket holds more than one item, so there are no item pairs to compare.")
+        return
+
+    st.dataframe(item_pairs.head(PAIR_TABLE_ROWS).style.format(
+        {'Support': '{:.2%}', 'Confidence': '{:.2%}', 'Lift': '{:.2f}'}
+    ).background_gradient(cmap='YlGn', subset=['Lift']))
+    shown = (f"All {len(item_pairs)} item pairs" if len(item_pairs) <= PAIR_TABLE_ROWS
+             else f"The {PAIR_TABLE_ROWS} of {len(item_pairs):,} item pairs with the highest lift")
+    st.caption(f"{shown}. Confidence is the share of baskets holding the first item that also hold the second; "
+               "lift above 1 means the two are bought together more often than chance.")
+
+def show_business_recommendations(rfm, concentration, lookalike_index):
     """Business Recommendations Page"""
     st.header("💡 Business Recommendations & Action Plan")
 
@@ -774,11 +1157,56 @@ def show_business_recommendations(rfm, cltv_data):
     **Expected Outcome:** Increase average order value by 10-15%, boost purchase frequency by 20%
     """)
 
+    # Lookalike Audiences from the nearest-neighbour index
+    st.markdown("### 👥 Lookalike Audiences")
+
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        grouping = st.radio("Seed customers from", ['RFM Segment', 'KMeans Cluster'], horizontal=True)
+    if grouping == 'RFM Segment':
+        labels = rfm['Customer_Segment']
+        groups = sorted(labels.unique())
+    else:
+        # Clusters are told apart by ID, as several can share a name
+        labels = 'Cluster ' + rfm['KMeans_Cluster'].astype(str) + ': ' + rfm['Cluster_Name']
+        groups = labels.groupby(rfm['KMeans_Cluster']).first().tolist()
+    with col2:
+        seed_group = st.selectbox("Seed group", groups,
+                                  index=groups.index('Champions') if 'Champions' in groups else 0)
+    with col3:
+        k = st.slider("Neighbours per seed", 1, 50, DEFAULT_NEIGHBOURS)
+
+    group = rfm.loc[labels == seed_group, 'Customer ID']
+    sampled = len(group) > LOOKALIKE_MAX_SEEDS
+    seeds = group.sample(LOOKALIKE_MAX_SEEDS, random_state=42) if sampled else group
+    audience = lookalike_index.audience(seeds, k, exclude=group).merge(
+        rfm[['Customer ID', 'Customer_Segment', 'Cluster_Name', 'Recency', 'Frequency', 'Monetary']],
+        on='Customer ID')
+
+    col1, col2, col3 = st.columns(3)
+    with col1:
+        st.metric("Seed Customers", f"{len(seeds):,}")
+    with col2:
+        st.metric("Lookalike Audience", f"{len(audience):,}")
+    with col3:
+        st.metric("Audience Revenue", f"£{audience['Monetary'].sum():,.2f}")
+
+    if audience.empty:
+        st.info("No customers outside the seed group are near enough to its seeds.")
+    else:
+        st.dataframe(audience.head(LOOKALIKE_TABLE_ROWS).style.format(
+            {'Distance': '{:.3f}', 'Monetary': '£{:,.2f}'}
+        ))
+    caption = (f"Customers outside {seed_group} whose full-history Recency, Frequency and log-Monetary "
+               "values are nearest a seed's in the standardized clustering space, closest first.")
+    if sampled:
+        caption += f" Seeds are a random {LOOKALIKE_MAX_SEEDS:,} of the group."
+    st.caption(caption)
+
     # CLTV-Based Budget Allocation
     st.markdown("### 💰 CLTV-Based Budget Allocation")
 
-    cltv_clean = cltv_data[cltv_data['CLTV'] <= cltv_data['CLTV'].quantile(0.99)]
-    avg_cltv = cltv_clean['CLTV'].mean()
+    avg_cltv = concentration['mean']
 
     st.markdown(f"""
     **Customer Acquisition Cost (CAC) Recommendations:**
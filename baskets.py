@@ -0,0 +1,102 @@
+"""
+Market-basket analysis on sparse item matrices
+
+Transaction lines sharing a customer, date and time form one basket. Baskets
+are held as a sparse basket x item incidence matrix; the item x item
+co-occurrence counts and the customer x item counts are sparse products of
+it, so memory grows with the non-zero entries rather than with
+customers x items.
+"""
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+# Columns that identify a basket
+BASKET_KEYS = ['Customer ID', 'Date', 'Time']
+# Item pairs seen together in fewer baskets are left out of the pair table
+MIN_PAIR_BASKETS = 1
+
+def build_baskets(lines):
+    """Sparse basket x item and customer x item matrices of the basket lines
+
+    Returns a dict with the item names, the customer IDs (rows of
+    customer_items), basket_items (1 where a basket holds an item),
+    customer_items (baskets of each customer holding each item) and
+    basket_customers (the customer row of each basket).
+    """
+    items = lines['Item'].astype('category').cat.remove_unused_categories()
+    item_codes = items.cat.codes.to_numpy()
+    customer_codes, customers = pd.factorize(lines['Customer ID'], sort=True)
+    basket_ids = lines.groupby(BASKET_KEYS, observed=True, sort=True, dropna=False).ngroup().to_numpy()
+
+    n_baskets = basket_ids.max() + 1 if len(lines) else 0
+    basket_customers = np.zeros(n_baskets, dtype=np.int32)
+    basket_customers[basket_ids] = customer_codes
+
+    ones = np.ones(len(lines), dtype=np.int32)
+    shape = (len(customers), len(items.cat.categories))
+    return {
+        'items': [str(item) for item in items.cat.categories],
+        'customers': np.asarray(customers, dtype=np.int64),
+        'basket_items': sparse.csr_matrix((ones, (basket_ids, item_codes)), shape=(n_baskets, shape[1])),
+        'customer_items': sparse.csr_matrix((ones, (customer_codes, item_codes)), shape=shape),
+        'basket_customers': basket_customers,
+    }
+
+def item_baskets(baskets):
+    """Number of baskets holding each item"""
+    return np.asarray(baskets['basket_items'].sum(axis=0), dtype=np.float64).ravel()
+
+def item_pair_metrics(baskets, min_baskets=MIN_PAIR_BASKETS):
+    """Support, confidence and lift of every ordered pair of items bought together
+
+    Co-occurrence counts come from the sparse product B'B, so only pairs
+    that share at least one basket are ever materialized.
+    """
+    n_baskets = baskets['basket_items'].shape[0]
+    single = item_baskets(baskets)
+    co_occurrence = (baskets['basket_items'].T @ baskets['basket_items']).tocoo()
+
+    pair = (co_occurrence.row != co_occurrence.col) & (co_occurrence.data >= min_baskets)
+    antecedent, consequent = co_occurrence.row[pair], co_occurrence.col[pair]
+    both = co_occurrence.data[pair].astype(np.float64)
+    items = np.asarray(baskets['items'], dtype=object)
+
+    pairs = pd.DataFrame({
+        'Antecedent': items[antecedent],
+        'Consequent': items[consequent],
+        'Baskets': both.astype(np.int64),
+        'Support': both / n_baskets,
+        'Confidence': both / single[antecedent],
+        'Lift': both * n_baskets / (single[antecedent] * single[consequent]),
+    })
+    return pairs.sort_values(['Lift', 'Baskets', 'Antecedent', 'Consequent'],
+                             ascending=[False, False, True, True], ignore_index=True)
+
+def segment_item_preferences(baskets, labels):
+    """Share of each segment's baskets holding each item, and its affinity
+
+    labels maps Customer ID to segment. Affinity is the segment's share
+    over the share among all baskets: above 1 the segment buys the item
+    more often than customers overall.
+    """
+    segment = pd.Series(labels).reindex(baskets['customers'])
+    codes, segments = pd.factorize(segment, sort=True)
+    labelled = np.flatnonzero(codes >= 0)
+    membership = sparse.csr_matrix((np.ones(len(labelled), dtype=np.int32), (codes[labelled], labelled)),
+                                   shape=(len(segments), len(baskets['customers'])))
+
+    counts = (membership @ baskets['customer_items']).tocoo()
+    segment_baskets = membership @ np.bincount(baskets['basket_customers'], minlength=len(baskets['customers']))
+    overall_share = item_baskets(baskets) / baskets['basket_items'].shape[0]
+
+    share = counts.data / segment_baskets[counts.row]
+    preferences = pd.DataFrame({
+        'Segment': np.asarray(segments, dtype=object)[counts.row],
+        'Item': np.asarray(baskets['items'], dtype=object)[counts.col],
+        'Baskets': counts.data.astype(np.int64),
+        'Share': share,
+        'Affinity': share / overall_share[counts.col],
+    })
+    return preferences.sort_values(['Segment', 'Item'], ignore_index=True)
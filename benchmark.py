@@ -0,0 +1,156 @@
+"""
+Scaling benchmark for the analytics pipeline
+
+Times and memory-profiles each stage on synthetic data from 1k to 10M
+transactions and appends one JSON record per stage to a results file, so
+runs can be compared across versions:
+
+    python benchmark.py --max-rows 1000000 --output benchmarks/results.jsonl
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import sklearn
+
+from analytics import (
+    build_customer_summary,
+    calculate_cltv,
+    calculate_rfm,
+    load_and_process_data,
+    perform_kmeans_clustering,
+)
+from lookalikes import LookalikeIndex
+from synthetic import generate_transactions, write_transactions_csv
+
+# Seed customers in the timed lookalike batch query
+LOOKALIKE_SEEDS = 1_000
+
+# (transactions, customers) benchmarked by default
+SCALES = [
+    (1_000, 100),
+    (10_000, 1_000),
+    (100_000, 10_000),
+    (1_000_000, 100_000),
+    (10_000_000, 1_000_000),
+]
+RESULTS_PATH = os.path.join('benchmarks', 'results.jsonl')
+
+def code_version():
+    """Current git commit of the checkout, or None outside a git repo"""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def environment():
+    """Versions and machine details stored with every result"""
+    return {
+        'commit': code_version(),
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'sklearn': sklearn.__version__,
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+    }
+
+def measure(func, *args, profile_memory=False):
+    """Run func(*args) and return its result with either its wall time or its peak traced memory"""
+    if profile_memory:
+        tracemalloc.start()
+        result = func(*args)
+        peak_mb = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+        tracemalloc.stop()
+        return result, round(peak_mb, 2)
+    start = time.perf_counter()
+    result = func(*args)
+    return result, round(time.perf_counter() - start, 4)
+
+def benchmark_scale(n_rows, n_customers, seed=0, profile_memory=False):
+    """Time (or memory-profile) every stage on one synthetic dataset
+
+    Runs in a fresh temporary directory, so every pass starts with a cold
+    Parquet cache and no saved cluster model, and the project's own .cache
+    directory is never touched.
+    """
+    measurements = {}
+
+    def run(stage, func, *args):
+        result, measurements[stage] = measure(func, *args, profile_memory=profile_memory)
+        return result
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        try:
+            data_path = os.path.join(workdir, f'transactions_{n_rows}.csv')
+            df = run('generate', generate_transactions, n_rows, n_customers, '2024-04-01', 365, seed)
+            run('write_csv', write_transactions_csv, df, data_path)
+            del df
+
+            run('load_csv', load_and_process_data, data_path)
+            df = run('load_cached', load_and_process_data, data_path)
+            summary = run('customer_summary', build_customer_summary, df)
+            rfm = run('rfm', calculate_rfm, summary)
+            run('cltv', calculate_cltv, summary)
+            clusters = run('kmeans', perform_kmeans_clustering, rfm)[0]
+            index = run('lookalike_index', LookalikeIndex.from_rfm, clusters)
+            seeds = clusters['Customer ID'].sample(min(LOOKALIKE_SEEDS, len(clusters)), random_state=seed)
+            run('lookalike_query', index.query, seeds)
+        finally:
+            os.chdir(cwd)
+
+    return measurements, len(summary)
+
+def run_benchmarks(scales=SCALES, output=RESULTS_PATH, seed=0, profile_memory=True):
+    """Benchmark each scale, appending one record per stage to output as JSON lines
+
+    Timings come from an untraced pass; peak memory, if requested, from a
+    second pass under tracemalloc, whose overhead would distort the times.
+    Yields (rows, records) as each scale finishes.
+    """
+    run_info = {'run_at': time.strftime('%Y-%m-%d %H:%M:%S'), **environment()}
+    if os.path.dirname(output):
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+
+    for n_rows, n_customers in scales:
+        seconds, customers = benchmark_scale(n_rows, n_customers, seed)
+        peak_mb = benchmark_scale(n_rows, n_customers, seed, profile_memory=True)[0] if profile_memory else {}
+
+        records = [{**run_info, 'rows': n_rows, 'customers': customers, 'stage': stage,
+                    'seconds': seconds[stage], 'peak_mb': peak_mb.get(stage)} for stage in seconds]
+        with open(output, 'a') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+        yield n_rows, records
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the analytics pipeline on synthetic data.')
+    parser.add_argument('--max-rows', type=int, default=SCALES[-1][0],
+                        help='largest scale to run, in transactions (default: %(default)s)')
+    parser.add_argument('--output', default=RESULTS_PATH, help='JSON lines results file (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed (default: %(default)s)')
+    parser.add_argument('--no-memory', action='store_true',
+                        help='skip the second, memory-profiled pass over each scale')
+    args = parser.parse_args()
+
+    scales = [scale for scale in SCALES if scale[0] <= args.max_rows]
+    for n_rows, records in run_benchmarks(scales, args.output, args.seed, not args.no_memory):
+        print(f"{n_rows:,} transactions, {records[0]['customers']:,} customers")
+        for record in records:
+            memory = '' if record['peak_mb'] is None else f" {record['peak_mb']:10.1f} MB"
+            print(f"  {record['stage']:<16} {record['seconds']:8.2f}s{memory}")
+    print(f"Results appended to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Size-bounded cache of rendered dashboard figures
+
+Stores PNG bytes keyed by (data fingerprint, chart id, parameters) so a
+Streamlit rerun with unchanged data can serve a chart without re-plotting.
+"""
+
+import io
+import threading
+from collections import OrderedDict
+
+import matplotlib.pyplot as plt
+
+# Default budget for cached PNG bytes across all sessions
+FIGURE_CACHE_MAX_BYTES = 64 * 1024 ** 2
+# Same resolution st.pyplot renders at
+FIGURE_DPI = 200
+
+def render_png(fig, dpi=FIGURE_DPI):
+    """Render a matplotlib figure to PNG bytes and close it"""
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format='png', dpi=dpi, bbox_inches='tight')
+    plt.close(fig)
+    return buffer.getvalue()
+
+class FigureCache:
+    """Least-recently-used store of rendered figures, bounded by total bytes"""
+
+    def __init__(self, max_bytes=FIGURE_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(fingerprint, chart_id, params):
+        """Cache key for a chart rendered from a given dataset and parameters"""
+        return (fingerprint, chart_id, tuple(sorted(params.items())))
+
+    def get(self, key):
+        """Cached PNG bytes for key, or None"""
+        with self._lock:
+            png = self._items.get(key)
+            if png is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return png
+
+    def put(self, key, png):
+        """Store PNG bytes, evicting least recently used entries over budget"""
+        if len(png) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._items:
+                self.size -= len(self._items.pop(key))
+            self._items[key] = png
+            self.size += len(png)
+            while self.size > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self.size -= len(evicted)
+
+    def get_or_render(self, fingerprint, chart_id, plot, **params):
+        """Return cached PNG bytes, calling plot(**params) only on a miss
+
+        Returns the bytes and whether they came from the cache.
+        """
+        key = self.make_key(fingerprint, chart_id, params)
+        png = self.get(key)
+        if png is not None:
+            return png, True
+        png = render_png(plot(**params))
+        self.put(key, png)
+        return png, False
+
+    def __len__(self):
+        return len(self._items)
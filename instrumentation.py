@@ -0,0 +1,92 @@
+"""
+Per-stage timing and memory instrumentation
+
+Pipeline stages, dashboard pages and chart renders are wrapped in track(),
+which records wall time, process peak memory, row counts and cache hits.
+Records are gathered per dashboard run by collect() and, when
+CUSTOMER_ANALYTICS_METRICS_LOG is set, appended to that JSON-lines file.
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+METRICS_LOG_PATH = os.environ.get('CUSTOMER_ANALYTICS_METRICS_LOG')
+
+_local = threading.local()
+
+def peak_memory_mb():
+    """Peak resident memory of this process so far, or None if unavailable"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024
+
+def row_count(value):
+    """Number of rows of a table-like result, else None"""
+    return len(value) if hasattr(value, 'shape') else None
+
+class MetricsLog:
+    """Append-only JSON-lines sink for stage records, safe across threads"""
+
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def write(self, record):
+        if not self.path:
+            return
+        line = json.dumps(record, default=str)
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write(line + '\n')
+
+metrics_log = MetricsLog(METRICS_LOG_PATH)
+
+@contextmanager
+def collect():
+    """Gather the records of every stage tracked on this thread inside the block"""
+    records = []
+    previous = getattr(_local, 'records', None)
+    _local.records = records
+    try:
+        yield records
+    finally:
+        _local.records = previous
+
+@contextmanager
+def track(stage, kind='stage', **fields):
+    """Time a block and record it with the process memory high-water mark
+
+    Yields the record so the block can add fields such as rows or cache
+    ('hit' or 'miss'). peak_growth_mb is how much the peak rose during the
+    block: zero means the block fit in memory already reserved.
+    """
+    record = {'stage': stage, 'kind': kind, 'rows': None, 'cache': None, **fields}
+    peak_before = peak_memory_mb()
+    start = time.perf_counter()
+    try:
+        yield record
+    except Exception as e:
+        record['error'] = type(e).__name__
+        raise
+    finally:
+        record['seconds'] = round(time.perf_counter() - start, 4)
+        record['peak_mb'] = peak_memory_mb()
+        if peak_before is not None:
+            record['peak_growth_mb'] = round(record['peak_mb'] - peak_before, 1)
+            record['peak_mb'] = round(record['peak_mb'], 1)
+        record['timestamp'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+        records = getattr(_local, 'records', None)
+        if records is not None:
+            records.append(record)
+        metrics_log.write(record)
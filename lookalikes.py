@@ -0,0 +1,106 @@
+"""
+Lookalike search over the customer feature vectors KMeans clusters on
+
+Customers are points in the standardized Recency/Frequency/log-Monetary
+space of perform_kmeans_clustering. A KD-tree over those points answers
+batch k-nearest-neighbour queries for a list of seed customers in
+logarithmic time, so "customers like our Champions" stays interactive at
+millions of customers. The pipeline builds the index from the clusters
+artifact, so it is rebuilt whenever the clustering is.
+"""
+
+import numpy as np
+import pandas as pd
+from sklearn.neighbors import KDTree
+from sklearn.preprocessing import StandardScaler
+
+from analytics import clustering_features
+
+# Neighbours returned per seed customer
+DEFAULT_NEIGHBOURS = 10
+# Widest neighbour list fetched per seed while looking for customers outside the seed group
+MAX_FETCH = 512
+# Points per KD-tree leaf; larger leaves build faster, smaller ones query faster
+LEAF_SIZE = 40
+
+class LookalikeIndex:
+    """KD-tree over the scaled feature vectors of every customer, addressed by Customer ID"""
+
+    def __init__(self, customer_ids, vectors, leaf_size=LEAF_SIZE):
+        # Rows are kept in Customer ID order so seeds are found by binary search
+        order = np.argsort(np.asarray(customer_ids), kind='stable')
+        self.customer_ids = np.asarray(customer_ids, dtype=np.int64)[order]
+        self.tree = KDTree(np.asarray(vectors, dtype=np.float64)[order], leaf_size=leaf_size)
+
+    @classmethod
+    def from_rfm(cls, rfm, leaf_size=LEAF_SIZE):
+        """Index the customers of an RFM table in the standardized clustering space"""
+        vectors = StandardScaler().fit_transform(clustering_features(rfm))
+        return cls(rfm['Customer ID'], vectors, leaf_size)
+
+    def __len__(self):
+        return len(self.customer_ids)
+
+    def rows(self, seed_ids):
+        """Index rows of the seed customers; IDs not in the index are dropped"""
+        seed_ids = np.asarray(seed_ids, dtype=np.int64)
+        rows = np.minimum(np.searchsorted(self.customer_ids, seed_ids), len(self) - 1)
+        return rows[self.customer_ids[rows] == seed_ids]
+
+    def query(self, seed_ids, k=DEFAULT_NEIGHBOURS):
+        """The k nearest other customers of each seed, in one batch query
+
+        Returns a long table of Seed, Customer ID, Rank (1 is nearest) and
+        Distance in standardized units.
+        """
+        rows = self.rows(seed_ids)
+        k = min(k, len(self) - 1)
+        if len(rows) == 0 or k < 1:
+            return pd.DataFrame({'Seed': pd.Series(dtype='int64'), 'Customer ID': pd.Series(dtype='int64'),
+                                 'Rank': pd.Series(dtype='int64'), 'Distance': pd.Series(dtype='float64')})
+
+        # One extra neighbour covers the seed itself, which ties may rank
+        # anywhere among identical vectors or push out of the result
+        distances, neighbours = self.tree.query(np.asarray(self.tree.data)[rows], k=k + 1)
+        keep = neighbours != rows[:, None]
+        keep[keep.all(axis=1), -1] = False
+
+        return pd.DataFrame({
+            'Seed': np.repeat(self.customer_ids[rows], k),
+            'Customer ID': self.customer_ids[neighbours[keep]],
+            'Rank': np.tile(np.arange(1, k + 1), len(rows)),
+            'Distance': distances[keep],
+        })
+
+    def audience(self, seed_ids, k=DEFAULT_NEIGHBOURS, exclude=(), max_fetch=MAX_FETCH):
+        """The k nearest customers of each seed that are neither seeds nor excluded, closest first
+
+        Neighbour lists are doubled until every seed has k eligible
+        neighbours or max_fetch is reached, so seeds deep inside a large
+        excluded group may contribute fewer. Each customer appears once,
+        with the seed it is closest to.
+        """
+        rows = self.rows(seed_ids)
+        ineligible = np.zeros(len(self), dtype=bool)
+        ineligible[self.rows(np.concatenate([np.asarray(seed_ids), np.asarray(exclude)]).astype(np.int64))] = True
+        limit = min(max_fetch, len(self))
+        if len(rows) == 0 or k < 1:
+            return pd.DataFrame({'Customer ID': pd.Series(dtype='int64'), 'Seed': pd.Series(dtype='int64'),
+                                 'Distance': pd.Series(dtype='float64')})
+
+        fetch = min(k, limit)
+        while True:
+            fetch = min(2 * fetch, limit)
+            distances, neighbours = self.tree.query(np.asarray(self.tree.data)[rows], k=fetch)
+            eligible = ~ineligible[neighbours]
+            if fetch == limit or (eligible.sum(axis=1) >= k).all():
+                break
+        eligible &= np.cumsum(eligible, axis=1) <= k
+
+        audience = pd.DataFrame({
+            'Customer ID': self.customer_ids[neighbours[eligible]],
+            'Seed': np.repeat(self.customer_ids[rows], eligible.sum(axis=1)),
+            'Distance': distances[eligible],
+        })
+        audience = audience.sort_values(['Distance', 'Customer ID'], kind='stable')
+        return audience.drop_duplicates('Customer ID').reset_index(drop=True)
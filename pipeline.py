@@ -0,0 +1,369 @@
+"""
+Headless batch pipeline for the customer analytics dashboard
+
+Runs load -> RFM -> CLTV -> KMeans clustering -> lookalike index -> basket
+affinity and writes every result table and model artifact to disk, so
+dashboard replicas only have to read them:
+
+    python pipeline.py --data data/canteen_shop_data.csv --output artifacts
+"""
+
+import argparse
+import json
+import os
+import shutil
+import time
+
+import joblib
+import numpy as np
+import pandas as pd
+
+from analytics import (
+    DATA_PATH,
+    RFM_RULES_PATH,
+    STREAMING_THRESHOLD_BYTES,
+    basket_lines,
+    build_customer_summary,
+    build_daily_cube,
+    calculate_cltv,
+    calculate_rfm,
+    cluster_model_path,
+    concentration_curve,
+    cube_dimensions,
+    dataset_overview,
+    filter_cube,
+    load_and_process_data,
+    load_segment_rules,
+    perform_kmeans_clustering,
+    refresh_customer_state,
+    refresh_rollup_state,
+    segment_transitions,
+    source_fingerprint,
+    summarize_cube,
+)
+from baskets import build_baskets, item_pair_metrics, segment_item_preferences
+from cltv_models import fit_cltv_models
+from instrumentation import metrics_log, row_count, track
+from lookalikes import LookalikeIndex
+from sql_source import SQLiteSource, is_sqlite_path
+
+ARTIFACTS_DIR = os.environ.get('CUSTOMER_ANALYTICS_ARTIFACTS', 'artifacts')
+# Bump when the artifact layout changes so stale outputs are not read
+ARTIFACT_VERSION = 9
+# Completed runs kept next to the current one
+KEEP_RUNS = 2
+
+ARTIFACT_TABLES = ['summary', 'rfm', 'cltv', 'clusters', 'centroid_drift', 'daily_cube', 'segment_transitions',
+                   'item_pairs', 'item_preferences']
+ARTIFACT_JSON = ['clustering', 'dimensions', 'concentration', 'cltv_model']
+# Model objects, stored with joblib
+ARTIFACT_MODELS = ['lookalike_index']
+
+def _json_default(value):
+    """Encode numpy scalars and timestamps in artifact JSON"""
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, pd.Timestamp):
+        return value.strftime('%Y-%m-%d')
+    raise TypeError(f'Cannot serialize {type(value).__name__}')
+
+def manifest_path(output_dir=ARTIFACTS_DIR):
+    """Location of the manifest pointing at the current run"""
+    return os.path.join(output_dir, 'manifest.json')
+
+def _rollup_state(context):
+    """Daily cube and basket lines of a large append-only export, refreshed once per context"""
+    if 'rollup_state' not in context:
+        # Only rows added since the last run are read
+        with track('refresh_rollup_state', kind='step') as record:
+            context['rollup_state'] = refresh_rollup_state(context['data_path'])
+            record['rows'] = len(context['rollup_state']['daily_cube'])
+    return context['rollup_state']
+
+def _summary(context):
+    """Per-customer summary of the source transactions"""
+    data_path = context['data_path']
+    if context['source'] is not None:
+        # Aggregated in the database; only one row per customer is read
+        with track('sql_customer_summary', kind='step') as record:
+            summary = context['source'].customer_summary()
+            record['rows'] = len(summary)
+        return summary
+    if os.path.getsize(data_path) > STREAMING_THRESHOLD_BYTES:
+        # Only rows added since the last run are read, into a summary bounded by the customers
+        with track('refresh_customer_state', kind='step') as record:
+            summary, _ = refresh_customer_state(data_path)
+            record['rows'] = len(summary)
+        return summary
+
+    with track('load_transactions', kind='step') as record:
+        df = load_and_process_data(data_path, context['fingerprint'])
+        record['rows'] = len(df)
+    with track('build_customer_summary', kind='step') as record:
+        summary = build_customer_summary(df)
+        record['rows'] = len(summary)
+    return summary
+
+def _daily_cube(context):
+    """Per-customer, per-day rollup used to re-derive results under filters"""
+    data_path = context['data_path']
+    if context['source'] is not None:
+        return context['source'].daily_cube()
+    if os.path.getsize(data_path) > STREAMING_THRESHOLD_BYTES:
+        return _rollup_state(context)['daily_cube']
+    return build_daily_cube(load_and_process_data(data_path, context['fingerprint']))
+
+def _baskets(context):
+    """Sparse basket and customer item matrices of the source transactions"""
+    data_path = context['data_path']
+    if context['source'] is not None:
+        lines = context['source'].basket_lines()
+    elif os.path.getsize(data_path) > STREAMING_THRESHOLD_BYTES:
+        lines = _rollup_state(context)['basket_lines']
+    else:
+        lines = basket_lines(load_and_process_data(data_path, context['fingerprint']))
+    return build_baskets(lines)
+
+def _item_preferences(context, baskets, clusters):
+    """Item preferences of the RFM segments and of the KMeans clusters
+
+    Clusters are grouped by ID, as several clusters can share a name, and
+    labelled "Cluster {id}: {name}" in ID order.
+    """
+    customers = clusters.set_index('Customer ID')
+    cluster_labels = 'Cluster ' + customers['KMeans_Cluster'].astype(str) + ': ' + customers['Cluster_Name']
+    label_order = cluster_labels.groupby(customers['KMeans_Cluster']).first().tolist()
+    by_cluster = segment_item_preferences(baskets, cluster_labels)
+    by_cluster = by_cluster.sort_values('Segment', key=lambda labels: labels.map(label_order.index),
+                                        kind='stable', ignore_index=True)
+    preferences = pd.concat({
+        'RFM Segment': segment_item_preferences(baskets, customers['Customer_Segment']),
+        'KMeans Cluster': by_cluster,
+    }, names=['Grouping'])
+    return preferences.reset_index(level='Grouping').reset_index(drop=True)
+
+def _rfm(context, summary):
+    """RFM scores and segments, using the configured rule table"""
+    return calculate_rfm(summary, load_segment_rules(context['rules_path']))
+
+def _kmeans(context, rfm):
+    """KMeans clustering, warm-started from the previous run on the same source"""
+    return perform_kmeans_clustering(rfm, model_path=cluster_model_path(context['data_path']))
+
+def _segment_transitions(context, cube):
+    """Month-to-month RFM segment migration, using the configured rule table"""
+    return segment_transitions(cube, rules=load_segment_rules(context['rules_path']))
+
+def _clustering(context, kmeans):
+    """JSON-friendly clustering info: K sweep, chosen K and quality"""
+    _, inertias, K_range, model_info = kmeans
+    clustering = {key: value for key, value in model_info.items() if key != 'centroid_drift'}
+    clustering['K_range'] = list(K_range)
+    clustering['inertias'] = list(inertias)
+    return clustering
+
+# Artifact dependency graph: name -> (dependencies, function of the context
+# and the resolved dependencies). Pages and the batch run resolve only the
+# names they need; everything upstream is computed once and memoized.
+ARTIFACT_GRAPH = {
+    'summary': ([], _summary),
+    'overview': (['summary'], lambda context, summary: dataset_overview(summary)),
+    'rfm': (['summary'], _rfm),
+    'cltv_model': (['summary'], lambda context, summary: fit_cltv_models(summary)),
+    'cltv': (['summary', 'cltv_model'], lambda context, summary, model: calculate_cltv(summary, params=model)),
+    'concentration': (['cltv'], lambda context, cltv: concentration_curve(cltv)),
+    'kmeans': (['rfm'], _kmeans),
+    'clusters': (['kmeans'], lambda context, kmeans: kmeans[0]),
+    'centroid_drift': (['kmeans'], lambda context, kmeans: kmeans[3]['centroid_drift']),
+    'clustering': (['kmeans'], _clustering),
+    'daily_cube': ([], _daily_cube),
+    'dimensions': (['daily_cube'], lambda context, cube: cube_dimensions(cube)),
+    'segment_transitions': (['daily_cube'], _segment_transitions),
+    'baskets': ([], _baskets),
+    'item_pairs': (['baskets'], lambda context, baskets: item_pair_metrics(baskets)),
+    'item_preferences': (['baskets', 'clusters'], _item_preferences),
+    # Built from the clusters, so a refreshed clustering always comes with a fresh index
+    'lookalike_index': (['clusters'], lambda context, clusters: LookalikeIndex.from_rfm(clusters)),
+}
+
+def pipeline_context(data_path=DATA_PATH, rules_path=RFM_RULES_PATH):
+    """Inputs shared by every artifact computation
+
+    A SQLite path gets one SQLiteSource, whose connection pool serves every
+    query of the run; release it with close_context.
+    """
+    return {
+        'data_path': data_path,
+        'rules_path': rules_path,
+        'fingerprint': source_fingerprint(data_path),
+        'source': SQLiteSource(data_path) if is_sqlite_path(data_path) else None,
+        'timings': {},
+    }
+
+def close_context(context):
+    """Close the connections the run opened on its data source"""
+    if context['source'] is not None:
+        context['source'].pool.close()
+
+def resolve_artifact(name, context, memo, resolve=None):
+    """Compute an artifact on demand, resolving its dependencies first
+
+    memo holds already computed artifacts. resolve, if given, is used to
+    look up dependencies instead (e.g. a cached function), so each one is
+    computed once and reused by later requests.
+    """
+    if name in memo:
+        return memo[name]
+
+    resolve = resolve or (lambda dependency: resolve_artifact(dependency, context, memo))
+    dependencies, compute = ARTIFACT_GRAPH[name]
+    args = [resolve(dependency) for dependency in dependencies]
+
+    with track(name, kind='artifact') as record:
+        memo[name] = compute(context, *args)
+        record['rows'] = row_count(memo[name])
+    context['timings'][name] = record['seconds']
+    return memo[name]
+
+# Artifacts that can be re-derived from a filtered slice of the daily cube
+FILTERABLE_ARTIFACTS = ['overview', 'rfm', 'cltv', 'concentration', 'clusters']
+# Models fitted on the full history once and reused to score filtered slices
+FULL_HISTORY_MODELS = ['cltv_model']
+
+def filter_summary(cube, start=None, end=None, selections=None):
+    """Customer summary of the transactions matching the filters, from the daily cube"""
+    return summarize_cube(filter_cube(cube, start, end, selections))
+
+def filtered_artifact(name, summary, context, resolve):
+    """A filterable artifact recomputed from a filtered customer summary
+
+    resolve looks up unfiltered artifacts. Models are not refitted: each
+    customer keeps the cluster fitted on the full history, with RFM values
+    from the filtered slice, and CLTV is scored with the FULL_HISTORY_MODELS
+    parameters.
+    """
+    memo = {'summary': summary}
+    if name == 'clusters':
+        assignment = resolve('clusters')[['Customer ID', 'KMeans_Cluster', 'Cluster_Name']]
+        return resolve_artifact('rfm', context, memo).merge(assignment, on='Customer ID')
+
+    def filtered_resolve(dependency):
+        if dependency in FULL_HISTORY_MODELS:
+            return resolve(dependency)
+        return resolve_artifact(dependency, context, memo, filtered_resolve)
+
+    return resolve_artifact(name, context, memo, filtered_resolve)
+
+def compute_artifacts(data_path=DATA_PATH, rules_path=RFM_RULES_PATH):
+    """Run the full analytics pipeline and return its result tables"""
+    context = pipeline_context(data_path, rules_path)
+    memo = {}
+    try:
+        artifacts = {name: resolve_artifact(name, context, memo)
+                     for name in ARTIFACT_TABLES + ARTIFACT_JSON + ARTIFACT_MODELS + ['overview']}
+    finally:
+        close_context(context)
+    artifacts.update({
+        'source': os.path.abspath(data_path),
+        'fingerprint': context['fingerprint'],
+        'timings': context['timings'],
+    })
+    return artifacts
+
+def write_artifacts(artifacts, output_dir=ARTIFACTS_DIR):
+    """Write a run into its own directory and switch the manifest to it
+
+    Readers always follow the manifest, which is replaced atomically, so a
+    dashboard never sees a half-written run.
+    """
+    run_id = time.strftime('%Y%m%d-%H%M%S') + f"-{artifacts['fingerprint'][:8]}"
+    run_dir = os.path.join(output_dir, run_id)
+    os.makedirs(run_dir, exist_ok=True)
+
+    for name in ARTIFACT_TABLES:
+        artifacts[name].to_parquet(os.path.join(run_dir, f'{name}.parquet'), index=False)
+    for name in ARTIFACT_JSON:
+        with open(os.path.join(run_dir, f'{name}.json'), 'w') as f:
+            json.dump(artifacts[name], f, default=_json_default, indent=2)
+    for name in ARTIFACT_MODELS:
+        joblib.dump(artifacts[name], os.path.join(run_dir, f'{name}.joblib'))
+
+    manifest = {
+        'version': ARTIFACT_VERSION,
+        'run': run_id,
+        'created_at': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'source': artifacts['source'],
+        'fingerprint': artifacts['fingerprint'],
+        'overview': artifacts['overview'],
+        'timings': artifacts['timings'],
+    }
+    tmp_path = f'{manifest_path(output_dir)}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, default=_json_default, indent=2)
+    os.replace(tmp_path, manifest_path(output_dir))
+
+    # Prune older runs, keeping the newest few for readers still on them
+    runs = sorted(entry for entry in os.listdir(output_dir)
+                  if os.path.isdir(os.path.join(output_dir, entry)))
+    for old_run in runs[:-KEEP_RUNS]:
+        if old_run != run_id:
+            shutil.rmtree(os.path.join(output_dir, old_run), ignore_errors=True)
+
+    return manifest
+
+def read_manifest(output_dir=ARTIFACTS_DIR):
+    """The current manifest, or None when no compatible run exists"""
+    path = manifest_path(output_dir)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        manifest = json.load(f)
+    return manifest if manifest.get('version') == ARTIFACT_VERSION else None
+
+def read_artifact(name, manifest, output_dir=ARTIFACTS_DIR):
+    """Read one artifact of the run the manifest points at"""
+    if name == 'overview':
+        return manifest['overview']
+    run_dir = os.path.join(output_dir, manifest['run'])
+    if name in ARTIFACT_TABLES:
+        return pd.read_parquet(os.path.join(run_dir, f'{name}.parquet'))
+    if name in ARTIFACT_MODELS:
+        return joblib.load(os.path.join(run_dir, f'{name}.joblib'))
+    with open(os.path.join(run_dir, f'{name}.json')) as f:
+        return json.load(f)
+
+def load_artifacts(output_dir=ARTIFACTS_DIR):
+    """Read the tables and model info of the current run"""
+    manifest = read_manifest(output_dir)
+    if manifest is None:
+        return None
+
+    artifacts = {name: read_artifact(name, manifest, output_dir)
+                 for name in ARTIFACT_TABLES + ARTIFACT_JSON + ARTIFACT_MODELS + ['overview']}
+    artifacts['manifest'] = manifest
+
+    return artifacts
+
+def run_pipeline(data_path=DATA_PATH, output_dir=ARTIFACTS_DIR, rules_path=RFM_RULES_PATH):
+    """Compute all artifacts and publish them to output_dir"""
+    artifacts = compute_artifacts(data_path, rules_path)
+    return write_artifacts(artifacts, output_dir)
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the customer analytics batch pipeline.')
+    parser.add_argument('--data', default=DATA_PATH, help='transaction CSV or SQLite database (default: %(default)s)')
+    parser.add_argument('--output', default=ARTIFACTS_DIR, help='artifact directory (default: %(default)s)')
+    parser.add_argument('--rules', default=RFM_RULES_PATH, help='optional RFM segment rules CSV')
+    parser.add_argument('--metrics-log', default=metrics_log.path,
+                        help='append per-stage timing records to this JSON-lines file')
+    args = parser.parse_args()
+    metrics_log.path = args.metrics_log
+
+    manifest = run_pipeline(args.data, args.output, args.rules)
+
+    print(f"Wrote run {manifest['run']} to {args.output}")
+    for stage, seconds in manifest['timings'].items():
+        print(f"  {stage:<16} {seconds:8.2f}s")
+
+if __name__ == "__main__":
+    main()
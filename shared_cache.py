@@ -0,0 +1,163 @@
+"""
+Persistent cache of computed artifacts shared by every worker on a host
+
+Streamlit's own caches live in one process, so each replica and each restart
+would recompute the pipeline. Entries here are pickled into a SQLite file
+keyed by the source fingerprint, the artifact and the code version, evicted
+by age and total size, and computed by only one worker at a time: the others
+wait on a per-key file lock and then read the stored result.
+"""
+
+import functools
+import hashlib
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+
+from analytics import CACHE_DIR
+
+try:
+    import fcntl
+except ImportError:  # Windows: locking is per process only
+    fcntl = None
+
+SHARED_CACHE_PATH = os.environ.get('CUSTOMER_ANALYTICS_SHARED_CACHE', os.path.join(CACHE_DIR, 'shared_cache.sqlite'))
+SHARED_CACHE_MAX_BYTES = int(os.environ.get('CUSTOMER_ANALYTICS_SHARED_CACHE_MB', 1024)) * 1024 ** 2
+SHARED_CACHE_TTL_SECONDS = int(os.environ.get('CUSTOMER_ANALYTICS_SHARED_CACHE_TTL', 7 * 24 * 3600))
+# Modules whose code determines the artifacts; editing one invalidates the cache
+CODE_MODULES = ['analytics.py', 'pipeline.py', 'cltv_models.py', 'sketches.py', 'baskets.py',
+                'lookalikes.py']
+
+@functools.lru_cache(maxsize=None)
+def code_version(modules=tuple(CODE_MODULES)):
+    """Hash of the source of the modules that compute artifacts"""
+    digest = hashlib.blake2b(digest_size=16)
+    directory = os.path.dirname(os.path.abspath(__file__))
+    for module in modules:
+        with open(os.path.join(directory, module), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+class CacheBackend(ABC):
+    """Key-value store for pickled artifacts with single-flight computation
+
+    Backends implement get, put and lock; get_or_compute ties them together.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    def make_key(self, fingerprint, name, version=None):
+        """Cache key for an artifact of a given dataset and code version"""
+        version = version or code_version()
+        return hashlib.blake2b(f'{fingerprint}:{name}:{version}'.encode(), digest_size=16).hexdigest()
+
+    @abstractmethod
+    def get(self, key):
+        """(True, value) if key is stored and fresh, else (False, None)"""
+
+    @abstractmethod
+    def put(self, key, value):
+        """Store a value under key"""
+
+    @abstractmethod
+    def lock(self, key):
+        """Context manager held while computing key, exclusive across workers"""
+
+    def get_or_compute(self, key, compute):
+        """Return the stored value, calling compute() only on a miss
+
+        A worker that misses takes the key's lock and looks again before
+        computing, so concurrent misses compute once. Returns the value and
+        whether it came from the cache.
+        """
+        found, value = self.get(key)
+        if not found:
+            with self.lock(key):
+                found, value = self.get(key)
+                if not found:
+                    value = compute()
+                    self.put(key, value)
+        if found:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return value, found
+
+class SQLiteCache(CacheBackend):
+    """Cache backend in a local SQLite file, evicting expired then least recently used entries"""
+
+    def __init__(self, path=SHARED_CACHE_PATH, max_bytes=SHARED_CACHE_MAX_BYTES, ttl=SHARED_CACHE_TTL_SECONDS):
+        super().__init__()
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.lock_dir = path + '.locks'
+        self._thread_lock = threading.RLock()
+        os.makedirs(self.lock_dir, exist_ok=True)
+        with self._connect() as db:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value BLOB NOT NULL, '
+                       'size INTEGER NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)')
+
+    @contextmanager
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=60)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def get(self, key):
+        now = time.time()
+        with self._connect() as db:
+            row = db.execute('SELECT value FROM entries WHERE key = ? AND created > ?',
+                             (key, now - self.ttl)).fetchone()
+            if row is None:
+                return False, None
+            db.execute('UPDATE entries SET accessed = ? WHERE key = ?', (now, key))
+        return True, pickle.loads(row[0])
+
+    def put(self, key, value):
+        """Store a value, then evict expired entries and the least recently used over budget"""
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(blob) > self.max_bytes:
+            return
+        now = time.time()
+        with self._connect() as db:
+            db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)', (key, blob, len(blob), now, now))
+            db.execute('DELETE FROM entries WHERE created <= ?', (now - self.ttl,))
+            # Keep the most recently used entries that fit in the budget
+            db.execute('DELETE FROM entries WHERE key IN (SELECT key FROM (SELECT key, SUM(size) OVER '
+                       '(ORDER BY accessed DESC, key) AS running FROM entries) WHERE running > ?)',
+                       (self.max_bytes,))
+
+    @contextmanager
+    def lock(self, key):
+        # flock conflicts between separate open() calls, so this also
+        # serializes threads of one process. Without flock (Windows) one
+        # re-entrant lock serializes computation within the process. Lock
+        # files are never deleted: a worker may have opened one and be about
+        # to flock it, and a new file at the same path would not exclude it.
+        if fcntl is None:
+            with self._thread_lock:
+                yield
+            return
+        with open(os.path.join(self.lock_dir, f'{key}.lock'), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def stats(self):
+        """Entries and total bytes currently stored"""
+        with self._connect() as db:
+            count, size = db.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries').fetchone()
+        return {'entries': count, 'bytes': size}
@@ -0,0 +1,109 @@
+"""
+Mergeable quantile sketches
+
+A KLL-style sketch keeps a few hundred weighted samples of a numeric column
+in compactors of increasing weight. Sketches built on separate partitions
+or stream chunks merge into one that answers quantile and rank queries over
+all of the data with a bounded rank error.
+"""
+
+import numpy as np
+
+# Sketch size; the normalized rank error shrinks roughly as 1/k
+DEFAULT_K = 200
+# Each compactor below the top holds 2/3 of the capacity of the one above
+CAPACITY_DECAY = 2 / 3
+
+class KLLSketch:
+    """Mergeable approximate-quantile sketch of a numeric column"""
+
+    def __init__(self, k=DEFAULT_K, seed=None):
+        self.k = k
+        self.n = 0
+        self.levels = [np.empty(0)]
+        self._rng = np.random.default_rng(seed)
+
+    def _capacity(self, level):
+        depth = len(self.levels) - level - 1
+        return max(2, int(np.ceil(self.k * CAPACITY_DECAY ** depth)))
+
+    def _compress(self):
+        """Compact levels until the sketch fits its total capacity
+
+        The lowest over-capacity level is sorted and every other item (from
+        a random offset) is promoted at double weight, which keeps ranks
+        unbiased. Compacting lazily, only while the sketch is over its total
+        capacity, keeps as many samples as the budget allows.
+        """
+        while sum(map(len, self.levels)) > sum(map(self._capacity, range(len(self.levels)))):
+            level = next(level for level, items in enumerate(self.levels)
+                         if len(items) > self._capacity(level))
+            if level + 1 == len(self.levels):
+                self.levels.append(np.empty(0))
+            items = np.sort(self.levels[level])
+            # An odd item out stays at this level
+            keep, items = (items[-1:], items[:-1]) if len(items) % 2 else (items[:0], items)
+            promoted = items[self._rng.integers(2)::2]
+            self.levels[level + 1] = np.concatenate([self.levels[level + 1], promoted])
+            self.levels[level] = keep
+
+    def update(self, values):
+        """Add a batch of values, ignoring NaNs"""
+        values = np.asarray(values, dtype=float).ravel()
+        values = values[~np.isnan(values)]
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self.n += len(values)
+        self._compress()
+        return self
+
+    def merge(self, other):
+        """Fold another sketch, e.g. from a different partition, into this one"""
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty(0))
+        for level, items in enumerate(other.levels):
+            self.levels[level] = np.concatenate([self.levels[level], items])
+        self.n += other.n
+        self._compress()
+        return self
+
+    def _weighted_items(self):
+        items = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(level), 2.0 ** height)
+                                  for height, level in enumerate(self.levels)])
+        order = np.argsort(items, kind='stable')
+        return items[order], np.cumsum(weights[order])
+
+    def quantiles(self, fractions):
+        """Approximate values at the given quantile fractions"""
+        items, cumulative = self._weighted_items()
+        ranks = np.asarray(fractions, dtype=float) * cumulative[-1]
+        return items[np.minimum(np.searchsorted(cumulative, ranks, side='left'), len(items) - 1)]
+
+    def ranks(self, values, inclusive=True):
+        """Approximate fraction of the data <= each value (< if not inclusive)"""
+        items, cumulative = self._weighted_items()
+        positions = np.searchsorted(items, np.asarray(values, dtype=float),
+                                    side='right' if inclusive else 'left')
+        total = cumulative[-1]
+        return np.where(positions > 0, cumulative[np.maximum(positions - 1, 0)], 0.0) / total
+
+    def rank_error_bound(self):
+        """Normalized rank error this sketch stays within with ~99% confidence
+
+        Empirical KLL constant (Karnin, Lang & Liberty; Apache DataSketches):
+        about 1.3% at k=200. Exact while nothing has been compacted yet.
+        """
+        if len(self.levels) == 1:
+            return 0.0
+        return 2.296 / self.k ** 0.9723
+
+    def to_dict(self):
+        """JSON-friendly form, for shipping sketches between workers"""
+        return {'k': self.k, 'n': self.n, 'levels': [level.tolist() for level in self.levels]}
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls(data['k'])
+        sketch.n = data['n']
+        sketch.levels = [np.asarray(level, dtype=float) for level in data['levels']]
+        return sketch
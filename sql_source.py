@@ -0,0 +1,172 @@
+"""
+Transactions in a SQL database, aggregated where they are stored
+
+The cleaning filters and the per-customer and daily aggregations run as SQL,
+so only the per-customer summary, the daily cube and the distinct basket
+lines travel to Python. The results match the pandas path on the same
+transactions. SQLite is the local
+implementation; other databases subclass SQLSource:
+
+    python sql_source.py --csv data/canteen_shop_data.csv --output data/transactions.sqlite
+    python pipeline.py --data data/transactions.sqlite
+"""
+
+import argparse
+import os
+import queue
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from contextlib import closing, contextmanager
+
+import pandas as pd
+
+from analytics import (
+    CHUNK_SIZE,
+    CUBE_DIMENSIONS,
+    TRANSACTION_DTYPES,
+    compact_transactions,
+    finalize_daily,
+    finalize_summary,
+    source_fingerprint,
+)
+
+TRANSACTIONS_TABLE = 'transactions'
+# Data paths with these extensions are read as SQLite databases
+SQLITE_EXTENSIONS = ('.sqlite', '.sqlite3', '.db')
+# Connections kept open per source
+POOL_SIZE = 4
+
+def is_sqlite_path(path):
+    """Whether a data path names a SQLite database rather than a CSV export"""
+    return os.path.splitext(path)[1].lower() in SQLITE_EXTENSIONS
+
+def quote(identifier):
+    """Quote a column or table name, which may contain spaces"""
+    return '"' + identifier.replace('"', '""') + '"'
+
+class ConnectionPool:
+    """Up to size connections, opened on demand and reused across threads"""
+
+    def __init__(self, connect, size=POOL_SIZE):
+        self._connect = connect
+        self.size = size
+        self._idle = queue.LifoQueue()
+        # Connections currently open, idle or borrowed
+        self.opened = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection, waiting for one if all are in use"""
+        try:
+            conn = self._idle.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                conn = self._connect() if self.opened < self.size else None
+                self.opened += conn is not None
+            if conn is None:
+                conn = self._idle.get()
+        try:
+            yield conn
+        finally:
+            self._idle.put(conn)
+
+    def close(self):
+        """Close the idle connections; borrowed ones stay open until returned"""
+        while not self._idle.empty():
+            self._idle.get_nowait().close()
+            self.opened -= 1
+
+class SQLSource(ABC):
+    """Transactions table in a SQL database
+
+    Subclasses provide _connect and fingerprint; the queries use standard
+    SQL with '?' parameters.
+    """
+
+    def __init__(self, table=TRANSACTIONS_TABLE, pool_size=POOL_SIZE):
+        self.table = table
+        self.pool = ConnectionPool(self._connect, pool_size)
+
+    @abstractmethod
+    def _connect(self):
+        """Open a new DB-API connection"""
+
+    @abstractmethod
+    def fingerprint(self):
+        """Changes whenever the stored transactions change"""
+
+    def query(self, sql, params=()):
+        with self.pool.connection() as conn:
+            return pd.read_sql_query(sql, conn, params=params)
+
+    def _cleaned(self):
+        """FROM/WHERE clause of the cleaned transactions, as clean_transactions filters them"""
+        return (f'FROM {quote(self.table)} WHERE {quote("Quantity")} > 0 AND {quote("Price")} > 0 '
+                f'AND {quote("Customer ID")} IS NOT NULL')
+
+    def customer_summary(self):
+        """Customer summary aggregated in the database, as build_customer_summary builds it"""
+        partial = self.query(
+            f'SELECT {quote("Customer ID")} AS {quote("Customer ID")}, '
+            f'MIN({quote("Date")}) AS FirstPurchase, MAX({quote("Date")}) AS LastPurchase, '
+            f'COUNT({quote("Item")}) AS NumPurchases, COUNT(DISTINCT {quote("Date")}) AS PurchaseDays, '
+            f'SUM({quote("Total")}) AS TotalRevenue '
+            f'{self._cleaned()} GROUP BY {quote("Customer ID")} ORDER BY {quote("Customer ID")}'
+        )
+        partial['FirstPurchase'] = pd.to_datetime(partial['FirstPurchase'])
+        partial['LastPurchase'] = pd.to_datetime(partial['LastPurchase'])
+        return finalize_summary(partial.set_index('Customer ID'))
+
+    def daily_cube(self):
+        """Daily rollup cube aggregated in the database, as build_daily_cube builds it"""
+        keys = ', '.join(quote(column) for column in ['Customer ID', 'Date', *CUBE_DIMENSIONS])
+        rollup = self.query(
+            f'SELECT {keys}, COUNT({quote("Item")}) AS Purchases, SUM({quote("Total")}) AS Revenue '
+            f'{self._cleaned()} GROUP BY {keys}'
+        )
+        return finalize_daily(compact_transactions(rollup))
+
+    def basket_lines(self):
+        """Distinct basket lines selected in the database, as baskets.basket_lines builds them"""
+        keys = ', '.join(quote(column) for column in ['Customer ID', 'Date', 'Time', 'Item'])
+        lines = self.query(f'SELECT DISTINCT {keys} {self._cleaned()}')
+        return compact_transactions(lines)
+
+class SQLiteSource(SQLSource):
+    """Transactions in a local SQLite file, opened read-only"""
+
+    def __init__(self, path, table=TRANSACTIONS_TABLE, pool_size=POOL_SIZE):
+        self.path = path
+        super().__init__(table, pool_size)
+
+    def _connect(self):
+        return sqlite3.connect(f'file:{os.path.abspath(self.path)}?mode=ro', uri=True, check_same_thread=False)
+
+    def fingerprint(self):
+        return source_fingerprint(self.path)
+
+def write_transactions_sqlite(csv_path, db_path, table=TRANSACTIONS_TABLE, chunksize=CHUNK_SIZE):
+    """Load a transactions CSV into a SQLite table indexed for the customer aggregation"""
+    # The connection's own context manager only commits; closing() releases it
+    with closing(sqlite3.connect(db_path)) as conn, conn:
+        conn.execute(f'DROP TABLE IF EXISTS {quote(table)}')
+        for chunk in pd.read_csv(csv_path, dtype=TRANSACTION_DTYPES, chunksize=chunksize):
+            chunk.to_sql(table, conn, if_exists='append', index=False)
+        # Covers the summary query, which then reads customers in index order
+        columns = ', '.join(quote(column) for column in ['Customer ID', 'Date', 'Quantity', 'Price', 'Item', 'Total'])
+        conn.execute(f'CREATE INDEX {quote(f"{table}_customer")} ON {quote(table)} ({columns})')
+
+def main():
+    parser = argparse.ArgumentParser(description='Load a transactions CSV into a SQLite database.')
+    parser.add_argument('--csv', required=True, help='transactions CSV to load')
+    parser.add_argument('--output', required=True, help='SQLite database to write')
+    parser.add_argument('--table', default=TRANSACTIONS_TABLE, help='table name (default: %(default)s)')
+    args = parser.parse_args()
+
+    write_transactions_sqlite(args.csv, args.output, args.table)
+    print(f"Loaded {args.csv} into table {args.table} of {args.output}")
+
+if __name__ == "__main__":
+    main()
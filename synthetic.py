@@ -0,0 +1,100 @@
+"""
+Synthetic canteen transactions for scaling tests
+
+Generates data with the same schema and formatting as
+data/canteen_shop_data.csv at any size:
+
+    python synthetic.py --rows 1000000 --customers 100000 --output data/synthetic_1m.csv
+"""
+
+import argparse
+
+import numpy as np
+import pandas as pd
+
+# Menu, popularity weights and prices of the real canteen data
+ITEM_PRICES = {'Sandwich': 4.50, 'Drink': 1.50, 'Salad': 5.00, 'Burger': 5.50}
+ITEM_WEIGHTS = [0.30, 0.35, 0.15, 0.20]
+PAYMENT_METHODS = ['Cash', 'Card', 'Mobile Payment']
+PAYMENT_WEIGHTS = [0.30, 0.35, 0.35]
+WEATHER = ['Sunny', 'Cloudy', 'Rainy']
+WEATHER_WEIGHTS = [0.40, 0.35, 0.25]
+# Lunch service in 15-minute slots, busiest around 12:30
+TIME_SLOTS = [f'{hour}:{minute:02d}' for hour in range(11, 15) for minute in (0, 15, 30, 45)]
+TIME_WEIGHTS = np.exp(-0.5 * ((np.arange(len(TIME_SLOTS)) - 6) / 3) ** 2)
+SATISFACTION_WEIGHTS = [0.03, 0.07, 0.25, 0.35, 0.30]
+N_EMPLOYEES = 200
+# Rows formatted and written per to_csv call
+WRITE_CHUNK_ROWS = 1_000_000
+
+def generate_transactions(n_rows, n_customers, start_date='2024-04-01', days=365, seed=0):
+    """Synthetic transactions in the canteen CSV schema, sorted by date and time
+
+    Customer activity is skewed (a few regulars make most purchases), each
+    customer is active from a random first visit for an exponentially
+    distributed lifespan, and items, quantities and times follow the menu.
+    """
+    rng = np.random.default_rng(seed)
+    n_customers = min(n_customers, n_rows)
+
+    # Heavy-tailed purchase propensity; every customer buys at least once
+    propensity = rng.lognormal(mean=0.0, sigma=1.2, size=n_customers)
+    customer = np.concatenate([
+        rng.permutation(n_customers),
+        rng.choice(n_customers, size=n_rows - n_customers, p=propensity / propensity.sum()),
+    ])
+
+    # Activity window per customer: first visit, then a lifespan before churn
+    first_day = rng.integers(0, days, size=n_customers)
+    lifespan = np.minimum(rng.exponential(scale=days / 3, size=n_customers), days - first_day)
+    day = first_day[customer] + (rng.random(n_rows) * lifespan[customer]).astype(np.int64)
+    slot = rng.choice(len(TIME_SLOTS), size=n_rows, p=TIME_WEIGHTS / TIME_WEIGHTS.sum())
+
+    order = np.lexsort((slot, day))
+    customer, day, slot = customer[order], day[order], slot[order]
+
+    items = np.array(list(ITEM_PRICES))
+    item = rng.choice(len(items), size=n_rows, p=ITEM_WEIGHTS)
+    price = np.array(list(ITEM_PRICES.values()))[item]
+    quantity = np.minimum(rng.geometric(p=0.65, size=n_rows), 5)
+    dates = pd.date_range(start_date, periods=days).strftime('%Y-%m-%d').to_numpy()
+    weather_by_day = rng.choice(WEATHER, size=days, p=WEATHER_WEIGHTS)
+
+    return pd.DataFrame({
+        'Date': dates[day],
+        'Time': np.array(TIME_SLOTS)[slot],
+        'Item': items[item],
+        'Price': price,
+        'Quantity': quantity,
+        'Total': price * quantity,
+        'Customer ID': customer + 1,
+        'Payment Method': rng.choice(PAYMENT_METHODS, size=n_rows, p=PAYMENT_WEIGHTS),
+        'Employee ID': rng.integers(101, 101 + N_EMPLOYEES, size=n_rows),
+        'Customer Satisfaction': rng.choice(np.arange(1, 6), size=n_rows, p=SATISFACTION_WEIGHTS),
+        'Weather': weather_by_day[day],
+        'Special Offers': np.where(rng.random(n_rows) < 0.5, 'Yes', 'No'),
+    })
+
+def write_transactions_csv(df, path, chunk_rows=WRITE_CHUNK_ROWS):
+    """Write transactions formatted like the source export"""
+    for start in range(0, len(df), chunk_rows):
+        chunk = df.iloc[start:start + chunk_rows].copy()
+        chunk['Customer ID'] = chunk['Customer ID'].astype(str).str.zfill(3)
+        chunk.to_csv(path, mode='w' if start == 0 else 'a', header=start == 0, index=False,
+                      float_format='%.2f')
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate synthetic canteen transactions.')
+    parser.add_argument('--rows', type=int, default=100_000, help='number of transactions (default: %(default)s)')
+    parser.add_argument('--customers', type=int, default=10_000, help='number of customers (default: %(default)s)')
+    parser.add_argument('--days', type=int, default=365, help='days covered (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed (default: %(default)s)')
+    parser.add_argument('--output', required=True, help='CSV file to write')
+    args = parser.parse_args()
+
+    df = generate_transactions(args.rows, args.customers, days=args.days, seed=args.seed)
+    write_transactions_csv(df, args.output)
+    print(f"Wrote {len(df):,} transactions for {df['Customer ID'].nunique():,} customers to {args.output}")
+
+if __name__ == "__main__":
+    main()
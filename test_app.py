@@ -2,10 +2,75 @@
 Test script to verify app.py functions work correctly
 """
 
+import glob
+import json
+import os
+import tempfile
+import threading
+import time
+
+import matplotlib.pyplot as plt
 import pandas as pd
 import numpy as np
-from sklearn.cluster import KMeans
-from sklearn.preprocessing import StandardScaler
+
+# Keep the test runs' caches and cluster models out of the project's .cache
+cache_dir = tempfile.TemporaryDirectory()
+os.environ['CUSTOMER_ANALYTICS_CACHE_DIR'] = cache_dir.name
+
+from analytics import (
+    DATA_PATH,
+    RFM_DEFAULT_SEGMENT,
+    RFM_SEGMENT_RULES,
+    ROLLUP_TABLES,
+    basket_lines,
+    build_customer_summary,
+    build_daily_cube,
+    calculate_cltv,
+    calculate_rfm,
+    cluster_model_path,
+    cohort_matrices,
+    concentration_curve,
+    customer_state_manifest_path,
+    evaluate_segment_rules,
+    load_and_process_data,
+    load_segment_rules,
+    merge_rfm_sketches,
+    name_clusters,
+    perform_kmeans_clustering,
+    refresh_customer_state,
+    refresh_rollup_state,
+    rfm_sketch_error,
+    rfm_values,
+    rolling_customer_summaries,
+    rolling_rfm,
+    rollup_state_manifest_path,
+    rules_fingerprint,
+    segment_transitions,
+    snapshot_dates,
+    sketch_rfm,
+    source_fingerprint,
+    stratified_sample,
+    transaction_cache_path,
+)
+from baskets import build_baskets, item_pair_metrics, segment_item_preferences
+import cltv_models
+from cltv_models import bgnbd_log_likelihood, predict_cltv, sufficient_statistics
+from figure_cache import FigureCache
+from instrumentation import collect, metrics_log
+from lookalikes import LookalikeIndex
+from pipeline import (
+    close_context,
+    compute_artifacts,
+    filter_summary,
+    filtered_artifact,
+    load_artifacts,
+    pipeline_context,
+    resolve_artifact,
+    run_pipeline,
+)
+from shared_cache import SHARED_CACHE_PATH, CacheBackend, SQLiteCache
+from sql_source import SQLiteSource, SQLSource, write_transactions_sqlite
+from synthetic import generate_transactions, write_transactions_csv
 
 print("="*60)
 print("TESTING CUSTOMER ANALYTICS APP")
@@ -14,9 +79,15 @@ print("="*60)
 # Test 1: Load Data
 print("\n[TEST 1] Loading data...")
 try:
-    df = pd.read_csv('data/canteen_shop_data.csv')
+    df = load_and_process_data(DATA_PATH)
+
+    assert isinstance(df['Item'].dtype, pd.CategoricalDtype)
+    assert pd.api.types.is_datetime64_any_dtype(df['Date'])
+    assert df['Customer ID'].dtype == 'Int32'
+
     print(f"[OK] Data loaded: {df.shape}")
     print(f"  Columns: {list(df.columns)}")
+    print(f"  Memory: {df.memory_usage(deep=True).sum() / 1024:.1f} KB")
 except Exception as e:
     print(f"[ERROR] Error loading data: {e}")
     exit(1)
@@ -24,10 +95,21 @@ except Exception as e:
 # Test 2: Clean Data
 print("\n[TEST 2] Cleaning data...")
 try:
-    df_clean = df.copy()
-    df_clean = df_clean[df_clean['Quantity'] > 0]
-    df_clean = df_clean[df_clean['Price'] > 0]
-    df_clean['TotalPrice'] = df_clean['Quantity'] * df_clean['Price']
+    df_clean = df
+    assert (df_clean['Quantity'] > 0).all() and (df_clean['Price'] > 0).all()
+    assert np.allclose(df_clean['TotalPrice'], df_clean['Quantity'] * df_clean['Price'])
+    assert pd.api.types.is_integer_dtype(df_clean['Quantity'])
+
+    # Fractional or oversized quantities keep a type that holds them
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for quantity, dtype in [(1.5, 'float64'), (40_000, 'int32')]:
+            raw = pd.read_csv(DATA_PATH, nrows=20, dtype={'Quantity': 'float64'})
+            raw.loc[0, 'Quantity'] = quantity
+            odd_path = os.path.join(tmp_dir, f'quantity-{dtype}.csv')
+            raw.to_csv(odd_path, index=False)
+            odd = load_and_process_data(odd_path)
+            assert odd['Quantity'].dtype == dtype and odd['Quantity'].iloc[0] == quantity, odd['Quantity'].dtype
+            assert np.isclose(odd['TotalPrice'].iloc[0], quantity * odd['Price'].iloc[0], rtol=1e-6)
     print(f"[OK] Data cleaned: {df_clean.shape}")
     print(f"  Unique customers: {df_clean['Customer ID'].nunique()}")
 except Exception as e:
@@ -37,43 +119,11 @@ except Exception as e:
 # Test 3: RFM Analysis
 print("\n[TEST 3] Calculating RFM metrics...")
 try:
-    snapshot_date = pd.to_datetime(df_clean['Date']).max() + pd.Timedelta(days=1)
-
-    rfm = df_clean.groupby('Customer ID').agg({
-        'Date': lambda x: (snapshot_date - pd.to_datetime(x.max())).days,
-        'Item': 'count',
-        'Total': 'sum'
-    }).reset_index()
-
-    rfm.columns = ['Customer ID', 'Recency', 'Frequency', 'Monetary']
-
-    # Create RFM Scores
-    rfm['R_Score'] = pd.qcut(rfm['Recency'], 5, labels=[5, 4, 3, 2, 1])
-    rfm['F_Score'] = pd.qcut(rfm['Frequency'].rank(method='first'), 5, labels=[1, 2, 3, 4, 5])
-    rfm['M_Score'] = pd.qcut(rfm['Monetary'], 3, labels=[1, 2, 3], duplicates='drop')
-
-    rfm['RFM_Segment'] = rfm['R_Score'].astype(int) + rfm['F_Score'].astype(int) + rfm['M_Score'].astype(int)
-
-    # Segment customers
-    def segment_customer(row):
-        if row['RFM_Segment'] >= 10 and row['R_Score'] >= 4:
-            return 'Champions'
-        elif row['RFM_Segment'] >= 7 and row['R_Score'] >= 3:
-            return 'Loyal Customers'
-        elif row['F_Score'] >= 3 and row['R_Score'] >= 3:
-            return 'Potential Loyalists'
-        elif row['R_Score'] >= 4:
-            return 'Recent Customers'
-        elif row['RFM_Segment'] >= 6 and row['R_Score'] <= 2:
-            return 'At Risk'
-        elif row['F_Score'] >= 2 and row['R_Score'] <= 2:
-            return 'Cant Lose Them'
-        elif row['R_Score'] <= 2:
-            return 'Lost'
-        else:
-            return 'Others'
+    summary = build_customer_summary(df_clean)
+    rfm = calculate_rfm(summary)
 
-    rfm['Customer_Segment'] = rfm.apply(segment_customer, axis=1)
+    assert len(rfm) == df_clean['Customer ID'].nunique()
+    assert rfm['Frequency'].sum() == len(df_clean)
 
     print(f"[OK]RFM calculated: {rfm.shape}")
     print(f"  Segments: {rfm['Customer_Segment'].nunique()}")
@@ -89,18 +139,9 @@ except Exception as e:
 # Test 4: CLTV Calculation
 print("\n[TEST 4] Calculating CLTV...")
 try:
-    cltv_data = df_clean.groupby('Customer ID').agg({
-        'Item': 'count',
-        'Total': 'sum',
-        'Date': lambda x: (pd.to_datetime(x.max()) - pd.to_datetime(x.min())).days
-    }).reset_index()
+    cltv_data = calculate_cltv(summary)
 
-    cltv_data.columns = ['Customer ID', 'NumPurchases', 'TotalRevenue', 'CustomerLifespan']
-
-    cltv_data['AvgOrderValue'] = cltv_data['TotalRevenue'] / cltv_data['NumPurchases']
-    cltv_data['PurchaseFrequency'] = cltv_data['NumPurchases'] / (cltv_data['CustomerLifespan'] + 1) * 365
-    cltv_data['CustomerLifespanYears'] = (cltv_data['CustomerLifespan'] + 1) / 365
-    cltv_data['CLTV'] = cltv_data['AvgOrderValue'] * cltv_data['PurchaseFrequency'] * cltv_data['CustomerLifespanYears']
+    assert np.isclose(cltv_data['TotalRevenue'].sum(), df_clean['Total'].sum())
 
     print(f"[OK]CLTV calculated: {cltv_data.shape}")
     print(f"  Average CLTV: ${cltv_data['CLTV'].mean():.2f}")
@@ -114,24 +155,29 @@ except Exception as e:
 # Test 5: KMeans Clustering
 print("\n[TEST 5] Performing KMeans clustering...")
 try:
-    X = rfm[['Recency', 'Frequency', 'Monetary']].copy()
-    X['Monetary'] = np.log1p(X['Monetary'])
+    rfm, inertias, K_range, model_info = perform_kmeans_clustering(rfm)
+    optimal_k = model_info['optimal_k']
 
-    scaler = StandardScaler()
-    X_scaled = scaler.fit_transform(X)
+    assert rfm['KMeans_Cluster'].nunique() == optimal_k
+    assert len(inertias) == len(K_range)
 
-    # Elbow method
-    inertias = []
-    K_range = range(2, 11)
-    for k in K_range:
-        kmeans = KMeans(n_clusters=k, random_state=42, n_init=10)
-        kmeans.fit(X_scaled)
-        inertias.append(kmeans.inertia_)
+    # The mini-batch engine gives the same outputs and reports its gap to exact KMeans
+    minibatch_rfm, _, _, minibatch_info = perform_kmeans_clustering(calculate_rfm(summary), engine='minibatch')
+    assert minibatch_info['engine'] == 'minibatch'
+    assert set(minibatch_info['quality']) >= {'sample_size', 'inertia', 'exact_inertia', 'inertia_gap',
+                                              'label_agreement'}
+    assert minibatch_info['quality']['sample_size'] == len(minibatch_rfm)
+    assert {'KMeans_Cluster', 'Cluster_Name'} <= set(minibatch_rfm.columns)
+    assert minibatch_rfm['KMeans_Cluster'].nunique() == minibatch_info['optimal_k']
+    assert 'quality' not in model_info
 
-    # Apply optimal K
-    optimal_k = 4
-    kmeans = KMeans(n_clusters=optimal_k, random_state=42, n_init=10)
-    rfm['KMeans_Cluster'] = kmeans.fit_predict(X_scaled)
+    # Too few customers to compare cluster counts is a clear error, not a KeyError
+    try:
+        perform_kmeans_clustering(calculate_rfm(summary.head(2)))
+    except ValueError as e:
+        assert 'more than 2 customers' in str(e)
+    else:
+        raise AssertionError('clustering 2 customers must raise ValueError')
 
     print(f"[OK]KMeans clustering completed")
     print(f"  Optimal K: {optimal_k}")
@@ -168,6 +214,736 @@ except Exception as e:
     traceback.print_exc()
     exit(1)
 
+# Test 7: Batch Pipeline Artifacts
+print("\n[TEST 7] Running headless batch pipeline...")
+try:
+    with tempfile.TemporaryDirectory() as output_dir:
+        manifest = run_pipeline(DATA_PATH, output_dir)
+        artifacts = load_artifacts(output_dir)
+
+        assert artifacts['manifest']['run'] == manifest['run']
+        assert len(artifacts['clusters']) == len(rfm)
+        assert set(artifacts['rfm']['Customer_Segment']) == set(rfm['Customer_Segment'])
+        # Only the pipeline saves a cluster model, kept per source
+        assert not artifacts['clustering']['warm_started']
+        assert os.path.exists(cluster_model_path(DATA_PATH))
+        # Item preferences keep one group per cluster ID, even where names repeat
+        clusters = artifacts['clusters'].drop_duplicates('KMeans_Cluster').sort_values('KMeans_Cluster')
+        labels = ('Cluster ' + clusters['KMeans_Cluster'].astype(str) + ': ' + clusters['Cluster_Name']).tolist()
+        by_cluster = artifacts['item_preferences'].query("Grouping == 'KMeans Cluster'")
+        assert by_cluster['Segment'].unique().tolist() == labels
+
+        print(f"[OK]Pipeline artifacts written and reloaded")
+        print(f"  Run: {manifest['run']}")
+        print(f"  Tables: {sorted(name for name in os.listdir(os.path.join(output_dir, manifest['run'])))}")
+
+    # A second run on the same source warm-starts and keeps cluster IDs and names
+    with tempfile.TemporaryDirectory() as model_dir:
+        model_path = os.path.join(model_dir, 'kmeans_model.json')
+        first, _, _, first_info = perform_kmeans_clustering(calculate_rfm(summary), model_path=model_path)
+        second, _, _, second_info = perform_kmeans_clustering(calculate_rfm(summary), model_path=model_path)
+        assert not first_info['warm_started'] and second_info['warm_started']
+        assert second_info['optimal_k'] == first_info['optimal_k']
+        pd.testing.assert_frame_equal(second[['Customer ID', 'KMeans_Cluster', 'Cluster_Name']],
+                                      first[['Customer ID', 'KMeans_Cluster', 'Cluster_Name']])
+    print(f"  Warm-started rerun kept all {second_info['optimal_k']} cluster IDs and names")
+except Exception as e:
+    print(f"[ERROR]Error in batch pipeline: {e}")
+    import traceback
+    traceback.print_exc()
+    exit(1)
+
+# Test 8: Level-of-Detail Sampling
+print("\n[TEST 8] Sampling clusters for large scatter plots...")
+try:
+    large = rfm.sample(50_000, replace=True, random_state=0)
+    sample = stratified_sample(large, 'KMeans_Cluster', budget=5_000, min_per_group=100)
+
+    assert len(sample) <= 5_000 + 100 * optimal_k
+    assert set(sample['KMeans_Cluster']) == set(large['KMeans_Cluster'])
+    assert stratified_sample(rfm, 'KMeans_Cluster', budget=len(rfm)) is rfm
+
+    print(f"[OK]Stratified sample drawn")
+    print(f"  {len(sample):,} of {len(large):,} customers across {sample['KMeans_Cluster'].nunique()} clusters")
+except Exception as e:
+    print(f"[ERROR]Error sampling clusters: {e}")
+    import traceback
+    traceback.print_exc()
+    exit(1)
+
+# Test 9: Synthetic Data Generator
+print("\n[TEST 9] Generating synthetic transactions...")
+try:
+    synthetic = generate_transactions(5_000, 500, seed=1)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        synthetic_path = os.path.join(tmp_dir, 'synthetic.csv')
+        write_transactions_csv(synthetic, synthetic_path)
+        synthetic_df = load_and_process_data(synthetic_path)
+
+    assert list(synthetic_df.columns) == list(df.columns)
+    assert len(synthetic_df) == 5_000
+    assert synthetic_df['Customer ID'].nunique() == 500
+    assert len(calculate_rfm(build_customer_summary(synthetic_df))) == 500
+
+    print(f"[OK]Synthetic data matches the source schema")
+    print(f"  {len(synthetic_df):,} transactions, {synthetic_df['Customer ID'].nunique()} customers")
+except Exception as e:
+    print(f"[ERROR]Error generating synthetic data: {e}")
+    import traceback
+    traceback.print_exc()
+    exit(1)
+
+# Test 10: Stage Instrumentation
+print("\n[TEST 10] Recording per-stage instrumentation...")
+try:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        metrics_log.path = os.path.join(tmp_dir, 'metrics.jsonl')
+        with collect() as records:
+            compute_artifacts(DATA_PATH)
+        with open(metrics_log.path) as f:
+            logged = [json.loads(line) for line in f]
+        metrics_log.path = None
+
+    stages = {record['stage']: record for record in records}
+    assert {'load_transactions', 'summary', 'rfm', 'kmeans'} <= set(stages)
+    assert stages['summary']['rows'] == len(rfm)
+    assert len(logged) == len(records)
+
+    print(f"[OK]{len(records)} stages recorded")
+    for record in records:
+        print(f"  {record['stage']:<24} {record['seconds']:.3f}s")
+except Exception as e:
+    print(f"[ERROR]Error recording instrumentation: {e}")
+    import traceback
+    traceback.print_exc()
+    exit(1)
+
+# Test 11: Sketch-Based RFM Scoring
+print("\n[TEST 11] Scoring RFM from merged quantile sketches...")
+try:
+    large_summary = build_customer_summary(generate_transactions(60_000, 20_000, seed=2))
+    snapshot_date = large_summary['LastPurchase'].max() + pd.Timedelta(days=1)
+    partitions = [large_summary.iloc[i::4] for i in range(4)]
+
+    sketches = merge_rfm_sketches(*[sketch_rfm(rfm_values(part, snapshot_date)) for part in partitions])
+    approximate = pd.concat([calculate_rfm(part, snapshot_date=snapshot_date, sketches=sketches)
+                             for part in partitions])
+    report = rfm_sketch_error(calculate_rfm(large_summary), approximate, sketches)
+
+    assert len(approximate) == len(large_summary)
+    assert max(report['score_share_error'].values()) <= 2 * report['rank_error_bound']
+
+    print(f"[OK]Scored {report['customers']:,} customers from {len(partitions)} partitions")
+    print(f"  Rank error bound: {report['rank_error_bound']:.2%}")
+    for score, error in report['score_share_error'].items():
+        print(f"    - {score} share error: {error:.2%}")
+except Exception as e:
+    print(f"[ERROR]Error scoring RFM from sketches: {e}")
+    import traceback
+    traceback.print_exc()
+    exit(1)
+
+# Test 12: Daily Rollup Cube
+print("\n[TEST 12] Re-deriving summaries from the daily rollup cube...")
+try:
+    cube = build_daily_cube(df)
+    pd.testing.assert_frame_equal(filter_summary(cube), summary, check_dtype=False)
+
+    selections = {'Payment Method': ['Card'], 'Weather': ['Sunny', 'Cloudy']}
+    filtered = filter_summary(cube, '2024-04-05', '2024-04-20', selections)
+    matching = df[(df['Date'] >= '2024-04-05') & (df['Date'] <= '2024-04-20')
+                  & (df['Payment Method'] == 'Card') & df['Weather'].isin(['Sunny', 'Cloudy'])]
+    pd.testing.assert_frame_equal(filtered, build_customer_summary(matching), check_dtype=False)
+
+    # Scores survive the tied quantile edges of a small filtered view
+    cash = filter_summary(cube, selections={'Payment Method': ['Cash']})
+    cash_rfm = calculate_rfm(cash)
+    assert len(cash_rfm) == len(cash) and cash_rfm['M_Score'].notna().all()
+    assert calculate_cltv(cash)['CLTV'].notna().all()
+
+    print(f"[OK]Cube rows: {len(cube)}")
+    print(f"  Filtered customers: {len(filtered)} of {len(summary)}")
+except Exception as e:
+    print(f"[ERROR]Error filtering the daily cube: {e}")
+    import traceback
+    traceback.print_exc()
+    exit(1)
+
+# Test 13: Probabilistic CLTV
+print("\n[TEST 13] Fitting BG/NBD + Gamma-Gamma CLTV models...")
+try:
+    synthetic_summary = build_customer_summary(synthetic_df)
+    predictions, params = predict_cltv(synthetic_summary)
+    assert params['fitted'] and params['bgnbd']['converged'] and params['gamma_gamma']['converged']
+    assert predictions.notna().all().all()
+    assert predictions['ProbabilityAlive'].between(0, 1).all()
+    assert (predictions['PredictedCLTV'] >= 0).all()
+
+    # The fit on distinct tuples has the same likelihood as one over every customer
+    stats = sufficient_statistics(synthetic_summary)
+    bgnbd = [params['bgnbd'][key] for key in ('r', 'alpha', 'a', 'b')]
+    per_customer = bgnbd_log_likelihood(bgnbd, stats['frequency'], stats['recency'], stats['T']).sum()
+    tuples = stats[['frequency', 'recency', 'T']].value_counts().reset_index()
+    per_tuple = (tuples['count'] * bgnbd_log_likelihood(bgnbd, tuples['frequency'], tuples['recency'], tuples['T'])).sum()
+    assert np.isclose(per_customer, per_tuple)
+    assert params['bgnbd']['distinct_tuples'] == len(tuples)
+
+    # Purchases are purchase days, and Gamma-Gamma only sees repeat customers
+    purchase_days = synthetic_df.groupby('Customer ID')['Date'].nunique()
+    assert (stats['frequency'].to_numpy() == purchase_days.loc[synthetic_summary['Customer ID']].to_numpy() - 1).all()
+    assert (synthetic_summary['PurchaseDays'] < synthetic_summary['NumPurchases']).any()
+    repeat = stats[stats['frequency'] > 0]
+    assert params['gamma_gamma']['distinct_tuples'] == len(repeat[['frequency']].assign(m=repeat['monetary'].round(2)).drop_duplicates())
+
+    # A filtered view is scored with the full-history parameters, never refitted
+    def refit(stats):
+        raise AssertionError('BG/NBD refitted for a filtered view')
+
+    half = synthetic_summary.iloc[::2]
+    expected, _ = predict_cltv(half, params=params)
+    fit_bgnbd, cltv_models.fit_bgnbd = cltv_models.fit_bgnbd, refit
+    context = pipeline_context(DATA_PATH)
+    try:
+        filtered_cltv = filtered_artifact('cltv', half, context, resolve={'cltv_model': params}.__getitem__)
+    finally:
+        cltv_models.fit_bgnbd = fit_bgnbd
+        close_context(context)
+    np.testing.assert_allclose(filtered_cltv['PredictedCLTV'], expected['PredictedCLTV'])
+
+    # One purchase per customer in the sample data: no model, NaN predictions
+    assert cltv_data['PredictedCLTV'].isna().all()
+
+    print(f"[OK]Models fitted on {params['bgnbd']['distinct_tuples']} distinct tuples for {len(stats)} customers")
+    print(f"  Predicted {params['horizon_days']}-day CLTV: ${predictions['PredictedCLTV'].sum():.2f}")
+except Exception as e:
+    print(f"[ERROR]Error fitting CLTV models: {e}")
+    import traceback
+    traceback.print_exc()
+    exit(1)
+
+# Test 14: Shared Artifact Cache
+print("\n[TEST 14] Sharing computed artifacts through the on-disk cache...")
+try:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cache_path = os.path.join(tmp_dir, 'shared.sqlite')
+        computed = []
+
+        def compute():
+            computed.append(1)
+            time.sleep(0.2)
+            return rfm
+
+        # Concurrent misses on one key compute once; the rest read the result
+        results = []
+        workers = [threading.Thread(target=lambda: results.append(SQLiteCache(cache_path).get_or_compute('rfm', compute)))
+                   for _ in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        assert len(computed) == 1 and sorted(cached for _, cached in results) == [False, True, True, True]
+        pd.testing.assert_frame_equal(results[0][0], rfm)
+
+        # Keys change with the code version; old entries expire or are evicted
+        cache = SQLiteCache(cache_path, max_bytes=10_000)
+        assert cache.make_key('data', 'rfm', 'v1') != cache.make_key('data', 'rfm', 'v2')
+        for i in range(5):
+            cache.get_or_compute(f'blob{i}', lambda: b'x' * 4_000)
+        assert cache.stats()['bytes'] <= 10_000 and cache.get('blob4')[0] and not cache.get('blob0')[0]
+        assert not SQLiteCache(cache_path, ttl=0).get('blob4')[0]
+        # Lock files stay in place, so a worker about to lock one is never cut off
+        assert sorted(os.listdir(cache.lock_dir)) == [f'blob{i}.lock' for i in range(5)] + ['rfm.lock']
+        assert SHARED_CACHE_PATH == os.path.join(cache_dir.name, 'shared_cache.sqlite')
+
+        # Backends must implement get, put and lock
+        try:
+            CacheBackend()
+        except TypeError:
+            pass
+        else:
+            raise AssertionError('CacheBackend must be abstract')
+
+    print(f"[OK]4 concurrent requests, {len(computed)} computation")
+except Exception as e:
+    print(f"[ERROR]Error in shared artifact cache: {e}")
+    import traceback
+    traceback.print_exc()
+    exit(1)
+
+# Test 15: CLTV Concentration Curve
+print("\n[TEST 15] Computing the CLTV concentration curve...")
+try:
+    concentration = concentration_curve(cltv_data)
+    cltv_clean = cltv_data[cltv_data['CLTV'] <= cltv_data['CLTV'].quantile(0.99)]
+    sorted_values = np.sort(cltv_clean['CLTV'].to_numpy())[::-1]
+    top_20 = int(round(0.2 * len(sorted_values)))
+
+    assert concentration['customers'] == len(cltv_clean)
+    assert np.isclose(concentration['total'], cltv_clean['CLTV'].sum())
+    assert np.isclose(concentration['top_shares']['0.2'], sorted_values[:top_20].sum() / sorted_values.sum() * 100)
+    assert 0 <= concentration['gini'] < 1
+    assert np.all(np.diff(concentration['curve']['cumulative_percent']) >= 0)
+
+    # Large tables are reduced to a fixed number of curve points
+    large = concentration_curve(pd.DataFrame({'CLTV': np.random.default_rng(0).lognormal(3, 1, 200_000)}), points=500)
+    assert len(large['curve']['customer_percent']) == 501
+    assert np.isclose(large['curve']['cumulative_percent'][-1], 100)
+
+    print(f"[OK]Top 20% of customers hold {concentration['top_shares']['0.2']:.1f}% of CLTV")
+    print(f"  Gini coefficient: {concentration['gini']:.3f}")
+except Exception as e:
+    print(f"[ERROR]Error computing the concentration curve: {e}")
+    import traceback
+    traceback.print_exc()
+    exit(1)
+
+# Test 16: SQL Data Source
+print("\n[TEST 16] Aggregating transactions in SQLite...")
+try:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = os.path.join(tmp_dir, 'transactions.sqlite')
+        write_transactions_sqlite(DATA_PATH, db_path)
+        source = SQLiteSource(db_path)
+
+        pd.testing.assert_frame_equal(source.customer_summary(), summary, check_dtype=False)
+        pd.testing.assert_frame_equal(source.daily_cube(), build_daily_cube(df), check_dtype=False)
+
+        # The batch pipeline reads a SQLite path through the same source
+        with tempfile.TemporaryDirectory() as sql_dir, tempfile.TemporaryDirectory() as csv_dir:
+            run_pipeline(db_path, sql_dir)
+            run_pipeline(DATA_PATH, csv_dir)
+            for name in ['rfm', 'cltv', 'daily_cube', 'item_pairs']:
+                pd.testing.assert_frame_equal(load_artifacts(sql_dir)[name], load_artifacts(csv_dir)[name])
+        source.pool.close()
+
+        # One source per run: its pool serves every query and is closed at the end
+        context = pipeline_context(db_path)
+        memo = {}
+        for name in ['summary', 'daily_cube', 'baskets']:
+            resolve_artifact(name, context, memo)
+        assert context['source'].pool.opened == 1
+        close_context(context)
+        assert context['source'].pool.opened == 0
+
+        # The base class leaves connecting and fingerprinting to subclasses
+        try:
+            SQLSource()
+        except TypeError:
+            pass
+        else:
+            raise AssertionError('SQLSource must be abstract')
+
+    print(f"[OK]SQL summary matches the pandas path for {len(summary)} customers")
+except Exception as e:
+    print(f"[ERROR]Error in SQL data source: {e}")
+    import traceback
+    traceback.print_exc()
+    exit(1)
+
+# Test 17: Rolling RFM Snapshots
+print("\n[TEST 17] Computing rolling RFM snapshots and segment migration...")
+try:
+    dates = snapshot_dates(df['Date'].min(), df['Date'].max(), freq='W-MON')
+    for date, snapshot_summary in rolling_customer_summaries(cube, dates):
+        pd.testing.assert_frame_equal(snapshot_summary, build_customer_summary(df[df['Date'] < date]), check_dtype=False)
+
+    # The last snapshot is the regular single-snapshot RFM
+    last_date, last_rfm = list(rolling_rfm(cube, freq='W-MON'))[-1]
+    assert (last_rfm['Customer_Segment'].to_numpy() == calculate_rfm(summary)['Customer_Segment'].to_numpy()).all()
+
+    # Customers only move between segments: each snapshot's From counts are the previous To counts
+    transitions = segment_transitions(cube, freq='W-MON')
+    counts_to = transitions.groupby(['Snapshot', 'To_Segment'])['Customers'].sum()
+    counts_from = transitions[transitions['From_Segment'] != 'New'].groupby(['Snapshot', 'From_Segment'])['Customers'].sum()
+    snapshots = sorted(transitions['Snapshot'].unique())
+    for previous, current in zip(snapshots, snapshots[1:]):
+        assert counts_from[current].sort_index().equals(counts_to[previous][counts_to[previous] > 0].sort_index())
+    assert transitions.loc[transitions['Snapshot'] == last_date, 'Customers'].sum() == len(summary)
+
+    print(f"[OK]{len(snapshots)} weekly snapshots, {len(transitions)} segment transitions")
+except Exception as e:
+    print(f"[ERROR]Error in rolling RFM: {e}")
+    import traceback
+    traceback.print_exc()
+    exit(1)
+
+# Test 18: Cohort Retention Matrices
+print("\n[TEST 18] Building cohort retention matrices...")
+try:
+    cohorts = cohort_matrices(build_daily_cube(synthetic_df), 'month')
+
+    months = synthetic_df['Date'].dt.to_period('M')
+    first_month = months.groupby(synthetic_df['Customer ID']).transform('min')
+    age = (months - first_month).apply(lambda offset: offset.n)
+    expected = synthetic_df.groupby([first_month.dt.start_time, age])['Customer ID'].nunique().unstack()
+
+    observed = cohorts['customers']
+    assert np.allclose(observed.fillna(0).to_numpy(),
+                       expected.reindex(index=observed.index, columns=observed.columns).fillna(0).to_numpy())
+    assert cohorts['sizes'].sum() == synthetic_df['Customer ID'].nunique()
+    assert (cohorts['retention'].iloc[:, 0] == 1).all()
+    assert np.isclose(np.nansum(cohorts['revenue'].to_numpy()), synthetic_df['Total'].sum())
+    # The latest cohort has not been observed for later periods yet
+    assert observed.iloc[-1, 1:].isna().all()
+
+    print(f"[OK]{len(cohorts['sizes'])} monthly cohorts over {observed.shape[1]} periods")
+    print(f"  Retention after 1 month: {cohorts['retention'].iloc[:, 1].mean():.1%} (cohort average)")
+except Exception as e:
+    print(f"[ERROR]Error building cohort matrices: {e}")
+    import traceback
+    traceback.print_exc()
+    exit(1)
+
+# Test 19: Basket Affinity
+print("\n[TEST 19] Building sparse basket matrices and item affinity...")
+try:
+    lines = basket_lines(synthetic_df)
+    baskets = build_baskets(lines)
+    pairs = item_pair_metrics(baskets)
+
+    # Pair counts match a dense self-join of the basket lines
+    keyed = lines.assign(Item=lines['Item'].astype(str))
+    joined = keyed.merge(keyed, on=['Customer ID', 'Date', 'Time'])
+    expected = joined[joined['Item_x'] != joined['Item_y']].groupby(['Item_x', 'Item_y']).size()
+    counted = pairs.set_index(['Antecedent', 'Consequent'])['Baskets']
+    pd.testing.assert_series_equal(counted.sort_index(), expected.sort_index(),
+                                   check_names=False, check_index_type=False, check_dtype=False)
+    # Lift is symmetric, confidence is not
+    lift = pairs.set_index(['Antecedent', 'Consequent'])['Lift']
+    assert np.allclose(lift.to_numpy(), lift.reindex(lift.index.swaplevel()).to_numpy())
+
+    # Every basket of a labelled customer counts toward its segment
+    segments = calculate_rfm(build_customer_summary(synthetic_df)).set_index('Customer ID')['Customer_Segment']
+    preferences = segment_item_preferences(baskets, segments)
+    assert preferences['Baskets'].sum() == len(lines)
+    assert (preferences['Share'] <= 1).all()
+
+    print(f"[OK]{baskets['basket_items'].shape[0]:,} baskets, {len(pairs)} item pairs")
+    print(f"  Highest lift: {pairs['Antecedent'].iloc[0]} -> {pairs['Consequent'].iloc[0]} ({pairs['Lift'].iloc[0]:.2f})")
+except Exception as e:
+    print(f"[ERROR]Error building basket affinity: {e}")
+    import traceback
+    traceback.print_exc()
+    exit(1)
+
+# Test 20: Lookalike Index
+print("\n[TEST 20] Querying the lookalike index...")
+try:
+    index = LookalikeIndex.from_rfm(rfm)
+    vectors = np.asarray(index.tree.data)
+    seeds = rfm['Customer ID'].sample(20, random_state=0).to_numpy()
+    neighbours = index.query(seeds, k=5)
+
+    # Batch k-NN matches brute-force distances, without the seed itself
+    for seed, found in neighbours.groupby('Seed'):
+        distances = np.linalg.norm(vectors - vectors[index.rows([seed])[0]], axis=1)
+        distances[index.rows([seed])[0]] = np.inf
+        assert np.allclose(found['Distance'].to_numpy(), np.sort(distances)[:5])
+        assert seed not in set(found['Customer ID'])
+
+    # The audience leaves out the whole seed group
+    champions = rfm.loc[rfm['Customer_Segment'] == 'Champions', 'Customer ID']
+    audience = index.audience(champions.head(5), k=5, exclude=champions)
+    assert not audience['Customer ID'].isin(champions).any()
+    assert audience['Customer ID'].is_unique
+
+    # The pipeline persists the index built from its clusters
+    persisted = artifacts['lookalike_index'].query(seeds, k=5)
+    assert np.allclose(persisted['Distance'], neighbours['Distance'])
+
+    print(f"[OK]{len(neighbours)} neighbours of {len(seeds)} seeds match brute force")
+    print(f"  Lookalike audience of {len(champions.head(5))} Champions: {len(audience)} customers")
+except Exception as e:
+    print(f"[ERROR]Error in lookalike index: {e}")
+    import traceback
+    traceback.print_exc()
+    exit(1)
+
+# Test 21: Incremental Customer State
+print("\n[TEST 21] Refreshing the customer state of an append-only export...")
+try:
+    state_tables = ['summary', *ROLLUP_TABLES]
+
+    def sorted_state(state):
+        """State tables in a canonical row order, with categories as plain values"""
+        keys = {'summary': ['Customer ID'], 'daily_cube': ['Customer ID', 'Date', 'Payment Method', 'Weather',
+                                                           'Special Offers', 'Employee ID'],
+                'basket_lines': ['Customer ID', 'Date', 'Time', 'Item']}
+        return {name: state[name].astype({column: object for column in state[name].select_dtypes('category')})
+                .sort_values(keys[name], ignore_index=True) for name in state_tables}
+
+    def assert_full_state(path, csv_bytes):
+        """The refreshed state matches full builds over a standalone CSV with these bytes"""
+        state = sorted_state({'summary': refresh_customer_state(path, chunksize=700)[0],
+                              **refresh_rollup_state(path, chunksize=700)})
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            expected_path = os.path.join(tmp_dir, 'expected.csv')
+            with open(expected_path, 'wb') as f:
+                f.write(csv_bytes)
+            df = load_and_process_data(expected_path)
+        expected = sorted_state({'summary': build_customer_summary(df), 'daily_cube': build_daily_cube(df),
+                                 'basket_lines': basket_lines(df)})
+        for name in state_tables:
+            pd.testing.assert_frame_equal(state[name], expected[name], check_dtype=False)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        source_path = os.path.join(tmp_dir, 'export.csv')
+        write_transactions_csv(generate_transactions(3_000, 300, seed=2), source_path)
+        with open(source_path, 'rb') as f:
+            content = f.read()
+        lines = content.splitlines(keepends=True)
+        head = b''.join(lines[:1_500])
+        partial_line = lines[2_000][:10]
+
+        # The summary is refreshed on its own, without building the rollups
+        with open(source_path, 'wb') as f:
+            f.write(head)
+        refresh_customer_state(source_path, chunksize=700)
+        assert os.path.exists(customer_state_manifest_path(source_path))
+        assert not os.path.exists(rollup_state_manifest_path(source_path))
+        # State is kept per absolute path, not per file name
+        same_name = os.path.join(tmp_dir, 'other', 'export.csv')
+        assert customer_state_manifest_path(same_name) != customer_state_manifest_path(source_path)
+
+        def rollup_files():
+            with open(rollup_state_manifest_path(source_path)) as f:
+                return json.load(f)['state_files']
+
+        # First run, then an append ending in a partially written line
+        assert_full_state(source_path, head)
+        first_files = rollup_files()
+        with open(source_path, 'ab') as f:
+            f.write(b''.join(lines[1_500:2_000]))
+        with open(source_path, 'ab') as f:
+            f.write(partial_line)
+        assert_full_state(source_path, b''.join(lines[:2_000]))
+
+        # Only the months the appended rows fall in are merged and rewritten
+        appended_month = lines[1_500][:7].decode()
+        appended_files = rollup_files()
+        kept = {partition for partition in first_files if partition.split('/')[1] < appended_month}
+        assert kept and all(appended_files[partition] == first_files[partition] for partition in kept)
+        assert all(appended_files[partition] != state_file for partition, state_file in first_files.items()
+                   if partition not in kept)
+        assert set(appended_files) > set(first_files)
+
+        # The rest of the line and the remaining rows resume from the stored offset
+        with open(source_path, 'ab') as f:
+            f.write(lines[2_000][10:] + b''.join(lines[2_001:]))
+        assert_full_state(source_path, content)
+
+        # A rewritten file no longer matches the stored prefix hash and is rebuilt
+        rewritten = lines[0] + b''.join(lines[1:1_000:2])
+        with open(source_path, 'wb') as f:
+            f.write(rewritten)
+        assert_full_state(source_path, rewritten)
+
+        # A header-only export gives empty tables, like a full load
+        with open(source_path, 'wb') as f:
+            f.write(lines[0])
+        summary_state, snapshot_date = refresh_customer_state(source_path)
+        assert snapshot_date is None and summary_state.empty
+        assert all(table.empty for table in refresh_rollup_state(source_path).values())
+
+    print(f"[OK]Incremental summary, daily cube and basket lines match full rebuilds "
+          f"after appends, a partial line and a rewrite")
+except Exception as e:
+    print(f"[ERROR]Error refreshing customer state: {e}")
+    import traceback
+    traceback.print_exc()
+    exit(1)
+
+# Test 22: Figure Cache
+print("\n[TEST 22] Evicting rendered figures from the byte-bounded cache...")
+try:
+    figure_cache = FigureCache(max_bytes=250)
+    figure_cache.put('a', b'a' * 100)
+    figure_cache.put('b', b'b' * 100)
+    figure_cache.put('c', b'c' * 100)
+    # Over budget: the oldest entry goes first
+    assert figure_cache.get('a') is None and figure_cache.get('b') is not None
+    assert len(figure_cache) == 2 and figure_cache.size == 200 <= figure_cache.max_bytes
+
+    # A hit makes an entry recent, so the least recently used one is evicted next
+    figure_cache.put('d', b'd' * 100)
+    assert figure_cache.get('c') is None and figure_cache.get('b') is not None and figure_cache.get('d') is not None
+    assert figure_cache.size <= figure_cache.max_bytes
+    # Entries larger than the whole budget are not stored
+    figure_cache.put('e', b'e' * 300)
+    assert figure_cache.get('e') is None and figure_cache.size == 200
+    assert (figure_cache.hits, figure_cache.misses) == (3, 3)
+
+    # get_or_render plots only on a miss
+    calls = []
+
+    def plot(title):
+        calls.append(title)
+        fig, ax = plt.subplots(figsize=(2, 2))
+        ax.set_title(title)
+        return fig
+
+    figure_cache = FigureCache()
+    png, cached = figure_cache.get_or_render('fingerprint', 'chart', plot, title='x')
+    assert not cached and png.startswith(b'\x89PNG')
+    assert figure_cache.get_or_render('fingerprint', 'chart', plot, title='x') == (png, True)
+    assert not figure_cache.get_or_render('fingerprint', 'chart', plot, title='y')[1]
+    assert calls == ['x', 'y'] and (figure_cache.hits, figure_cache.misses) == (1, 2)
+
+    print(f"[OK]Least recently used figures evicted within the byte budget")
+    print(f"  Rendered {len(calls)} figures for 3 requests ({figure_cache.size:,} bytes cached)")
+except Exception as e:
+    print(f"[ERROR]Error in figure cache: {e}")
+    import traceback
+    traceback.print_exc()
+    exit(1)
+
+# Test 23: Segment Rule Tables
+print("\n[TEST 23] Checking the segment rule tables against the original if/elif logic...")
+try:
+    def baseline_segment(row):
+        """The row-wise RFM segmentation the rule table replaced"""
+        if row['RFM_Segment'] >= 10 and row['R_Score'] >= 4:
+            return 'Champions'
+        elif row['RFM_Segment'] >= 7 and row['R_Score'] >= 3:
+            return 'Loyal Customers'
+        elif row['F_Score'] >= 3 and row['R_Score'] >= 3:
+            return 'Potential Loyalists'
+        elif row['R_Score'] >= 4:
+            return 'Recent Customers'
+        elif row['RFM_Segment'] >= 6 and row['R_Score'] <= 2:
+            return 'At Risk'
+        elif row['F_Score'] >= 2 and row['R_Score'] <= 2:
+            return 'Cant Lose Them'
+        elif row['R_Score'] <= 2:
+            return 'Lost'
+        else:
+            return 'Others'
+
+    def baseline_cluster_name(cluster_id, profiles):
+        """The row-wise cluster naming the rule table replaced"""
+        profile = profiles.loc[cluster_id]
+        if profile['Frequency'] > profiles['Frequency'].quantile(0.75) and profile['Monetary'] > profiles['Monetary'].quantile(0.75):
+            return 'VIP Champions'
+        elif profile['Recency'] < profiles['Recency'].quantile(0.25) and profile['Monetary'] > profiles['Monetary'].median():
+            return 'Recent Big Spenders'
+        elif profile['Frequency'] <= profiles['Frequency'].quantile(0.25) and profile['Monetary'] <= profiles['Monetary'].quantile(0.25):
+            return 'Low Engagement'
+        else:
+            return 'Regular Customers'
+
+    # Every combination of scores gets the same segment
+    scores = pd.MultiIndex.from_product([range(1, 6), range(1, 6), range(1, 4)],
+                                        names=['R_Score', 'F_Score', 'M_Score']).to_frame(index=False)
+    scores['RFM_Segment'] = scores.sum(axis=1)
+    expected = scores.apply(baseline_segment, axis=1).to_numpy()
+    assert (evaluate_segment_rules(scores, RFM_SEGMENT_RULES, RFM_DEFAULT_SEGMENT) == expected).all()
+
+    # And random cluster profiles get the same names
+    rng = np.random.default_rng(0)
+    for _ in range(50):
+        profiles = pd.DataFrame(rng.gamma(2.0, 10.0, size=(int(rng.integers(2, 11)), 3)),
+                                columns=['Recency', 'Frequency', 'Monetary'])
+        expected = [baseline_cluster_name(i, profiles) for i in profiles.index]
+        assert list(name_clusters(profiles)) == expected
+
+    # A rules CSV replaces the built-in table for the pipeline
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        rules_path = os.path.join(tmp_dir, 'rfm_segment_rules.csv')
+        pd.DataFrame([('Top Tier', 'RFM_Segment', '>=', 9), ('Reachable', 'R_Score', '>=', 3)],
+                     columns=['Segment', 'Column', 'Op', 'Value']).to_csv(rules_path, index=False)
+        assert load_segment_rules(os.path.join(tmp_dir, 'missing.csv')) == RFM_SEGMENT_RULES
+        overridden = resolve_artifact('rfm', pipeline_context(DATA_PATH, rules_path), {})
+        assert set(overridden['Customer_Segment']) <= {'Top Tier', 'Reachable', RFM_DEFAULT_SEGMENT}
+        top_tier = (overridden['RFM_Segment'] >= 9).to_numpy()
+        assert (overridden.loc[top_tier, 'Customer_Segment'] == 'Top Tier').all()
+        assert (overridden['Customer_Segment'] == 'Reachable').to_numpy().sum() == (
+            ~top_tier & (overridden['R_Score'].astype(int) >= 3).to_numpy()).sum()
+
+        # Cache keys follow the rules file, so edited rules are never served stale
+        assert rules_fingerprint(os.path.join(tmp_dir, 'missing.csv')) == 'default'
+        before = rules_fingerprint(rules_path)
+        with open(rules_path, 'a') as f:
+            f.write('Everyone,RFM_Segment,>=,0\n')
+        assert rules_fingerprint(rules_path) not in (before, 'default')
+
+    print(f"[OK]Rule tables match the original logic on {len(scores)} score combinations and 50 cluster profiles")
+    print(f"  Override segments: {sorted(overridden['Customer_Segment'].unique())}")
+except Exception as e:
+    print(f"[ERROR]Error in segment rule tables: {e}")
+    import traceback
+    traceback.print_exc()
+    exit(1)
+
+# Test 24: Transaction Cache Invalidation
+print("\n[TEST 24] Invalidating the Parquet transaction cache when the source changes...")
+try:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        source_path = os.path.join(tmp_dir, 'cached.csv')
+        with open(DATA_PATH, 'rb') as f:
+            source_lines = f.read().splitlines(keepends=True)
+        with open(source_path, 'wb') as f:
+            f.write(b''.join(source_lines[:101]))
+
+        first = load_and_process_data(source_path)
+        first_cache = transaction_cache_path(source_path, source_fingerprint(source_path))
+        assert len(first) == 100 and os.path.exists(first_cache)
+        # A fresh cache is read back unchanged
+        pd.testing.assert_frame_equal(load_and_process_data(source_path), first)
+
+        # Appended rows change the fingerprint: the cache is rebuilt and the old file dropped
+        with open(source_path, 'ab') as f:
+            f.write(b''.join(source_lines[101:]))
+        appended = load_and_process_data(source_path)
+        appended_cache = transaction_cache_path(source_path, source_fingerprint(source_path))
+        assert appended_cache != first_cache and os.path.exists(appended_cache) and not os.path.exists(first_cache)
+        pd.testing.assert_frame_equal(appended.reset_index(drop=True), df_clean.reset_index(drop=True),
+                                      check_dtype=False, check_categorical=False)
+
+        # An in-place edit of the same size is picked up as well
+        assert b',Cash,' in source_lines[1]
+        with open(source_path, 'wb') as f:
+            f.write(b''.join([source_lines[0], source_lines[1].replace(b',Cash,', b',Card,')] + source_lines[2:]))
+        edited = load_and_process_data(source_path)
+        assert edited['Payment Method'].iloc[0] == 'Card' and appended['Payment Method'].iloc[0] == 'Cash'
+        assert len(glob.glob(os.path.join(cache_dir.name, 'cached-*.parquet'))) == 1
+
+    print(f"[OK]Appends and edits rebuild the cache; {len(appended)} rows after the append")
+except Exception as e:
+    print(f"[ERROR]Error invalidating the transaction cache: {e}")
+    import traceback
+    traceback.print_exc()
+    exit(1)
+
+print("\n[TEST 25] Resolving only the artifacts a page needs...")
+try:
+    from collections import Counter
+    from app import PAGE_ARTIFACTS
+
+    context = pipeline_context(DATA_PATH)
+    memo, requests = {}, Counter()
+
+    def counting_resolve(name):
+        # Stands in for the app's cached lookup: counts every request for an artifact
+        requests[name] += 1
+        return resolve_artifact(name, context, memo, counting_resolve)
+
+    try:
+        for name in PAGE_ARTIFACTS["🎯 RFM Analysis"]:
+            counting_resolve(name)
+    finally:
+        close_context(context)
+
+    computed = set(context['timings'])
+    assert computed == set(memo) == {'summary', 'rfm', 'daily_cube', 'segment_transitions'}, computed
+    assert not computed & {'clusters', 'kmeans', 'clustering', 'cltv', 'concentration'}
+    assert set(requests) == computed and max(requests.values()) == 1
+    print(f"[OK]RFM Analysis computed only {sorted(computed)} with {sum(requests.values())} resolver calls")
+except Exception as e:
+    print(f"[ERROR]Error resolving page artifacts: {e}")
+    import traceback
+    traceback.print_exc()
+    exit(1)
+
 # Final Summary
 print("\n" + "="*60)
 print("ALL TESTS PASSED SUCCESSFULLY!")